@@ -0,0 +1,244 @@
+import asyncio
+import contextlib
+import socket
+import threading
+import time
+import protocol
+from cache import SMALL_FILE_LIMIT
+from event_log import ERROR, INFO, LOG_BACKUPS, MAX_LOG_BYTES
+from scheduler import ShapedReader, ShapedWriter
+from server_core import ClientState, Error, Listing, Receive, Reply, Send, ServerCore
+
+class AsyncServer(ServerCore):
+    DEFAULT_BACKLOG = 1024
+    DEFAULT_MAX_CONNECTIONS = 10000
+
+    def __init__(self, host=ServerCore.DEFAULT_HOST, port=ServerCore.DEFAULT_PORT, files_directory="server_files",
+                 backlog=DEFAULT_BACKLOG, max_connections=DEFAULT_MAX_CONNECTIONS, zero_copy=True,
+                 send_buffer_size=protocol.SEND_BUFFER_SIZE, dedup=False, cache_size=0,
+                 cache_small_limit=SMALL_FILE_LIMIT, compress_at_rest=None, log_file=None, log_level=INFO,
+                 observer=None, metrics_port=None, profile=None, durability='none', rate_limit=0,
+                 handle_rate_limit=0, max_large_transfers=0, swarm=False, log_max_bytes=MAX_LOG_BYTES,
+                 log_backups=LOG_BACKUPS):
+        super().__init__(host, port, files_directory, backlog, zero_copy, send_buffer_size, dedup, cache_size,
+                         cache_small_limit, compress_at_rest, log_file, log_level, observer, metrics_port,
+                         profile, durability, rate_limit, handle_rate_limit, max_large_transfers, swarm,
+                         log_max_bytes, log_backups)
+        self.max_connections = max_connections
+        self.server = None
+        self.loop = None
+        self.hashing = {}  # file name -> future of its hash on the executor
+        self.clients = set()  # tasks of the connected clients
+
+    def bind(self):
+        self.server_socket = socket.create_server((self.host, self.port), backlog=self.backlog,
+                                                  reuse_port=self.reuse_port)
+        # Pick up the real port when bound to port 0
+        self.port = self.server_socket.getsockname()[1]
+
+    async def serve(self):
+        if self.server_socket is None:
+            self.bind()
+        self.events.start()
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(
+            self.handle_client, sock=self.server_socket, backlog=self.backlog)
+        self.log_message(f"Server started on {self.host}:{self.port} (asyncio)")
+        self.start_metrics()
+        async with self.server:
+            # stop_server() closes the server, which cancels serve_forever()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.server.serve_forever()
+            # Connections still open are let go before the loop ends
+            for task in self.clients:
+                task.cancel()
+            await asyncio.gather(*self.clients, return_exceptions=True)
+
+    def start_server(self):
+        # Binds right away so errors surface to the caller, then runs the
+        # event loop on a background thread so that a GUI can own the main
+        # thread.
+        self.bind()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop_server(self):
+        if self.loop and self.server and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self.clients.add(task)
+        try:
+            await self.serve_client(reader, writer)
+        finally:
+            self.clients.discard(task)
+
+    async def serve_client(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+
+        if len(self.active_connections) >= self.max_connections:
+            protocol.write_error(writer, "Error: Server is full, try again later.")
+            await self.close_writer(writer)
+            return
+
+        if client_address in self.active_connections:
+            self.log_message(f"Rejected connection from {client_address}: Already connected")
+            await self.close_writer(writer)
+            return
+
+        self.active_connections.add(client_address)
+        self.connections_gauge.inc()
+        self.log_message(f"Connection from {client_address}")
+        # Replies of several small frames must not wait for delayed ACKs
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        state = ClientState(writer, client_address[0])
+
+        try:
+            while True:
+                try:
+                    frame, payload = await protocol.read_frame(reader)
+                    if frame is None:
+                        break
+
+                    if frame.opcode != protocol.OP_COMMAND:
+                        raise protocol.ProtocolError(f"Expected a command frame, got opcode {frame.opcode}.")
+
+                    command, params = protocol.parse_command(payload)
+                    self.events.debug("Received command", command=command, params=params, client=client_address)
+                    started = time.perf_counter()
+                    await self.dispatch(reader, writer, state, command, params)
+                    await writer.drain()
+                    self.metrics.observe_command(command, time.perf_counter() - started)
+
+                except Exception as e:
+                    self.log_message(f"Error: {str(e)}", ERROR)
+                    break
+        except asyncio.CancelledError:
+            # The server is stopping; the session is still released below
+            pass
+
+        # Clean up after client disconnects. Being cancelled again while the
+        # server stops must not leave the session or the gauge behind.
+        try:
+            await asyncio.shield(self.offload(self.sessions.blocks, self.close_session, state))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.active_connections.discard(client_address)
+            self.connections_gauge.dec()
+        await self.close_writer(writer)
+
+    async def close_writer(self, writer):
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError, asyncio.CancelledError):
+            pass
+
+    async def offload(self, blocks, function, *args):
+        # Runs function on the executor when it may block, so the other
+        # connections are served meanwhile
+        if blocks:
+            return await self.loop.run_in_executor(None, function, *args)
+        return function(*args)
+
+    async def run_codec(self, function, *args):
+        # Compressing and inflating file data is CPU work the loop must not
+        # wait for, so downloads do it on the executor a piece at a time
+        return await self.loop.run_in_executor(None, function, *args)
+
+    async def hashed(self, filename):
+        # Hashes the file on the executor. Connections asking for the same
+        # file meanwhile wait for that one hash; its errors are left for
+        # execute() to report.
+        future = self.hashing.get(filename)
+        if future is None:
+            future = self.hashing[filename] = self.loop.run_in_executor(None, self.store.hash_file, filename)
+            future.add_done_callback(lambda done: self.hashing.pop(filename, None))
+        with contextlib.suppress(Exception):
+            await asyncio.shield(future)
+
+    async def dispatch(self, reader, writer, state, command, params):
+        # Commands are checked and executed by ServerCore; this only does
+        # the stream side of its response. In a worker process the session
+        # and swarm commands are round trips to the coordinator, and a file
+        # that has not been hashed yet is hashed before execute() needs it.
+        filename = self.pending_hash(state, command, params)
+        if filename is not None:
+            await self.hashed(filename)
+        response = await self.offload(self.execute_blocks(command, params), self.execute, state, command, params)
+        if isinstance(response, Receive):
+            response = await self.receive(reader, response)
+        if isinstance(response, Reply):
+            protocol.write_reply(writer, response.message)
+        elif isinstance(response, Error):
+            if response.discard:
+                await protocol.read_stream(reader, None)
+            protocol.write_error(writer, response.message)
+        elif isinstance(response, Listing):
+            await protocol.write_chunks(writer, response.chunks)
+        elif isinstance(response, Send):
+            await self.send_file(writer, response)
+
+    def shaped(self, stream, shaped_class, handle, direction):
+        # The reader or writer of one transfer, passed through the scheduler
+        # when shaping is on
+        if not self.scheduler.enabled:
+            return contextlib.nullcontext(stream)
+        return self.shaped_transfer(stream, shaped_class, handle, direction)
+
+    @contextlib.contextmanager
+    def shaped_transfer(self, stream, shaped_class, handle, direction):
+        transfer = self.scheduler.open(handle, direction)
+        try:
+            yield shaped_class(stream, self.scheduler, transfer, self.loop)
+        finally:
+            self.scheduler.close(transfer)
+
+    async def receive(self, reader, receive):
+        # Local disk writes are small and bounded by CHUNK_SIZE, so they are
+        # done inline rather than bouncing every chunk through an executor.
+        upload = receive.upload
+        self.transfers_gauge.inc()
+        try:
+            with upload.file, self.shaped(reader, ShapedReader, receive.handle, 'in') as shaped_reader:
+                received = await protocol.read_stream(shaped_reader, upload.file, codec=receive.codec,
+                                                      digest=upload.file if receive.verify else None)
+        except Exception as e:
+            return self.receive_failed(upload, e)
+        finally:
+            self.transfers_gauge.dec()
+        # Publishing may wait for the disk, which must not stall the loop
+        return await self.offload(self.finish_blocks(upload), self.finish_receive, upload, received)
+
+    async def send_file(self, writer, send):
+        self.transfers_gauge.inc()
+        try:
+            with self.shaped(writer, ShapedWriter, send.handle, 'out') as shaped_writer:
+                await self.send_file_data(shaped_writer, send)
+        finally:
+            self.transfers_gauge.dec()
+        self.bytes_out.inc(send.count)
+
+    async def send_file_data(self, writer, send):
+        end = send.checksum is None
+        with send.file as file:
+            if send.encoded:
+                await protocol.write_stream(writer, file, send.count, zero_copy=self.zero_copy,
+                                            buffer_size=self.send_buffer_size, flags=protocol.FLAG_COMPRESSED,
+                                            end=end)
+            elif await self.offload(send.codec is not None, self.compresses, send):
+                await protocol.write_compressed(writer, file, send.count, send.codec,
+                                                buffer_size=self.send_buffer_size, end=end, run=self.run_codec)
+            else:
+                await protocol.write_stream(writer, file, send.count, zero_copy=self.zero_copy,
+                                            buffer_size=self.send_buffer_size, end=end,
+                                            run=self.run_codec if send.inflated else None)
+        if send.checksum is not None:
+            protocol.write_checksum(writer, send.checksum)
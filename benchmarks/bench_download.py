@@ -0,0 +1,150 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import protocol
+
+# Compares the download path of the server over loopback:
+#
+#   legacy    1 KiB read()/sendall() pairs, the original send_file loop
+#   buffered  one reused --send-buffer sized buffer
+#   sendfile  socket.sendfile (kernel zero-copy)
+#
+# Each mode gets a fresh headless server process so its CPU time can be read
+# from /proc (Linux only; reported as null elsewhere).
+
+MODES = {
+    'legacy': ['--no-sendfile', '--send-buffer', '1024'],
+    'buffered': ['--no-sendfile'],
+    'sendfile': [],
+}
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def make_file(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as file:
+        remaining = size
+        while remaining:
+            count = min(len(block), remaining)
+            file.write(block[:count])
+            remaining -= count
+
+
+def process_cpu_seconds(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime are fields 14 and 15 of the stat line
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+def download(sock, filename):
+    protocol.send_command(sock, f"/get {filename}")
+    frame = protocol.recv_frame_header(sock)
+    if frame.opcode == protocol.OP_ERROR:
+        raise RuntimeError(protocol.recv_exact(sock, frame.length).decode())
+    return protocol.recv_stream(sock, None, first=frame)
+
+
+def run_mode(mode, files, args, workdir):
+    command = [sys.executable, os.path.join(ROOT, 'server.py'), '--port', str(args.port)]
+    if args.engine == 'async':
+        command.append('--async')
+    server = subprocess.Popen(command + MODES[mode], cwd=workdir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        wait_for_port(args.port)
+        sock = socket.create_connection(('127.0.0.1', args.port))
+        protocol.send_command(sock, "/register bench")
+        protocol.read_response(sock)
+
+        for filename, size in files:
+            download(sock, filename)  # warm the page cache
+            cpu_before = process_cpu_seconds(server.pid)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                if download(sock, filename) != size:
+                    raise RuntimeError(f"Short download of {filename}")
+            elapsed = time.perf_counter() - start
+            cpu_after = process_cpu_seconds(server.pid)
+            results.append({
+                'mode': mode,
+                'size': size,
+                'repeat': args.repeat,
+                'mb_per_s': round(size * args.repeat / elapsed / 1024 ** 2, 1),
+                'server_cpu_s': None if cpu_before is None else round(cpu_after - cpu_before, 3),
+            })
+        sock.close()
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download path benchmark")
+    parser.add_argument('--sizes', default='1M,100M,2G', help="comma separated file sizes")
+    parser.add_argument('--modes', default=','.join(MODES), help="comma separated modes to run")
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--repeat', type=int, default=3, help="downloads per file and mode")
+    parser.add_argument('--port', type=int, default=12399)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='fx-bench-')
+    try:
+        os.makedirs(os.path.join(workdir, 'server_files'))
+        files = []
+        for text in args.sizes.split(','):
+            size = parse_size(text)
+            filename = f"bench_{text.strip()}.bin"
+            make_file(os.path.join(workdir, 'server_files', filename), size)
+            files.append((filename, size))
+
+        results = []
+        for mode in args.modes.split(','):
+            results.extend(run_mode(mode.strip(), files, args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':<10}{'size':>14}{'MB/s':>10}{'server CPU s':>14}")
+        for row in results:
+            print(f"{row['mode']:<10}{row['size']:>14}{row['mb_per_s']:>10}{str(row['server_cpu_s']):>14}")
+
+
+if __name__ == "__main__":
+    main()
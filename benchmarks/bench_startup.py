@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Measures how long the headless entry points take to become useful:
+#
+#   interpreter   `python -c pass`, the floor everything else includes
+#   import        `import server` / `import client` in a fresh interpreter
+#   threaded      spawning `server.py` until its port accepts a connection
+#   async         the same for `server.py --async`
+#   client        one `client.py dir` command against a running server
+#
+# Every row is the median of --runs fresh processes. Importing server or
+# client must not load Tk; the benchmark fails if it does, or if a row
+# other than the interpreter's exceeds --max-ms, so it can gate changes.
+
+GUI_MODULES = ('tkinter', 'ttkbootstrap', 'server_gui', 'client_gui')
+
+LOADED_GUI_MODULES = (f"import sys; sys.path.insert(0, {ROOT!r}); import server, client; "
+                      f"print(','.join(m for m in {GUI_MODULES!r} if m in sys.modules))")
+
+
+def run_timed(command, cwd):
+    start = time.perf_counter()
+    subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def wait_for_port(server, port, timeout=10):
+    # Polls often, the wait is what is being measured
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                raise RuntimeError(f"Server did not start on port {port}")
+            time.sleep(0.001)
+
+
+def time_server_start(command, port, cwd):
+    start = time.perf_counter()
+    server = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(server, port)
+        return time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def median_ms(samples):
+    return round(statistics.median(samples) * 1000, 1)
+
+
+def measure(args, workdir):
+    python = sys.executable
+    server = [python, os.path.join(ROOT, 'server.py'), '--port', str(args.port), '--log-file', '']
+    rows = {}
+    rows['interpreter'] = [run_timed([python, '-c', 'pass'], workdir) for _ in range(args.runs)]
+    for module in ('server', 'client'):
+        code = f"import sys; sys.path.insert(0, {ROOT!r}); import {module}"
+        rows[f'import {module}'] = [run_timed([python, '-c', code], workdir) for _ in range(args.runs)]
+    rows['threaded'] = [time_server_start(server, args.port, workdir) for _ in range(args.runs)]
+    rows['async'] = [time_server_start(server + ['--async'], args.port, workdir) for _ in range(args.runs)]
+
+    running = subprocess.Popen(server, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(running, args.port)
+        client = [python, os.path.join(ROOT, 'client.py'), '--port', str(args.port), 'dir']
+        rows['client'] = [run_timed(client, workdir) for _ in range(args.runs)]
+    finally:
+        running.terminate()
+        running.wait()
+    return {name: median_ms(samples) for name, samples in rows.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless start-up benchmark")
+    parser.add_argument('--runs', type=int, default=5, help="processes started per measurement")
+    parser.add_argument('--port', type=int, default=12398)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help="fail when a start-up takes longer than this many milliseconds")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='fx-bench-')
+    try:
+        loaded = subprocess.run([sys.executable, '-c', LOADED_GUI_MODULES], cwd=workdir, check=True,
+                                capture_output=True, text=True).stdout.strip()
+        results = measure(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    failures = []
+    if loaded:
+        failures.append(f"importing server and client loads {loaded}")
+    if args.max_ms is not None:
+        failures.extend(f"{name} took {ms} ms" for name, ms in results.items()
+                        if name != 'interpreter' and ms > args.max_ms)
+
+    if args.json:
+        print(json.dumps({'median_ms': results, 'gui_modules_loaded': loaded.split(',') if loaded else [],
+                          'failures': failures}, indent=2))
+    else:
+        print(f"{'start-up':<16}{'median ms':>10}")
+        for name, ms in results.items():
+            print(f"{name:<16}{ms:>10}")
+        for failure in failures:
+            print(f"Error: {failure}", file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from bench_download import parse_size, wait_for_port
+from client_core import ClientCore
+
+# Measures how much a swarm saves the server when many clients download
+# the same file at once. One server is started on loopback with --swarm and
+# the file is uploaded; then --clients processes of `client.py get` start
+# together, once as plain downloads and once with --swarm. The server's
+# bytes_sent_total tells how many copies of the file it sent each time.
+#
+# Swarm clients keep serving for --seed seconds after their download, so
+# that the slower ones can still fetch from the faster ones.
+
+
+def make_file(path, size):
+    # Unlike bench_download's files no two chunks are equal, which a client
+    # would copy from its own download instead of fetching it
+    with open(path, 'wb') as file:
+        remaining = size
+        while remaining:
+            count = min(1024 * 1024, remaining)
+            file.write(os.urandom(count))
+            remaining -= count
+
+
+def sent_bytes(core):
+    return core.stats()['metrics']['bytes_sent_total']
+
+
+def run_wave(args, core, size, workdir, swarm):
+    clients = []
+    before = sent_bytes(core)
+    start = time.perf_counter()
+    for number in range(args.clients):
+        directory = os.path.join(workdir, f"{'swarm' if swarm else 'plain'}-{number}")
+        os.makedirs(directory)
+        command = [sys.executable, os.path.join(ROOT, 'client.py'), '--port', str(args.port)]
+        if swarm:
+            command += ['--swarm', '--seed', str(args.seed)]
+        command += ['get', 'bench.bin', '--connections', str(args.connections)]
+        clients.append(subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL))
+    failed = sum(1 for client in clients if client.wait() != 0)
+    elapsed = time.perf_counter() - start
+    sent = sent_bytes(core) - before
+    return {
+        'mode': 'swarm' if swarm else 'plain',
+        'clients': args.clients,
+        'failed': failed,
+        'server_mb_sent': round(sent / 1024 ** 2, 1),
+        'copies_sent': round(sent / size, 2),
+        'seconds': round(elapsed - (args.seed if swarm else 0), 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Swarm download benchmark")
+    parser.add_argument('--size', default='64M', help="size of the downloaded file")
+    parser.add_argument('--clients', type=int, default=8, help="client processes downloading at once")
+    parser.add_argument('--connections', type=int, default=4, help="connections (or streams) per client")
+    parser.add_argument('--seed', type=float, default=3, help="seconds swarm clients keep serving when done")
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--port', type=int, default=12397)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='fx-bench-')
+    command = [sys.executable, os.path.join(ROOT, 'server.py'), '--port', str(args.port), '--swarm',
+               '--log-file', '']
+    if args.engine == 'async':
+        command.append('--async')
+    server = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.port)
+        size = parse_size(args.size)
+        make_file(os.path.join(workdir, 'bench.bin'), size)
+        core = ClientCore()
+        core.connect('127.0.0.1', args.port)
+        core.register('bench')
+        core.store(os.path.join(workdir, 'bench.bin'))
+        results = [run_wave(args, core, size, workdir, swarm) for swarm in (False, True)]
+        core.disconnect()
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':<8}{'clients':>8}{'failed':>8}{'server MB':>11}{'copies':>8}{'seconds':>9}")
+        for row in results:
+            print(f"{row['mode']:<8}{row['clients']:>8}{row['failed']:>8}{row['server_mb_sent']:>11}"
+                  f"{row['copies_sent']:>8}{row['seconds']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from bench_download import make_file, parse_size, wait_for_port
+from client_core import ClientCore, ClientError
+
+# Load generator: N simulated users, each on its own ClientCore session,
+# run a weighted mix of /register, /store, /get and /dir for a fixed time
+# and the latency percentiles, throughput and errors of every command are
+# printed as JSON.
+#
+#   register  leave (if joined), join and register again
+#   store     upload a file whose size is drawn from --sizes
+#   get       download a file some user stored before
+#   dir       list up to 100 entries
+#
+# Without --server a headless server is started on loopback in a scratch
+# directory and stopped afterwards.
+
+COMMANDS = ('register', 'store', 'get', 'dir')
+
+
+def parse_weights(text, parse_key=str):
+    # "a=3,b=1" -> [(a, 3.0), (b, 1.0)]
+    weights = []
+    for item in text.split(','):
+        key, _, weight = item.partition('=')
+        weights.append((parse_key(key.strip()), float(weight or 1)))
+    return weights
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {command: [] for command in COMMANDS}
+        self.errors = {command: 0 for command in COMMANDS}
+        self.bytes = {command: 0 for command in COMMANDS}
+        self.messages = {}
+
+    def record(self, command, elapsed, size=0, error=None):
+        with self.lock:
+            if error is None:
+                self.latencies[command].append(elapsed)
+                self.bytes[command] += size
+            else:
+                self.errors[command] += 1
+                self.messages[error] = self.messages.get(error, 0) + 1
+
+    def report(self, wall_time):
+        commands = {}
+        for command in COMMANDS:
+            latencies = sorted(self.latencies[command])
+            if not latencies and not self.errors[command]:
+                continue
+            commands[command] = {
+                'count': len(latencies),
+                'errors': self.errors[command],
+                'p50_ms': self.milliseconds(percentile(latencies, 0.50)),
+                'p95_ms': self.milliseconds(percentile(latencies, 0.95)),
+                'p99_ms': self.milliseconds(percentile(latencies, 0.99)),
+                'mb_per_s': round(self.bytes[command] / wall_time / 1024 ** 2, 2),
+            }
+        total_bytes = sum(self.bytes.values())
+        return {
+            'duration_s': round(wall_time, 2),
+            'operations': sum(len(latencies) for latencies in self.latencies.values()),
+            'ops_per_s': round(sum(len(latencies) for latencies in self.latencies.values()) / wall_time, 1),
+            'mb_per_s': round(total_bytes / wall_time / 1024 ** 2, 2),
+            'errors': sum(self.errors.values()),
+            'commands': commands,
+            'error_messages': dict(sorted(self.messages.items(), key=lambda item: -item[1])[:10]),
+        }
+
+    @staticmethod
+    def milliseconds(seconds):
+        return None if seconds is None else round(seconds * 1000, 2)
+
+
+class User(threading.Thread):
+    def __init__(self, index, args, files, stored, recorder, deadline):
+        super().__init__(daemon=True)
+        self.index = index
+        self.args = args
+        self.files = files
+        self.stored = stored
+        self.recorder = recorder
+        self.deadline = deadline
+        self.random = random.Random(args.seed + index)
+        self.core = ClientCore(codecs=None if args.compress else [], multiplex=args.mux, verify=not args.no_verify)
+        self.directory = tempfile.mkdtemp(prefix=f"user{index}-", dir=args.workdir)
+
+    def run(self):
+        commands, weights = zip(*self.args.mix)
+        while time.monotonic() < self.deadline:
+            # A broken session is replaced before anything else is tried
+            command = 'register' if not self.core.is_registered else self.random.choices(commands, weights)[0]
+            start = time.perf_counter()
+            try:
+                size = getattr(self, command)()
+            except ClientError as e:
+                self.recorder.record(command, 0, error=str(e))
+                continue
+            except Exception as e:
+                self.recorder.record(command, 0, error=f"{type(e).__name__}: {e}")
+                self.core.close()
+                continue
+            self.recorder.record(command, time.perf_counter() - start, size)
+        if self.core.is_joined:
+            try:
+                self.core.disconnect()
+            except OSError:
+                pass
+
+    def register(self):
+        if self.core.is_joined:
+            self.core.disconnect()
+        self.core.connect(self.args.host, self.args.port)
+        self.core.register(f"load{self.index}")
+        return 0
+
+    def store(self):
+        paths, weights = zip(*self.files)
+        path = self.random.choices(paths, weights)[0]
+        self.core.store(path, self.args.connections)
+        if os.path.basename(path) not in self.stored:
+            self.stored.append(os.path.basename(path))
+        return os.path.getsize(path)
+
+    def get(self):
+        if not self.stored:
+            return self.store()
+        name = self.random.choice(self.stored)
+        destination = os.path.join(self.directory, name)
+        # Ranged downloads would otherwise resume from the previous copy
+        for suffix in ('', '.part', '.ranges'):
+            if os.path.exists(destination + suffix):
+                os.remove(destination + suffix)
+        return self.core.get(name, self.args.connections, destination)
+
+    def dir(self):
+        for _ in self.core.list_directory(['limit=100']):
+            pass
+        return 0
+
+
+def start_server(args):
+    command = [sys.executable, os.path.join(ROOT, 'server.py'), '--port', str(args.port)]
+    if args.engine == 'async':
+        command.append('--async')
+    server = subprocess.Popen(command + args.server_args.split(), cwd=args.workdir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(args.port)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the file exchange server")
+    parser.add_argument('--users', type=int, default=10, help="concurrent simulated users")
+    parser.add_argument('--duration', type=float, default=10, help="seconds to run")
+    parser.add_argument('--mix', default='register=1,store=3,get=5,dir=1',
+                        help="relative weights of the commands")
+    parser.add_argument('--sizes', default='4K=50,256K=30,4M=15,32M=5',
+                        help="file sizes to upload with their relative weights")
+    parser.add_argument('--connections', type=int, default=1, help="connections per transfer")
+    parser.add_argument('--compress', action='store_true', help="offer compression at /join")
+    parser.add_argument('--no-verify', action='store_true', help="send no checksums with transfers")
+    parser.add_argument('--mux', action='store_true',
+                        help="multiplex each user's requests and ranges over one connection")
+    parser.add_argument('--text', action='store_true',
+                        help="upload compressible text instead of random bytes")
+    parser.add_argument('--server', default=None,
+                        help="host:port of a running server (default: start one on loopback)")
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--server-args', default='', help="extra arguments for the started server")
+    parser.add_argument('--port', type=int, default=12398)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    args.mix = parse_weights(args.mix)
+    for command, _ in args.mix:
+        if command not in COMMANDS:
+            parser.error(f"unknown command '{command}' in --mix")
+    args.host = '127.0.0.1'
+    if args.server:
+        args.host, _, port = args.server.rpartition(':')
+        args.port = int(port)
+
+    args.workdir = tempfile.mkdtemp(prefix='fx-load-')
+    server = None
+    try:
+        files = []
+        for size, weight in parse_weights(args.sizes, parse_size):
+            path = os.path.join(args.workdir, f"load_{size}.{'log' if args.text else 'bin'}")
+            if args.text:
+                with open(path, 'wb') as file:
+                    line = b"2024-01-01 12:00:00 INFO request served in 12 ms\n"
+                    file.write((line * (size // len(line) + 1))[:size])
+            else:
+                make_file(path, size)
+            files.append((path, weight))
+
+        if not args.server:
+            server = start_server(args)
+
+        recorder = Recorder()
+        stored = []
+        deadline = time.monotonic() + args.duration
+        users = [User(index, args, files, stored, recorder, deadline) for index in range(args.users)]
+        start = time.perf_counter()
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        report = recorder.report(time.perf_counter() - start)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(args.workdir, ignore_errors=True)
+
+    report['users'] = args.users
+    report['engine'] = None if args.server else args.engine
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
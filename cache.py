@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+
+SMALL_FILE_LIMIT = 1024 * 1024
+
+
+class MemoryFile:
+    # Read-only file object over a cached buffer. protocol.send_stream
+    # recognises memory() and sends the buffer without copying it.
+
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def memory(self, size):
+        return self.view[self.position:self.position + size]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.view) - self.position
+        data = bytes(self.view[self.position:self.position + size])
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.view[self.position:self.position + len(buffer)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position += len(self.view)
+        self.position = max(0, min(position, len(self.view)))
+        return self.position
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class FileCache:
+    # Size-bounded LRU cache of hot files for /get. Small files are kept as
+    # ready-to-send bytes, large ones as mmap views; either way an entry is
+    # tagged with the (size, mtime) it was loaded for, so a lookup never
+    # returns data of a file that has since been overwritten.
+
+    def __init__(self, budget, small_file_limit=SMALL_FILE_LIMIT):
+        self.budget = budget
+        self.small_file_limit = small_file_limit
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def admits(self, size):
+        # A single file may take at most half of the budget, otherwise one
+        # large download would flush everything else.
+        return size <= self.budget // 2
+
+    def get(self, name, version):
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self.drop(name)
+                self.invalidations += 1
+            self.misses += 1
+            return None
+
+    def put(self, name, version, buffer):
+        view = memoryview(buffer)
+        with self.lock:
+            if name in self.entries:
+                self.drop(name)
+            self.entries[name] = (version, view)
+            self.used += len(view)
+            while self.used > self.budget and self.entries:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+        return view
+
+    def drop(self, name):
+        # Views handed out earlier stay valid; an mmap is only unmapped once
+        # the last of them is gone.
+        _, view = self.entries.pop(name)
+        self.used -= len(view)
+
+    def invalidate(self, name):
+        with self.lock:
+            if name in self.entries:
+                self.drop(name)
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'budget': self.budget,
+                'used': self.used,
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
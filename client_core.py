@@ -0,0 +1,689 @@
+import contextlib
+import hashlib
+import io
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import compression
+import protocol
+from mux import Multiplexer, announced_mux
+from storage import (BLOB_CHUNK_SIZE, CHECKSUM_ALGORITHM, BoundedBuffer, HashingReader, HashingWriter, PartialFile,
+                     iter_chunks, missing_ranges, stream_checksum)
+from swarm import (CHUNK_SIZE, POLL_INTERVAL, PeerServer, chunk_count, chunk_span, fetch_piece, is_chunk_intact,
+                   missing_chunks)
+
+# Files larger than this, or transfers over several connections, are moved
+# in ranges of this size so an interrupted transfer can resume.
+RANGE_SIZE = 8 * 1024 * 1024
+
+# Number of chunk hashes asked about per /chunks command
+CHUNK_QUERY_SIZE = 1000
+
+
+class ClientError(Exception):
+    # Refusals reported by the server or misuse of the session; the message
+    # is meant to be shown to the user as is.
+    pass
+
+
+def split_ranges(spans, range_size=RANGE_SIZE):
+    ranges = []
+    for start, end in spans:
+        for offset in range(start, end, range_size):
+            ranges.append((offset, min(range_size, end - offset)))
+    return ranges
+
+
+class ProgressReader:
+    # File wrapper that reports every piece read through it, so progress
+    # moves while a file or range is being sent
+
+    def __init__(self, file, report):
+        self.file = file
+        self.report = report
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if data:
+            self.report(len(data))
+        return data
+
+    def readinto(self, buffer):
+        count = self.file.readinto(buffer)
+        if count:
+            self.report(count)
+        return count
+
+
+class ProgressWriter:
+    # Counterpart of ProgressReader for received data, which is reported as
+    # it is written (after decompression)
+
+    def __init__(self, file, report):
+        self.file = file
+        self.report = report
+
+    def write(self, data):
+        count = self.file.write(data)
+        self.report(len(data))
+        return count
+
+
+class ClientCore:
+    # Headless client session: everything ClientApp does on the wire, usable
+    # from scripts and the load generator. Methods block until the server
+    # has answered, raise ClientError for refusals and let socket errors
+    # through. `notify` receives informational messages and `progress`, if
+    # set, the number of bytes of file data moved, piece by piece as they
+    # are sent or received.
+    #
+    # With `multiplex`, and a server that supports it, every request runs as
+    # a stream of its own on the one connection (see request()), so a
+    # session may be used from several threads at once and ranged transfers
+    # need no extra connections. Without it, threads take turns: one
+    # request at a time is sent on the connection.
+    #
+    # With `verify`, uploads and whole downloads end with a checksum the
+    # receiver compares with what it wrote, if the server supports it.
+    # Ranged downloads are checked against /stat once complete, and a /get
+    # whose destination already holds the same content is skipped.
+    #
+    # With `swarm`, and a server started with --swarm, the session serves
+    # the chunks it downloads to other clients, and downloads of more than
+    # one chunk take what they can from them (see swarm.py).
+
+    def __init__(self, codecs=None, notify=None, multiplex=False, verify=True, swarm=False):
+        self.host = None
+        self.port = None
+        self.client_socket = None
+        self.multiplex = multiplex
+        self.mux = None
+        self.is_registered = False
+        self.is_joined = False
+        self.handle = None
+        self.server_deduplicates = None
+        self.codecs = list(compression.CODECS) if codecs is None else codecs
+        self.codec = None
+        self.verify = verify
+        self.checksums = False  # Negotiated at /join
+        self.swarm = swarm
+        self.peer = None  # PeerServer once the server accepted /peer
+        self.token = None
+        self.notify = notify
+        self.progress = None
+        self.cancelled = threading.Event()
+        self.sockets = set()
+        # Held for a request on a connection that is not multiplexed
+        self.lock = threading.RLock()
+
+    def connect(self, host, port):
+        if self.is_joined:
+            raise ClientError("Already joined the server.")
+        sock = self.open_connection(host, port)
+        try:
+            # Offer every codec we know; data is compressed only if the
+            # server picks one of them
+            params = [f"codecs={','.join(self.codecs)}"] if self.codecs else []
+            if self.multiplex:
+                params.append("mux")
+            if self.verify:
+                params.append("checksums")
+            protocol.send_command(sock, " ".join(["/join", *params]))
+            ok, response = protocol.read_response(sock)
+        except Exception:
+            sock.close()
+            raise
+        self.client_socket = sock
+        self.codec = compression.announced_codec(response) if ok else None
+        self.checksums = ok and protocol.announced_checksums(response)
+        if ok and announced_mux(response):
+            self.mux = Multiplexer(sock)
+            self.mux.start()
+        self.is_joined = True
+        self.server_deduplicates = None
+        self.host = host
+        self.port = port
+
+    def open_connection(self, host, port):
+        sock = socket.create_connection((host, port))
+        # A request is several small frames; none of them may wait for the
+        # ACK of the previous one
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def disconnect(self):
+        if not self.is_joined:
+            raise ClientError("Error: You have not joined the server yet.")
+        try:
+            with self.request() as sock:
+                protocol.send_command(sock, "/leave")
+                # Waiting for the reply frees the handle before a new session
+                protocol.read_response(sock)
+        finally:
+            if self.mux:
+                self.mux.close()
+                self.mux = None
+            if self.peer:
+                self.peer.close()
+                self.peer = None
+            self.client_socket.close()
+            self.client_socket = None
+            self.is_joined = False
+            self.is_registered = False
+            self.handle = None
+            self.codec = None
+            self.checksums = False
+            self.token = None
+
+    def register(self, handle):
+        if not self.is_joined:
+            raise ClientError("Error: Please join the server before registering.")
+        if self.is_registered:
+            raise ClientError("Error: Already registered.")
+        with self.request() as sock:
+            protocol.send_command(sock, f"/register {handle}")
+            ok, response = protocol.read_response(sock)
+        if not ok:
+            raise ClientError(response)
+        self.is_registered = True
+        self.handle = handle
+        if self.swarm:
+            self.join_swarm()
+        return response
+
+    def join_swarm(self):
+        # Serves the chunks of this session's downloads to other peers, on
+        # the interface the server is reached through
+        peer = PeerServer(self.client_socket.getsockname()[0])
+        with self.request() as sock:
+            protocol.send_command(sock, f"/peer {peer.port}")
+            ok, response = protocol.read_response(sock)
+        if ok:
+            self.peer = peer
+            return
+        peer.close()
+        if self.notify:
+            self.notify(f"{response} Files are fetched from the server only.")
+
+    def session_token(self):
+        # Token that lets further connections attach to this session; safe
+        # to call from any thread
+        if self.token is None:
+            with self.request() as sock:
+                protocol.send_command(sock, "/token")
+                ok, token = protocol.read_response(sock)
+            if not ok:
+                raise ClientError(token)
+            self.token = token
+        return self.token
+
+    def open_attached(self):
+        # Returns (socket, codec) of a new connection attached to this
+        # session. Uses the cached token, see session_token().
+        sock = self.open_connection(self.host, self.port)
+        try:
+            params = [self.token]
+            if self.codec:
+                params.append(f"codecs={self.codec.name}")
+            if self.checksums:
+                params.append("checksums")
+            protocol.send_command(sock, " ".join(["/attach", *params]))
+            ok, response = protocol.read_response(sock)
+        except Exception:
+            sock.close()
+            raise
+        if not ok:
+            sock.close()
+            raise ClientError(response)
+        return sock, compression.announced_codec(response)
+
+    @contextlib.contextmanager
+    def request(self):
+        # Yields what one request is sent on and read from: a new stream on
+        # a multiplexed connection, otherwise the connection itself. A stream
+        # left by an exception is reset so the server stops working on it.
+        if self.mux is None:
+            with self.lock:
+                yield self.client_socket
+            return
+        stream = self.mux.open()
+        self.sockets.add(stream)
+        try:
+            yield stream
+        except BaseException:
+            stream.reset()
+            raise
+        else:
+            stream.close()
+        finally:
+            self.sockets.discard(stream)
+
+    def attach(self):
+        # A session of its own, sharing this one's user; used to run
+        # transfers next to this session. It is a new connection unless this
+        # one is multiplexed, in which case it shares it.
+        self.session_token()
+        core = ClientCore(self.codecs, self.notify, self.multiplex, self.verify, self.swarm)
+        core.checksums = self.checksums
+        core.peer = self.peer
+        if self.mux is not None:
+            core.mux = self.mux
+            core.codec = self.codec
+        else:
+            core.client_socket, core.codec = self.open_attached()
+        core.token = self.token
+        core.host = self.host
+        core.port = self.port
+        core.handle = self.handle
+        core.server_deduplicates = self.server_deduplicates
+        core.is_joined = True
+        core.is_registered = True
+        return core
+
+    def store(self, filename, connections=1):
+        if not self.is_joined:
+            raise ClientError("Error: Please join the server before sending files.")
+        if not os.path.exists(filename):
+            raise ClientError("Error: File not found.")
+
+        size = os.path.getsize(filename)
+        if (size >= BLOB_CHUNK_SIZE and self.server_deduplicates is not False
+                and self.store_deduplicated(filename, size, connections)):
+            return
+        if size and (connections > 1 or size > RANGE_SIZE):
+            self.store_in_ranges(filename, size, connections)
+            return
+        with open(filename, 'rb') as file, self.request() as sock:
+            protocol.send_command(sock, f"/store {os.path.basename(filename)}")
+            self.send_data(sock, file, size, filename)
+            ok, response = protocol.read_response(sock)
+        if not ok:
+            raise ClientError(response)
+
+    def store_in_ranges(self, filename, size, connections):
+        name = os.path.basename(filename)
+        info = self.stat(name)
+        partial = info.get('partial') if info else None
+        if partial and partial['total'] == size:
+            missing = missing_ranges(partial['ranges'], size)
+        else:
+            missing = [(0, size)]
+
+        def upload_range(sock, offset, length):
+            with open(filename, 'rb') as file:
+                file.seek(offset)
+                protocol.send_command(sock, f"/store {name} {offset} {size}")
+                self.send_data(sock, file, length, filename)
+            ok, response = protocol.read_response(sock)
+            if not ok:
+                raise ConnectionError(response)
+
+        self.transfer_ranges(split_ranges(missing), connections, upload_range)
+
+    def store_deduplicated(self, filename, size, connections):
+        # Hashes the file locally, asks the server which chunks it lacks and
+        # uploads only those before linking the name to the full chunk list.
+        # Returns False when the server does not deduplicate.
+        name = os.path.basename(filename)
+        with open(filename, 'rb') as file:
+            chunks = list(iter_chunks(file))
+
+        digests = list(dict.fromkeys(digest for digest, _, _ in chunks))
+        missing = set()
+        for start in range(0, len(digests), CHUNK_QUERY_SIZE):
+            batch = digests[start:start + CHUNK_QUERY_SIZE]
+            with self.request() as sock:
+                protocol.send_command(sock, " ".join(["/chunks", *batch]))
+                ok, response = protocol.read_response(sock)
+            if not ok:
+                # Server without deduplication, fall back to plain uploads
+                self.server_deduplicates = False
+                return False
+            missing.update(response.split())
+        self.server_deduplicates = True
+
+        pending = {}
+        for digest, offset, length in chunks:
+            if digest in missing and digest not in pending:
+                pending[digest] = (offset, length)
+        offsets = {offset: digest for digest, (offset, _) in pending.items()}
+
+        def upload_chunk(sock, offset, length):
+            with open(filename, 'rb') as file:
+                file.seek(offset)
+                protocol.send_command(sock, f"/chunk {offsets[offset]}")
+                self.send_data(sock, file, length, filename)
+            ok, response = protocol.read_response(sock)
+            if not ok:
+                raise ConnectionError(response)
+
+        self.transfer_ranges(list(pending.values()), connections, upload_chunk)
+
+        manifest = json.dumps({'size': size, 'chunks': [[digest, length] for digest, _, length in chunks]}).encode()
+        with self.request() as sock:
+            protocol.send_command(sock, f"/manifest {name}")
+            protocol.send_stream(sock, io.BytesIO(manifest), len(manifest))
+            ok, response = protocol.read_response(sock)
+        if not ok:
+            raise ConnectionError(response)
+        skipped = len(chunks) - len(pending)
+        if skipped and self.notify:
+            self.notify(f"{skipped} of {len(chunks)} chunks were already on the server.")
+        return True
+
+    def send_data(self, sock, file, size, filename):
+        # Compressed on the fly when a codec was negotiated and the file
+        # type is worth it, and hashed on the way out when checksums were
+        compressed = self.codec is not None and compression.is_compressible(filename, size, file)
+        file = self.with_progress(file, ProgressReader)
+        if self.checksums:
+            file = HashingReader(file)
+        if compressed:
+            protocol.send_compressed(sock, file, size, self.codec, end=not self.checksums)
+        else:
+            protocol.send_stream(sock, file, size, end=not self.checksums)
+        if self.checksums:
+            protocol.send_checksum(sock, file.hexdigest())
+
+    def get(self, filename, connections=1, destination=None):
+        # Saves the file as `destination` (default: its name in the current
+        # directory) and returns the number of bytes received
+        if not self.is_joined:
+            raise ClientError("Error: Please join the server before requesting files.")
+        destination = destination or filename
+
+        info = self.stat(filename)
+        size = info.get('size') if info else None
+        checksum = info.get('checksum') if info else None
+        if self.verify and checksum and self.has_copy(destination, size, checksum):
+            if self.notify:
+                self.notify(f"{destination} is already up to date.")
+            return 0
+        if self.peer is not None and size is None:
+            # What the server answers a /get of a file it does not have
+            raise ClientError(f"Error: File '{filename}' not found.")
+        if self.peer is not None and size > CHUNK_SIZE:
+            self.get_from_swarm(filename, size, connections, destination)
+            return size
+        if size and (connections > 1 or size > RANGE_SIZE) and not self.gets_encoded(info, connections):
+            self.get_in_ranges(filename, size, connections, destination)
+            if self.verify and checksum:
+                # Ranges arrive out of order, so the result is hashed at the end
+                self.check_copy(destination, checksum)
+            return size
+
+        try:
+            with self.request() as sock:
+                protocol.send_command(sock, f"/get {filename}")
+                frame = protocol.recv_frame_header(sock)
+                if frame is None:
+                    raise ConnectionError("Server closed the connection.")
+                if frame.opcode == protocol.OP_ERROR:
+                    raise ClientError(protocol.recv_exact(sock, frame.length).decode())
+                with open(destination, 'wb') as file:
+                    file = self.with_progress(file, ProgressWriter)
+                    file = HashingWriter(file) if self.checksums else file
+                    received = protocol.recv_stream(sock, file, first=frame, codec=self.codec,
+                                                    digest=file if self.checksums else None)
+        except protocol.ChecksumError as e:
+            os.remove(destination)
+            raise ClientError(f"Error: {filename}: {str(e)}")
+        return received
+
+    def gets_encoded(self, info, connections):
+        # A file the server keeps compressed with our codec is sent as
+        # stored by a whole /get, while every range of it would be
+        # decompressed on the server from the start of the file
+        return connections == 1 and self.codec is not None and info.get('codec') == self.codec.name
+
+    def has_copy(self, destination, size, checksum):
+        if not os.path.isfile(destination) or os.path.getsize(destination) != size:
+            return False
+        with open(destination, 'rb') as file:
+            return stream_checksum(file) == checksum
+
+    def check_copy(self, destination, checksum):
+        with open(destination, 'rb') as file:
+            if stream_checksum(file) == checksum:
+                return
+        os.remove(destination)
+        raise ClientError(f"Error: {destination}: Checksum mismatch, the data was damaged in transit.")
+
+    def get_in_ranges(self, filename, size, connections, destination):
+        # Received ranges are tracked in <destination>.part/.ranges so that
+        # an interrupted download continues where it stopped.
+        partial = PartialFile(os.path.abspath(destination), size)
+
+        def download_range(sock, offset, length):
+            protocol.send_command(sock, f"/get {filename} {offset} {length}")
+            frame = protocol.recv_frame_header(sock)
+            if frame is None:
+                raise ConnectionError("Server closed the connection.")
+            if frame.opcode == protocol.OP_ERROR:
+                raise ConnectionError(protocol.recv_exact(sock, frame.length).decode())
+            with partial.open(offset) as file:
+                received = protocol.recv_stream(sock, self.with_progress(file, ProgressWriter), first=frame,
+                                                codec=self.codec)
+            partial.record(offset, received)
+
+        self.transfer_ranges(split_ranges(partial.missing()), connections, download_range)
+
+    def get_from_swarm(self, filename, size, connections, destination):
+        # Asks the server for chunk maps until every chunk has arrived, from
+        # the peers the map names or else from the server, and checked
+        # against its hash. Written chunks are served to other peers at
+        # once and reported to the server with the next map.
+        partial = PartialFile(os.path.abspath(destination), size)
+        paths = (partial.data_path, partial.final_path)
+        checksum = hashes = None
+        have = []
+        from_peers = []
+
+        def fetch_chunk(sock, offset, length):
+            index = offset // CHUNK_SIZE
+            data = self.peer.read(hashes[index])
+            for address in sources[index] if data is None else ():
+                data = fetch_piece(address, hashes[index], length)
+                if data is not None:
+                    from_peers.append(length)
+                    break
+            if data is None:
+                data = self.download_chunk(sock, filename, offset, length, hashes[index])
+            else:
+                self.report_progress(length)
+            with partial.open(offset) as file:
+                file.write(data)
+            partial.record(offset, length)
+            self.peer.add(hashes[index], paths, offset, length)
+            have.append(index)
+
+        while True:
+            params = [f"checksum={checksum}"] if checksum else []
+            if have:
+                params.append(f"have={','.join(map(str, have))}")
+            chunk_map = self.chunk_map(filename, params)
+            have = []
+            if partial.published:
+                # That map only reported the last chunks
+                break
+            if 'hashes' in chunk_map:
+                if hashes is not None or chunk_map['size'] != size:
+                    raise ClientError(f"Error: {filename} changed on the server during the download.")
+                checksum, hashes = chunk_map['checksum'], chunk_map['hashes']
+                partial, have = self.resume_chunks(partial, hashes)
+                paths = (partial.data_path, partial.final_path)
+            missing = missing_chunks(partial.missing())
+            sources = {index: addresses for index, addresses in chunk_map['chunks'] if index in missing}
+            if not chunk_map['pending']:
+                # The server counts the others as ours, e.g. from a download
+                # to another destination: copied from there or fetched again
+                sources.update((index, []) for index in missing if index not in sources)
+            if not sources:
+                if not have:
+                    time.sleep(POLL_INTERVAL)
+                continue
+            self.transfer_ranges([chunk_span(index, size) for index in sources], connections, fetch_chunk)
+
+        if self.notify:
+            self.notify(f"{filename}: {sum(from_peers)} of {size} bytes came from peers.")
+
+    def resume_chunks(self, partial, hashes):
+        # Returns the PartialFile to continue with and the chunks it already
+        # holds, which are served from now on. A download of another version
+        # of the file is started over.
+        held = sorted(set(range(chunk_count(partial.total))) - missing_chunks(partial.missing()))
+        if not all(is_chunk_intact(partial.data_path, index, partial.total, hashes[index]) for index in held):
+            for path in (partial.data_path, partial.state_path):
+                os.remove(path)
+            return PartialFile(partial.final_path, partial.total), []
+        for index in held:
+            self.peer.add(hashes[index], (partial.data_path, partial.final_path), *chunk_span(index, partial.total))
+        return partial, held
+
+    def download_chunk(self, sock, filename, offset, length, digest):
+        protocol.send_command(sock, f"/get {filename} {offset} {length}")
+        frame = protocol.recv_frame_header(sock)
+        if frame is None:
+            raise ConnectionError("Server closed the connection.")
+        if frame.opcode == protocol.OP_ERROR:
+            raise ConnectionError(protocol.recv_exact(sock, frame.length).decode())
+        buffer = BoundedBuffer(length)
+        protocol.recv_stream(sock, self.with_progress(buffer, ProgressWriter), first=frame, codec=self.codec)
+        if hashlib.new(CHECKSUM_ALGORITHM, buffer.data).hexdigest() != digest:
+            raise ClientError(f"Error: {filename}: Checksum mismatch, the data was damaged in transit.")
+        return bytes(buffer.data)
+
+    def chunk_map(self, filename, params):
+        with self.request() as sock:
+            protocol.send_command(sock, " ".join(["/get", filename, "swarm", *params]))
+            ok, response = protocol.read_response(sock)
+        if not ok:
+            raise ClientError(response)
+        return json.loads(response)
+
+    def stat(self, filename):
+        # Returns the /stat record, or None if the server knows no such file
+        with self.request() as sock:
+            protocol.send_command(sock, f"/stat {filename}")
+            ok, response = protocol.read_response(sock)
+        return json.loads(response) if ok else None
+
+    def transfer_ranges(self, ranges, connections, transfer_range):
+        # Runs transfer_range(sock, offset, length) for every range over
+        # `connections` extra sockets attached to this session, or as that
+        # many concurrent streams when the connection is multiplexed.
+        if not ranges:
+            return
+
+        if self.mux is None:
+            self.session_token()
+        pending = queue.Queue()
+        for item in ranges:
+            pending.put(item)
+        errors = []
+
+        def ranges_left():
+            while not errors and not self.cancelled.is_set():
+                try:
+                    yield pending.get_nowait()
+                except queue.Empty:
+                    return
+
+        def worker():
+            sock = None
+            try:
+                if self.mux is not None:
+                    for offset, length in ranges_left():
+                        with self.request() as stream:
+                            transfer_range(stream, offset, length)
+                    return
+                sock, _ = self.open_attached()
+                self.sockets.add(sock)
+                with sock:
+                    for offset, length in ranges_left():
+                        transfer_range(sock, offset, length)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self.sockets.discard(sock)
+
+        workers = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(max(1, min(connections, len(ranges))))]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if errors:
+            raise errors[0]
+        if self.cancelled.is_set():
+            raise ClientError("Transfer cancelled.")
+
+    def report_progress(self, count):
+        if self.progress:
+            self.progress(count)
+
+    def with_progress(self, file, wrapper):
+        # `file` wrapped in ProgressReader or ProgressWriter when progress
+        # is reported. Left alone otherwise, so sends keep their zero-copy
+        # path.
+        return wrapper(file, self.report_progress) if self.progress else file
+
+    def cancel(self):
+        # Aborts a transfer running on another thread by shutting its
+        # connections down (or resetting its streams). Ranges that already
+        # arrived are kept, so the transfer can be resumed later.
+        self.cancelled.set()
+        for sock in [self.client_socket, *list(self.sockets)]:
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def list_directory(self, options=()):
+        # Yields the /dir header ({total, offset, count}) and then each batch
+        # of entries as a list of dicts, as they arrive
+        if not self.is_registered:
+            raise ClientError("Error: Please join the server before requesting the directory list.")
+        with self.request() as sock:
+            protocol.send_command(sock, " ".join(["/dir", *options]))
+            frame = protocol.recv_frame_header(sock)
+            if frame is None:
+                raise ConnectionError("Server closed the connection.")
+            if frame.opcode == protocol.OP_ERROR:
+                raise ClientError(protocol.recv_exact(sock, frame.length).decode())
+
+            chunks = protocol.recv_chunks(sock, first=frame)
+            yield json.loads(next(chunks))
+            for chunk in chunks:
+                if chunk:
+                    yield [json.loads(line) for line in chunk.decode().split("\n")]
+
+    def stats(self):
+        with self.request() as sock:
+            protocol.send_command(sock, "/stats")
+            ok, response = protocol.read_response(sock)
+        if not ok:
+            raise ClientError(response)
+        return json.loads(response)
+
+    def close(self):
+        # Drops the connection without /leave, e.g. after a failed transfer.
+        # A session sharing another one's multiplexed connection only lets
+        # go of it.
+        if self.client_socket:
+            if self.mux:
+                self.mux.close()
+            self.client_socket.close()
+        self.client_socket = None
+        self.mux = None
+        self.is_joined = False
+        self.is_registered = False
+        self.codec = None
+        self.checksums = False
+        # Closed by the session that started it, in disconnect()
+        self.peer = None
+        self.token = None
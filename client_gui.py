@@ -0,0 +1,493 @@
+import glob
+import itertools
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from client_core import ClientCore, ClientError
+import ttkbootstrap as ttk
+from tkinter import scrolledtext, NORMAL, DISABLED, END
+
+# Transfers run at the same time unless changed with /transfers <n>
+MAX_TRANSFERS = 3
+
+# Minimum number of seconds between two progress updates of a transfer
+PROGRESS_INTERVAL = 0.5
+
+# How often the GUI picks up events from the transfer threads
+POLL_INTERVAL_MS = 100
+
+
+class Transfer:
+    def __init__(self, number, kind, filename, connections, total=None):
+        self.number = number
+        self.kind = kind  # 'store' or 'get'
+        self.filename = filename
+        self.connections = connections
+        self.total = total
+        self.state = 'queued'
+        self.moved = 0
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.core = None
+        self.cancel_requested = False
+        self.lock = threading.Lock()
+        self.last_report = 0
+
+    def advance(self, count):
+        # Called from transfer threads. Returns True when it is time to show
+        # the progress again.
+        with self.lock:
+            self.moved += count
+            now = time.monotonic()
+            if now - self.last_report < PROGRESS_INTERVAL:
+                return False
+            self.last_report = now
+            return True
+
+    def throughput(self):
+        if not self.started:
+            return 0
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return self.moved / elapsed / 1024 ** 2 if elapsed > 0 else 0
+
+    def describe(self):
+        text = f"#{self.number} /{self.kind} {self.filename} {self.state}"
+        if self.state == 'running' and self.total:
+            text += f" {min(100, 100 * self.moved // self.total)}%"
+        if self.started:
+            text += f" {self.moved / 1024 ** 2:.1f} MB at {self.throughput():.1f} MB/s"
+        return text
+
+
+class TransferManager:
+    # Runs /store and /get on worker threads so a large transfer never
+    # blocks the Tk main loop. Every transfer gets a session of its own,
+    # attached to the main one: streams of the main connection when it is
+    # multiplexed, connections of their own otherwise. Worker threads never
+    # touch Tk: they post events to a queue that the GUI drains with after().
+
+    def __init__(self, core, limit=MAX_TRANSFERS):
+        self.core = core
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.events = queue.Queue()
+        self.transfers = {}
+        self.numbers = itertools.count(1)
+        self.workers = 0
+
+    def submit(self, kind, filename, connections=1):
+        # Runs on the GUI thread; the transfer attaches to the main session
+        # from its worker, as that is a round trip to the server
+        total = os.path.getsize(filename) if kind == 'store' and os.path.isfile(filename) else None
+        transfer = Transfer(next(self.numbers), kind, filename, connections, total)
+        self.transfers[transfer.number] = transfer
+        self.pending.put(transfer)
+        self.set_limit(self.limit)
+        return transfer
+
+    def set_limit(self, limit):
+        # Extra workers start right away; surplus ones stop once their
+        # current transfer is done
+        with self.lock:
+            self.limit = limit
+            while self.workers < min(self.limit, self.pending.qsize()):
+                self.workers += 1
+                threading.Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        while True:
+            with self.lock:
+                if self.workers > self.limit or self.pending.empty():
+                    self.workers -= 1
+                    return
+                transfer = self.pending.get_nowait()
+            if transfer.state == 'queued':
+                self.run(transfer)
+
+    def run(self, transfer):
+        transfer.state = 'running'
+        transfer.started = time.monotonic()
+        self.events.put(('progress', transfer))
+        core = None
+        try:
+            core = self.core.attach()
+            core.notify = lambda message: self.events.put(('message', message))
+            core.progress = lambda count: transfer.advance(count) and self.events.put(('progress', transfer))
+            transfer.core = core
+            if transfer.cancel_requested:
+                core.cancel()
+            if transfer.kind == 'store':
+                core.store(transfer.filename, transfer.connections)
+            else:
+                transfer.total = core.get(transfer.filename, transfer.connections)
+            transfer.state = 'done'
+        except Exception as e:
+            transfer.state = 'cancelled' if transfer.cancel_requested else 'failed'
+            transfer.error = e
+        finally:
+            if core:
+                core.close()
+            transfer.finished = time.monotonic()
+            self.events.put(('finished', transfer))
+
+    def cancel(self, number=None):
+        # Cancels one transfer, or all unfinished ones when number is None.
+        # Returns the transfers that were cancelled.
+        if number is None:
+            selected = list(self.transfers.values())
+        else:
+            selected = [self.transfers[number]] if number in self.transfers else []
+        cancelled = []
+        for transfer in selected:
+            if transfer.state == 'queued':
+                transfer.state = 'cancelled'
+                transfer.cancel_requested = True
+                cancelled.append(transfer)
+            elif transfer.state == 'running':
+                transfer.cancel_requested = True
+                if transfer.core:
+                    transfer.core.cancel()
+                cancelled.append(transfer)
+        return cancelled
+
+    def active(self):
+        return [t for t in self.transfers.values() if t.state in ('queued', 'running')]
+
+    def forget_finished(self):
+        for number in [n for n, t in self.transfers.items() if t.state not in ('queued', 'running')]:
+            del self.transfers[number]
+
+
+class ClientApp:
+    DEFAULT_HOST = '0.0.0.0'
+    DEFAULT_PORT = 0
+
+    def __init__(self):
+        self.host = self.DEFAULT_HOST
+        self.port = self.DEFAULT_PORT
+        # Background transfers and the window's own commands share one
+        # multiplexed connection when the server offers it
+        self.core = ClientCore(notify=self.update_output, multiplex=True)
+        self.transfers = TransferManager(self.core)
+        self.setup_gui()
+    
+    def setup_gui(self):
+        # Set up the main application window
+        self.app = ttk.Window(themename="superhero")
+        self.style = ttk.Style()
+        self.set_default_font()
+        
+        self.app.title("File Exchange Client")
+        self.app.geometry("800x650")
+
+        # Main Frame
+        self.main_frame = ttk.Frame(self.app)
+        self.main_frame.pack(fill='both', expand=True, padx=10, pady=10)
+        self.main_frame.grid_rowconfigure(0, weight=1)
+        self.main_frame.grid_columnconfigure(0, weight=1)
+
+        # Connection Info Frame
+        self.conn_info_frame = ttk.LabelFrame(self.main_frame, text='Connection Information', padding=10)
+        self.conn_info_frame.grid(row=0, column=0, padx=10, pady=10, sticky='nsew')
+        self.create_labels()
+        
+        # Input Frame
+        self.input_frame = ttk.Frame(self.main_frame)
+        self.input_frame.grid(row=1, column=0, padx=10, pady=10, sticky='nsew')
+
+        # Log Frame
+        self.log_frame = ttk.LabelFrame(self.main_frame, text='Client Log', padding=10)
+        self.log_frame.grid(row=2, column=0, padx=10, pady=10, sticky='nsew')
+
+        # Command Entry and Button
+        self.command_label = ttk.Label(self.input_frame, text="Command:")
+        self.command_label.pack(side='left', padx=5)
+
+        self.command_entry = ttk.Entry(self.input_frame, width=50)
+        self.command_entry.pack(side='left', padx=5)
+
+        self.send_button = ttk.Button(self.input_frame, text="Send", command=self.execute_command)
+        self.send_button.pack(side='left', padx=5)
+
+        # ScrolledText for Logs
+        self.output_area = scrolledtext.ScrolledText(self.log_frame, state=DISABLED, width=80, height=15)
+        self.output_area.pack(expand=True, fill='both')
+
+        # Background transfers
+        self.transfer_label = ttk.Label(self.main_frame, text="No transfers running.", anchor='w', justify='left')
+        self.transfer_label.grid(row=3, column=0, padx=10, pady=5, sticky='ew')
+        self.app.after(POLL_INTERVAL_MS, self.poll_transfers)
+
+        # Run the application
+        self.app.mainloop()
+
+    def set_default_font(self, font_name='Helvetica', font_size=10, font_weight='bold'):
+        # Create a font configuration
+        default_font = (font_name, font_size, font_weight)
+        
+        # Configure styles for various widgets
+        self.style.configure('TLabel', font=default_font)
+        self.style.configure('TButton', font=default_font)
+        self.style.configure('TEntry', font=default_font)
+        self.style.configure('TFrame', font=default_font)
+        self.style.configure('TCheckbutton', font=default_font)
+        self.style.configure('TRadiobutton', font=default_font)
+
+    def create_labels(self):
+        ttk.Label(self.conn_info_frame, text='Address', anchor='center', width=25).grid(row=1, column=1, ipadx=10, ipady=5)
+        ttk.Label(self.conn_info_frame, text='Port Number', anchor='center', width=25).grid(row=2, column=1, ipadx=10, ipady=5)
+        ttk.Label(self.conn_info_frame, text='Status', anchor="center", width=25).grid(row=3, column=1, ipadx=10, ipady=5)
+        ttk.Label(self.conn_info_frame, text='User Handle', anchor='center', width=25).grid(row=4, column=1, ipadx=10, ipady=5)
+
+        self.address_label = ttk.Label(self.conn_info_frame, text="0", bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
+        self.address_label.grid(row=1, column=2, ipadx=10, ipady=5)
+        
+        self.port_label = ttk.Label(self.conn_info_frame, text="0", bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
+        self.port_label.grid(row=2, column=2, ipadx=10, ipady=5)
+        
+        self.status_label = ttk.Label(self.conn_info_frame, text="Unjoined", bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
+        self.status_label.grid(row=3, column=2, ipadx=10, ipady=5)
+        
+        self.user_handle_label = ttk.Label(self.conn_info_frame, text="", bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
+        self.user_handle_label.grid(row=4, column=2, ipadx=10, ipady=5)
+
+    def connect_to_server(self, ip, port):
+        try:
+            self.core.connect(ip, port)
+        except ClientError as e:
+            self.update_output(str(e))
+            return
+        except Exception as e:
+            self.update_output(f"Error: Connection to the Server has failed! Please check IP Address and Port Number. {str(e)}")
+            return
+        self.update_output("Connection to the File Exchange Server is successful!")
+        self.update_status("Joined")
+        self.host = ip
+        self.port = port
+        self.update_labels()
+
+    def disconnect_from_server(self):
+        for transfer in self.transfers.cancel():
+            self.update_output(f"Cancelling transfer #{transfer.number}.")
+        try:
+            self.core.disconnect()
+        except ClientError as e:
+            self.update_output(str(e))
+            return
+        except Exception as e:
+            self.update_output(f"Error: Disconnection failed. {str(e)}")
+            return
+        self.update_output("Connection closed. Thank you!")
+        self.update_status("Unjoined")
+        self.user_handle_label.config(text="")
+        self.update_labels()
+
+    def register_handle(self, handle):
+        try:
+            response = self.core.register(handle)
+        except ClientError as e:
+            self.update_output(str(e))
+            return
+        self.update_status("Registered")
+        self.user_handle_label.config(text=handle)
+        self.update_output(response)
+
+    def send_file_to_server(self, pattern, connections=1):
+        # Queues an upload for every local file matching the pattern
+        if not self.core.is_joined:
+            self.update_output("Error: Please join the server before sending files.")
+            return
+        filenames = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        filenames = [filename for filename in filenames if os.path.isfile(filename)]
+        if not filenames:
+            self.update_output("Error: File not found.")
+            return
+        self.queue_transfers('store', filenames, connections)
+
+    def fetch_file_from_server(self, pattern, connections=1):
+        # Queues a download for every server file matching the pattern
+        if not self.core.is_joined:
+            self.update_output("Error: Please join the server before requesting files.")
+            return
+        filenames = [pattern]
+        if glob.has_magic(pattern):
+            try:
+                listing = self.core.list_directory([f"glob={pattern}"])
+                next(listing)
+                filenames = [entry['name'] for batch in listing for entry in batch]
+            except ClientError as e:
+                self.update_output(str(e))
+                return
+            except Exception as e:
+                self.update_output(f"Error: Failed to fetch file. {str(e)}")
+                return
+            if not filenames:
+                self.update_output(f"Error: No files on the server match '{pattern}'.")
+                return
+        self.queue_transfers('get', filenames, connections)
+
+    def queue_transfers(self, kind, filenames, connections):
+        for filename in filenames:
+            try:
+                transfer = self.transfers.submit(kind, filename, connections)
+            except ClientError as e:
+                self.update_output(str(e))
+                return
+            except Exception as e:
+                self.update_output(f"Error: Failed to start transfer. {str(e)}")
+                return
+            self.update_output(f"Queued transfer #{transfer.number}: /{kind} {filename}")
+        self.show_transfers()
+
+    def poll_transfers(self):
+        # Applies whatever the transfer threads posted since the last call
+        changed = False
+        try:
+            while True:
+                kind, item = self.transfers.events.get_nowait()
+                if kind == 'message':
+                    self.update_output(item)
+                elif kind == 'finished':
+                    self.transfer_finished(item)
+                changed = True
+        except queue.Empty:
+            pass
+        if changed:
+            self.show_transfers()
+        self.app.after(POLL_INTERVAL_MS, self.poll_transfers)
+
+    def transfer_finished(self, transfer):
+        if transfer.state == 'done' and transfer.kind == 'store':
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.update_output(f"User<{timestamp}>: Uploaded {transfer.filename}")
+        elif transfer.state == 'done':
+            self.update_output(f"File received from Server: {transfer.filename}")
+        elif transfer.state == 'cancelled':
+            self.update_output(f"Transfer #{transfer.number} of {transfer.filename} cancelled. Run the command again to resume.")
+        elif isinstance(transfer.error, ClientError):
+            self.update_output(str(transfer.error))
+        else:
+            action = "send" if transfer.kind == 'store' else "fetch"
+            self.update_output(f"Error: Failed to {action} file. {str(transfer.error)} Run the command again to resume.")
+
+    def show_transfers(self):
+        active = self.transfers.active()
+        if not active:
+            self.transfer_label.config(text="No transfers running.")
+            return
+        self.transfer_label.config(text="\n".join(transfer.describe() for transfer in active[:5]))
+
+    def list_transfers(self):
+        if not self.transfers.transfers:
+            self.update_output("No transfers.")
+            return
+        self.update_output(f"Transfers (up to {self.transfers.limit} at a time):")
+        self.update_output("\n".join(t.describe() for t in self.transfers.transfers.values()))
+        self.transfers.forget_finished()
+
+    def cancel_transfers(self, target):
+        number = None if target == 'all' else int(target)
+        cancelled = self.transfers.cancel(number)
+        if not cancelled:
+            self.update_output("Error: No such transfer is queued or running.")
+        for transfer in cancelled:
+            self.update_output(f"Cancelling transfer #{transfer.number}.")
+        self.show_transfers()
+
+    def request_directory_list(self, options=()):
+        try:
+            # The listing arrives in batches; show each one as it comes in
+            listing = self.core.list_directory(options)
+            header = next(listing)
+            if not header['total']:
+                self.update_output("Directory is empty.")
+            else:
+                self.update_output(f"Files in server ({header['count']} of {header['total']}):")
+            for batch in listing:
+                self.update_output("\n".join(self.format_entry(entry) for entry in batch))
+        except ClientError as e:
+            self.update_output(str(e))
+        except Exception as e:
+            self.update_output(f"Error: Failed to retrieve directory list. {str(e)}")
+
+    def format_entry(self, entry):
+        modified = datetime.fromtimestamp(entry['mtime']).strftime("%Y-%m-%d %H:%M:%S")
+        return f"{entry['name']}  {entry['size']} bytes  {modified}"
+
+    def update_output(self, message):
+        self.output_area.config(state=NORMAL)
+        self.output_area.insert(END, message + "\n")
+        self.output_area.config(state=DISABLED)
+
+    def update_status(self, status):
+        self.status_label.config(text=status)
+
+    def update_labels(self):
+        self.address_label.config(text=self.host)
+        self.port_label.config(text=str(self.port))
+        if self.core.is_joined:
+            self.status_label.config(text="Joined")
+        else:
+            self.status_label.config(text="Unjoined")
+
+    def execute_command(self):
+        command = self.command_entry.get()
+        tokens = command.split()
+
+        if not tokens:
+            self.update_output("Error: Command not found.")
+            return
+
+        cmd = tokens[0]
+        if cmd == '/join' and len(tokens) == 3:
+            self.connect_to_server(tokens[1], int(tokens[2]))
+            
+        elif cmd == '/leave':
+            self.disconnect_from_server()
+        elif cmd == '/register' and len(tokens) == 2:
+            self.register_handle(tokens[1])
+        elif cmd == '/store' and len(tokens) in (2, 3):
+            self.send_file_to_server(tokens[1], self.parse_connections(tokens))
+        elif cmd == '/dir':
+            self.request_directory_list(tokens[1:])
+        elif cmd == '/get' and len(tokens) in (2, 3):
+            self.fetch_file_from_server(tokens[1], self.parse_connections(tokens))
+        elif cmd == '/transfers' and len(tokens) == 1:
+            self.list_transfers()
+        elif cmd == '/transfers' and len(tokens) == 2 and tokens[1].isdigit() and int(tokens[1]) > 0:
+            self.transfers.set_limit(int(tokens[1]))
+            self.update_output(f"Running up to {tokens[1]} transfers at a time.")
+        elif cmd == '/cancel' and len(tokens) == 2 and (tokens[1] == 'all' or tokens[1].isdigit()):
+            self.cancel_transfers(tokens[1])
+        elif cmd == '/?':
+            self.display_help()
+        else:
+            self.update_output("Error: Command not found or incorrect parameters.")
+
+    def parse_connections(self, tokens):
+        # Optional trailing number of parallel connections for /store and /get
+        if len(tokens) == 3 and tokens[2].isdigit() and int(tokens[2]) > 0:
+            return int(tokens[2])
+        return 1
+
+    def display_help(self):
+        help_message = (
+            "Available Commands:\n"
+            "/join <server_ip_add> <port>\n"
+            "/leave\n"
+            "/register <handle>\n"
+            "/store <filename|pattern> [connections]\n"
+            "/dir [prefix=<text>] [glob=<pattern>] [sort=name|size|mtime] [desc] [offset=<n>] [limit=<n>]\n"
+            "/get <filename|pattern> [connections]\n"
+            "/transfers [max_parallel]\n"
+            "/cancel <transfer_number>|all\n"
+            "/?\n"
+        )
+        self.update_output(help_message)
+
+if __name__ == "__main__":
+    ClientApp()
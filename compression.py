@@ -0,0 +1,235 @@
+import os
+import zlib
+
+# Streaming compression for transfers and for files kept at rest.
+#
+# A codec has a name, a compressor() returning an object with
+# compress(data) and flush() (the zlib/bz2/lzma compressobj interface) and a
+# decompressor() returning a decoder with feed(data) and finish(), both
+# yielding decompressed pieces of bounded size. Extra codecs are added with
+# register_codec(); zlib is always available.
+
+OUTPUT_CHUNK = 256 * 1024
+
+# Formats that are already compressed gain nothing from another pass
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.7z', '.avi', '.br', '.bz2', '.docx', '.flac', '.gif', '.gz', '.jar', '.jpeg', '.jpg', '.lz4',
+    '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp',
+    '.xlsx', '.xz', '.zip', '.zst',
+}
+
+# Files smaller than this are not worth the extra frames
+MIN_COMPRESS_SIZE = 1024
+
+# Data of unknown type is only compressed if a sample of this size shrinks
+# to at most SAMPLE_RATIO of its size
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_RATIO = 0.9
+
+
+class ZlibDecoder:
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+
+    def feed(self, data, max_output=OUTPUT_CHUNK):
+        # max_output keeps a small, highly compressed input from expanding
+        # into one huge buffer
+        while data:
+            piece = self.decompressor.decompress(data, max_output)
+            if piece:
+                yield piece
+            data = self.decompressor.unconsumed_tail
+
+    def finish(self):
+        piece = self.decompressor.flush()
+        if piece:
+            yield piece
+        if not self.decompressor.eof:
+            raise ValueError("Compressed stream is truncated.")
+
+
+class ZlibCodec:
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compressor(self):
+        return zlib.compressobj(self.level)
+
+    def decompressor(self):
+        return ZlibDecoder()
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown codec '{name}'.")
+
+
+def negotiate(offered):
+    # Picks the first codec in the client's order of preference that this
+    # side knows, or None to transfer uncompressed
+    for name in offered:
+        if name in CODECS:
+            return name
+    return None
+
+
+def offered_codecs(params):
+    # "codecs=zlib,..." as sent with /join and /attach, most preferred first
+    for param in params:
+        key, _, value = param.partition('=')
+        if key == 'codecs':
+            return [name for name in value.split(',') if name]
+    return []
+
+
+def announced_codec(message):
+    # Reads back the codec the server appended to its /join or /attach reply
+    key, _, name = message.rpartition(' ')[2].partition('=')
+    if key == 'codec' and name in CODECS:
+        return CODECS[name]
+    return None
+
+
+def is_compressible(filename, size=None, file=None):
+    # With `file` given, a sample at its current position is test-compressed
+    # as well, which catches random or encrypted data under any name
+    if size is not None and size < MIN_COMPRESS_SIZE:
+        return False
+    if os.path.splitext(filename)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    if file is None:
+        return True
+    position = file.tell()
+    sample = file.read(SAMPLE_SIZE if size is None else min(SAMPLE_SIZE, size))
+    file.seek(position)
+    return len(zlib.compress(sample, 1)) <= len(sample) * SAMPLE_RATIO
+
+
+class CompressingWriter:
+    # Compresses everything written through it into `file`
+
+    def __init__(self, file, codec):
+        self.file = file
+        self.compressor = codec.compressor()
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.file.write(compressed)
+        return len(data)
+
+    def close(self):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DecompressingWriter:
+    # Decompresses whatever is written through it into `file`. Returns the
+    # number of decompressed bytes from finish().
+
+    def __init__(self, file, codec):
+        self.file = file
+        self.decoder = codec.decompressor()
+        self.size = 0
+
+    def write(self, data):
+        for piece in self.decoder.feed(bytes(data)):
+            self.file.write(piece)
+            self.size += len(piece)
+        return len(data)
+
+    def finish(self):
+        for piece in self.decoder.finish():
+            self.file.write(piece)
+            self.size += len(piece)
+        return self.size
+
+
+class DecompressingReader:
+    # Read-only file object over a compressed file. Seeking forward
+    # decompresses and drops the skipped bytes, so ranged reads of a file
+    # compressed at rest cost time proportional to the offset.
+
+    def __init__(self, file, codec, size):
+        self.file = file
+        self.codec = codec
+        self.size = size
+        self.restart()
+
+    def restart(self):
+        self.file.seek(0)
+        self.decoder = self.codec.decompressor()
+        self.buffer = bytearray()
+        self.position = 0
+        self.finished = False
+
+    def fill(self, size):
+        while len(self.buffer) < size and not self.finished:
+            data = self.file.read(OUTPUT_CHUNK)
+            if data:
+                pieces = self.decoder.feed(data)
+            else:
+                pieces = self.decoder.finish()
+                self.finished = True
+            for piece in pieces:
+                self.buffer += piece
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        self.fill(size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position += self.size
+        if position < self.position:
+            self.restart()
+        while self.position < position:
+            if not self.read(min(OUTPUT_CHUNK, position - self.position)):
+                break
+        return self.position
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+register_codec(ZlibCodec())
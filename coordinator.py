@@ -0,0 +1,356 @@
+import itertools
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+from multiprocessing.connection import wait
+from sessions import SessionRegistry
+from storage import ProcessLock
+
+# Multi-process mode (server.py --workers N). The engine is built once in
+# the parent, which indexes files_directory and collects unreferenced
+# chunks, and then forks N workers that each run the full connection loop.
+# With SO_REUSEPORT every worker listens on the port itself and the kernel
+# spreads connections over them; without it they accept on one listening
+# socket created before the fork.
+#
+# Workers share nothing but the disk. The parent stays behind as the
+# coordinator that keeps them consistent, over two pipes per worker:
+#
+#   requests  session registry calls (/join, /register, /token, /attach,
+#             /leave), so handles are unique and a token issued by one
+#             worker attaches connections landing on another; swarm tracker
+#             calls (/peer, /get <file> swarm), so peers on every worker
+#             find each other; and "publish" from a worker that published
+#             an upload. Each call waits for its answer; the asyncio engine
+#             makes them on its executor.
+#   events    ("file", id, name, checksum) to every other worker, which
+#             reloads that entry of its index and answers ("reloaded", id),
+#             and ("users", count, handles) for their users gauge. "publish"
+#             returns once all of them reloaded, so an upload is only
+#             confirmed when a /dir on any worker lists it.
+#
+# Ranges of one partial upload can reach different workers; they exclude
+# each other with a ProcessLock on the partial directory. The bandwidth
+# limits are split between the workers, see worker_limits().
+
+SESSION_METHODS = ('join', 'reserve', 'release', 'issue_token', 'resolve_token', 'handles', '__len__')
+SWARM_METHODS = ('add_peer', 'remove_peer', 'is_peer', 'add_chunks', 'chunk_map', 'stats')
+
+# Seconds a publishing worker waits for the others to reload the file
+RELOAD_TIMEOUT = 5
+
+# Seconds workers get to finish after Ctrl-C before they are terminated
+SHUTDOWN_TIMEOUT = 5
+
+
+class Coordinator:
+    # Runs in the parent process: one thread per worker answers its requests
+
+    def __init__(self, sessions=None, swarm=None):
+        self.sessions = sessions or SessionRegistry()
+        self.swarm = swarm
+        self.requests = []
+        self.events = []
+        self.event_locks = []
+        self.worker_ends = []
+        self.running = set()  # workers whose event pipe is still open
+        self.reloads = {}     # event id -> workers yet to reload the file
+        self.reloaded = threading.Condition()
+        self.event_ids = itertools.count()
+
+    def add_worker(self):
+        requests, worker_requests = multiprocessing.Pipe()
+        events, worker_events = multiprocessing.Pipe()
+        self.requests.append(requests)
+        self.events.append(events)
+        self.event_locks.append(threading.Lock())
+        self.worker_ends.append((worker_requests, worker_events))
+        self.running.add(len(self.worker_ends) - 1)
+
+    def client(self, number):
+        # Called in worker `number` after the fork. Every other pipe end is
+        # closed, so that the parent sees EOF once a worker is gone.
+        for connection in self.requests + self.events:
+            connection.close()
+        for other, ends in enumerate(self.worker_ends):
+            if other != number:
+                for connection in ends:
+                    connection.close()
+        return CoordinatorClient(number, *self.worker_ends[number])
+
+    def forked(self):
+        # Called in the parent once every worker runs
+        for ends in self.worker_ends:
+            for connection in ends:
+                connection.close()
+
+    def start(self):
+        self.sessions.subscribe(self.users_changed)
+        for number, connection in enumerate(self.requests):
+            threading.Thread(target=self.serve, args=(number, connection), daemon=True).start()
+        for number, connection in enumerate(self.events):
+            threading.Thread(target=self.relay, args=(number, connection), daemon=True).start()
+
+    def serve(self, number, connection):
+        while True:
+            try:
+                method, args = connection.recv()
+            except (EOFError, OSError):
+                return
+            if method in SESSION_METHODS:
+                result = getattr(self.sessions, method)(*args)
+            elif method in SWARM_METHODS and self.swarm is not None:
+                result = getattr(self.swarm, method)(*args)
+            elif method == 'publish':
+                result = self.publish(number, *args)
+            else:
+                result = None
+            try:
+                connection.send(result)
+            except OSError:
+                return
+
+    def relay(self, number, connection):
+        # Collects the reload confirmations of one worker
+        while True:
+            try:
+                event = connection.recv()
+            except (EOFError, OSError):
+                break
+            if event[0] == 'reloaded':
+                self.confirm(number, event[1])
+        # A worker that is gone has nothing left to reload
+        with self.reloaded:
+            self.running.discard(number)
+            for waiting in self.reloads.values():
+                waiting.discard(number)
+            self.reloaded.notify_all()
+
+    def publish(self, number, name, checksum):
+        # Worker `number` published the file: every other worker reloads it
+        # before the upload is confirmed
+        event_id = next(self.event_ids)
+        with self.reloaded:
+            waiting = self.reloads[event_id] = self.running - {number}
+        self.broadcast(('file', event_id, name, checksum), skip=number)
+        with self.reloaded:
+            self.reloaded.wait_for(lambda: not waiting, RELOAD_TIMEOUT)
+            del self.reloads[event_id]
+
+    def confirm(self, number, event_id):
+        with self.reloaded:
+            waiting = self.reloads.get(event_id)
+            if waiting is not None:
+                waiting.discard(number)
+                if not waiting:
+                    self.reloaded.notify_all()
+
+    def broadcast(self, event, skip=None):
+        for number, connection in enumerate(self.events):
+            if number == skip:
+                continue
+            with self.event_locks[number]:
+                try:
+                    connection.send(event)
+                except OSError:
+                    pass
+
+    def users_changed(self, count, handles):
+        self.broadcast(('users', count, handles))
+
+
+class CoordinatorClient:
+    # A worker's side of the coordinator. It stands in for the engine's
+    # SessionRegistry, keying sessions by worker number and connection.
+    blocks = True
+
+    def __init__(self, number, requests, events):
+        self.number = number
+        self.requests = requests
+        self.events = events
+        self.lock = threading.Lock()
+        self.listeners = []
+
+    def call(self, method, *args):
+        with self.lock:
+            self.requests.send((method, args))
+            return self.requests.recv()
+
+    def key(self, session):
+        return f"{self.number}:{id(session)}"
+
+    def __len__(self):
+        return self.call('__len__')
+
+    def join(self, session):
+        self.call('join', self.key(session))
+
+    def reserve(self, session, handle):
+        return self.call('reserve', self.key(session), handle)
+
+    def release(self, session):
+        self.call('release', self.key(session))
+
+    def issue_token(self, handle):
+        return self.call('issue_token', handle)
+
+    def resolve_token(self, token):
+        return self.call('resolve_token', token)
+
+    def handles(self):
+        return self.call('handles')
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def file_updated(self, name, checksum):
+        # Called while an upload is published, before it is confirmed;
+        # waits until the other workers list the file
+        self.call('publish', name, checksum)
+
+    def listen(self, store):
+        threading.Thread(target=self.run, args=(store,), daemon=True).start()
+
+    def run(self, store):
+        while True:
+            try:
+                event = self.events.recv()
+            except (EOFError, OSError):
+                # The coordinator is gone, shut this worker down too
+                os.kill(os.getpid(), signal.SIGINT)
+                return
+            if event[0] == 'file':
+                store.reload(*event[2:])
+                try:
+                    self.events.send(('reloaded', event[1]))
+                except OSError:
+                    return
+            elif event[0] == 'users':
+                for listener in self.listeners:
+                    listener(*event[1:])
+
+
+class CoordinatorSwarm:
+    # A worker's stand-in for the SwarmTracker, which lives in the
+    # coordinator
+    blocks = True
+
+    def __init__(self, client):
+        self.client = client
+
+    def add_peer(self, handle, address):
+        self.client.call('add_peer', handle, address)
+
+    def remove_peer(self, handle):
+        self.client.call('remove_peer', handle)
+
+    def is_peer(self, handle):
+        return self.client.call('is_peer', handle)
+
+    def add_chunks(self, handle, checksum, indices, count):
+        self.client.call('add_chunks', handle, checksum, indices, count)
+
+    def chunk_map(self, handle, checksum, count):
+        return self.client.call('chunk_map', handle, checksum, count)
+
+    def stats(self):
+        return self.client.call('stats')
+
+
+def worker_path(path, number):
+    # logs/server.log -> logs/server-w1.log
+    root, extension = os.path.splitext(path)
+    return f"{root}-w{number}{extension}"
+
+
+def worker_limits(settings, number, count):
+    # The server's --rate-limit and --max-large-transfers split between
+    # `count` workers, so that together they move no more than one process
+    # would. A worker's transfers only get its share, even while the others
+    # are idle. Every worker admits at least one large transfer, as 0 would
+    # mean no cap; --handle-rate-limit stays per worker.
+    rate = settings['rate'] and max(1, settings['rate'] // count)
+    max_large = settings['max_large']
+    if max_large:
+        max_large = max(1, max_large // count + (number < max_large % count))
+    return {'rate': rate, 'max_large': max_large}
+
+
+def run_worker(engine, coordinator, number):
+    client = coordinator.client(number)
+    engine.sessions = client
+    if engine.swarm:
+        engine.swarm = CoordinatorSwarm(client)
+    engine.scheduler.configure(**worker_limits(engine.scheduler.settings(), number,
+                                               len(coordinator.worker_ends)))
+    client.subscribe(engine.update_users_text)
+    engine.store.subscribe(client.file_updated)
+    client.listen(engine.store)
+    if engine.events.file:
+        engine.events.reopen(worker_path(engine.events.file.path, number))
+    if engine.metrics_port is not None:
+        engine.metrics_port += number
+    if engine.profile:
+        engine.profile = worker_path(engine.profile, number)
+    try:
+        engine.run()
+    finally:
+        # A forked process does not run atexit handlers
+        engine.events.stop()
+        if engine.profile:
+            engine.write_profile()
+
+
+def serve_workers(engine, count):
+    # Forks `count` workers running `engine` and coordinates them until
+    # they exit. Only available where processes can fork.
+    context = multiprocessing.get_context('fork')
+    if hasattr(socket, 'SO_REUSEPORT'):
+        # Resolve port 0 once, so that all workers share the same port
+        engine.reuse_port = True
+        engine.bind()
+        engine.server_socket.close()
+        engine.server_socket = None
+    else:
+        engine.bind()
+    engine.store.partial_lock = ProcessLock(engine.store.partial_directory)
+
+    coordinator = Coordinator(engine.sessions, engine.swarm)
+    for number in range(count):
+        coordinator.add_worker()
+    workers = []
+    for number in range(count):
+        worker = context.Process(target=run_worker, args=(engine, coordinator, number),
+                                 name=f"worker-{number}", daemon=True)
+        worker.start()
+        workers.append(worker)
+    coordinator.forked()
+    coordinator.start()
+    if engine.server_socket is not None:
+        engine.server_socket.close()
+    print(f"Serving {engine.host}:{engine.port} from {count} worker processes", flush=True)
+
+    # SIGTERM stops the workers like Ctrl-C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        # One worker dying takes the server down rather than leaving its
+        # share of the port unserved
+        wait([worker.sentinel for worker in workers])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGINT)
+        for worker in workers:
+            worker.join(SHUTDOWN_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+    failed = [worker.name for worker in workers if worker.exitcode not in (0, -signal.SIGINT)]
+    if failed:
+        print(f"Error: {', '.join(failed)} exited unexpectedly.", file=sys.stderr)
+        return 1
+    return 0
@@ -0,0 +1,212 @@
+import ctypes
+import os
+import threading
+import time
+
+# How uploads are made to survive a crash before they are acknowledged.
+# Whatever the mode, files are written under a temporary name and renamed
+# into place once complete, so readers never see partial content; the mode
+# only decides when the data and the rename reach the disk.
+#
+#   none       leave it to the OS (fastest, a crash may lose recent uploads)
+#   fdatasync  sync every file before its rename and the directory after it
+#   group      the files and directories of concurrent uploads are synced
+#              in batches by one committer thread. Where syncfs(2) exists
+#              (Linux), a batch of several paths costs one syncfs of their
+#              filesystem however many uploads it holds; elsewhere each of
+#              its distinct paths is synced once, so a path several uploads
+#              wait for (ranges of one file, the directory they are renamed
+#              in) still costs one sync per batch instead of one per upload
+DURABILITY_MODES = ('none', 'fdatasync', 'group')
+
+# A batch closes this many seconds after its first request, or as soon as
+# it holds GROUP_COMMIT_SIZE paths
+GROUP_COMMIT_DELAY = 0.005
+GROUP_COMMIT_SIZE = 64
+
+
+def sync_file(path):
+    # The data of a file already written and closed
+    fd = os.open(path, os.O_RDONLY if os.name == 'posix' else os.O_RDWR)
+    try:
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def load_syncfs():
+    # os has no wrapper for syncfs(2), which only Linux provides
+    try:
+        return ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError, TypeError):
+        return None
+
+
+SYNCFS = load_syncfs()
+
+
+def sync_filesystem(path):
+    # Flushes the data and metadata of the whole filesystem holding path
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if SYNCFS(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+    finally:
+        os.close(fd)
+
+
+def sync_directory(path):
+    # Makes renames and new names in the directory durable. Only possible
+    # on POSIX systems; elsewhere the rename is durable with the file.
+    if os.name != 'posix':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Durability:
+    # Mode "none". Stores call sync() with the files they are about to
+    # rename into place and/or the directories they renamed files in, and
+    # it returns once those are on disk. It may block, which `blocks`
+    # tells event loop callers. `syncs` counts the sync calls made to the OS.
+    mode = 'none'
+    blocks = False
+    syncs = 0
+
+    def sync(self, files=(), directories=()):
+        pass
+
+
+class DataSync(Durability):
+    mode = 'fdatasync'
+    blocks = True
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def sync(self, files=(), directories=()):
+        directories = set(directories)
+        for path in files:
+            sync_file(path)
+        for path in directories:
+            sync_directory(path)
+        with self.lock:
+            self.syncs += len(files) + len(directories)
+
+
+class GroupCommit(Durability):
+    # Callers add their paths to the open batch and wait until it has been
+    # synced. One committer thread closes a batch after `delay` seconds or
+    # `size` paths, whichever comes first, and syncs it while the next batch
+    # gathers: with one syncfs per filesystem when `syncfs` is available and
+    # the batch holds more than one path, otherwise by fdatasyncing its
+    # files and fsyncing its directories. Each caller gets the error of its
+    # own paths.
+    mode = 'group'
+    blocks = True
+
+    def __init__(self, delay=GROUP_COMMIT_DELAY, size=GROUP_COMMIT_SIZE, syncfs=SYNCFS is not None):
+        self.delay = delay
+        self.size = size
+        self.syncfs = syncfs
+        self.condition = threading.Condition()
+        self.next = 1       # number of the batch gathering paths
+        self.opened = 0.0   # when its first request came in
+        self.requested = 0  # highest batch number someone waits for
+        self.done = 0       # number of the last batch synced
+        self.errors = {}    # batch number -> {path: OSError}, for its waiters
+        self.paths = set()
+        self.directories = set()
+        self.thread = None
+        self.syncs = 0
+
+    def sync(self, files=(), directories=()):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if self.requested < self.next:
+                self.opened = time.monotonic()
+            self.paths.update(files)
+            self.directories.update(directories)
+            target = self.requested = self.next
+            self.condition.notify_all()
+            while self.done < target:
+                self.condition.wait()
+            errors = self.errors.get(target, {})
+            error = next((errors[path] for path in [*files, *directories] if path in errors), None)
+        if error is not None:
+            raise error
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.requested < self.next:
+                    self.condition.wait()
+                # Let concurrent uploads join the batch until it is full
+                while len(self.paths) + len(self.directories) < self.size:
+                    remaining = self.opened + self.delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                number = self.next
+                self.next += 1
+                paths, self.paths = self.paths, set()
+                directories, self.directories = self.directories, set()
+            if self.syncfs and len(paths) + len(directories) > 1:
+                syncs, errors = self.sync_filesystems(paths | directories)
+            else:
+                syncs, errors = self.sync_paths(paths, directories)
+            with self.condition:
+                self.syncs += syncs
+                self.done = number
+                if errors:
+                    self.errors[number] = errors
+                # Waiters of older batches have long picked their errors up
+                self.errors.pop(number - 1000, None)
+                self.condition.notify_all()
+
+
+    def sync_paths(self, paths, directories):
+        errors = {}
+        for path in paths:
+            try:
+                sync_file(path)
+            except OSError as e:
+                errors[path] = e
+        for path in directories:
+            try:
+                sync_directory(path)
+            except OSError as e:
+                errors[path] = e
+        return len(paths) + len(directories), errors
+
+    def sync_filesystems(self, paths):
+        # One syncfs for all the paths on a filesystem; its error goes to
+        # each of them
+        errors = {}
+        devices = {}
+        for path in paths:
+            try:
+                devices.setdefault(os.stat(path).st_dev, []).append(path)
+            except OSError as e:
+                errors[path] = e
+        for device_paths in devices.values():
+            try:
+                sync_filesystem(device_paths[0])
+            except OSError as e:
+                errors.update(dict.fromkeys(device_paths, e))
+        return len(devices), errors
+
+
+def make_durability(mode):
+    if mode not in DURABILITY_MODES:
+        raise ValueError(f"Unknown durability mode '{mode}'.")
+    return {'none': Durability, 'fdatasync': DataSync, 'group': GroupCommit}[mode]()
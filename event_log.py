@@ -0,0 +1,164 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', ERROR: 'error'}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+# Seconds between two drains of the event queue
+FLUSH_INTERVAL = 0.2
+
+# Events waiting for the consumer beyond this are dropped, oldest first
+MAX_PENDING = 65536
+
+# Lines the GUI keeps in its log widget
+DISPLAY_LINES = 1000
+
+MAX_LOG_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+
+
+class RotatingFile:
+    # Append-only log file that is renamed to <path>.1 (and older copies
+    # shifted up to <path>.<backups>) once it grows past max_bytes
+
+    def __init__(self, path, max_bytes=MAX_LOG_BYTES, backups=LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, text):
+        position = self.file.tell()
+        if position and position + len(text) > self.max_bytes:
+            self.rotate()
+        self.file.write(text)
+        self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{number}"):
+                os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        self.file.close()
+
+
+class EventLog:
+    # Server log pipeline. Any thread may call emit() (or debug/info/error):
+    # it only appends a tuple to a deque, which is thread-safe without a
+    # lock, so logging costs the same however many clients are connected.
+    # A single consumer thread drains the deque every FLUSH_INTERVAL and
+    # writes the batch as JSON lines to a rotated file, as text to stdout
+    # and/or into a bounded buffer the GUI picks up with lines().
+
+    def __init__(self, path=None, level=INFO, echo=True, max_bytes=MAX_LOG_BYTES, backups=LOG_BACKUPS):
+        self.level = level
+        self.echo = echo
+        self.pending = deque(maxlen=MAX_PENDING)
+        self.display = None
+        self.file = RotatingFile(path, max_bytes, backups) if path else None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.flush_lock = threading.Lock()
+
+    def emit(self, level, message, **fields):
+        if level >= self.level:
+            self.pending.append((time.time(), level, message, fields))
+
+    def debug(self, message, **fields):
+        if DEBUG >= self.level:
+            self.pending.append((time.time(), DEBUG, message, fields))
+
+    def info(self, message, **fields):
+        if INFO >= self.level:
+            self.pending.append((time.time(), INFO, message, fields))
+
+    def error(self, message, **fields):
+        if ERROR >= self.level:
+            self.pending.append((time.time(), ERROR, message, fields))
+
+    def reopen(self, path):
+        # Switches to another file, e.g. one per worker process
+        if self.file:
+            max_bytes, backups = self.file.max_bytes, self.file.backups
+            self.file.close()
+            self.file = RotatingFile(path, max_bytes, backups)
+
+    def attach_display(self, lines=DISPLAY_LINES):
+        # Called by a GUI: rendered lines are kept for it instead of printed
+        self.display = deque(maxlen=lines)
+        self.echo = False
+
+    def lines(self):
+        # Rendered lines since the last call, for the GUI thread
+        lines = []
+        if self.display is not None:
+            while self.display:
+                lines.append(self.display.popleft())
+        return lines
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def run(self):
+        while not self.stopped.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def flush(self):
+        with self.flush_lock:
+            batch = []
+            while self.pending:
+                batch.append(self.pending.popleft())
+            if not batch:
+                return
+            if self.file:
+                self.file.write("".join(self.record(event) + "\n" for event in batch))
+            if self.echo or self.display is not None:
+                lines = [self.render(event) for event in batch]
+                if self.display is not None:
+                    self.display.extend(lines)
+                if self.echo:
+                    sys.stdout.write("\n".join(lines) + "\n")
+                    sys.stdout.flush()
+
+    @staticmethod
+    def record(event):
+        timestamp, level, message, fields = event
+        entry = {'time': round(timestamp, 6), 'level': LEVEL_NAMES.get(level, level), 'message': message}
+        entry.update(fields)
+        return json.dumps(entry, default=str)
+
+    @staticmethod
+    def render(event):
+        timestamp, level, message, fields = event
+        text = time.strftime('%H:%M:%S', time.localtime(timestamp)) + " " + message
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
@@ -0,0 +1,240 @@
+import bisect
+import collections
+import sys
+import threading
+import traceback
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Commands get their own label; anything else is counted as "other" so a
+# misbehaving client cannot create unbounded label values
+COMMANDS = ('/register', '/attach', '/token', '/store', '/chunks', '/chunk', '/manifest', '/dir', '/get',
+            '/stat', '/stats', '/join', '/leave', '/peer')
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the quantile (None past the
+        # last bucket or without observations)
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket
+            samples.append((name + '_bucket', labels + (('le', str(bound)),), cumulative))
+        samples.append((name + '_sum', labels, total))
+        samples.append((name + '_count', labels, count))
+        return samples
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'p50': self.quantile(0.50),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class MetricsRegistry:
+    # Named metrics, optionally split by labels, shared by the server engine,
+    # /stats, the HTTP endpoint and the GUI. Metrics are created on first
+    # use; collectors are called at read time for values that live
+    # elsewhere (e.g. the file cache counters).
+
+    def __init__(self, prefix='fx_'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.help = {}
+        self.kinds = {}
+        self.collectors = []
+
+    def get(self, metric_class, name, help_text, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = metric_class()
+                    self.help.setdefault(name, help_text)
+                    self.kinds.setdefault(name, metric_class.kind)
+        return metric
+
+    def counter(self, name, help_text='', **labels):
+        return self.get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text='', **labels):
+        return self.get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text='', **labels):
+        return self.get(Histogram, name, help_text, labels)
+
+    def value(self, name, **labels):
+        metric = self.metrics.get((name, tuple(sorted(labels.items()))))
+        return metric.snapshot() if metric else 0
+
+    def add_collector(self, collector):
+        # collector() returns {name: value} of gauges computed on demand
+        self.collectors.append(collector)
+
+    def observe_command(self, command, seconds):
+        command = command if command in COMMANDS else 'other'
+        self.counter('commands_total', "Commands handled", command=command).inc()
+        self.histogram('command_seconds', "Time spent handling a command", command=command).observe(seconds)
+
+    def snapshot(self):
+        # Nested dict for /stats: name -> value, or name -> {label: value}
+        result = {}
+        with self.lock:
+            items = sorted(self.metrics.items())
+        for (name, labels), metric in items:
+            if labels:
+                label = ",".join(str(value) for _, value in labels)
+                result.setdefault(name, {})[label] = metric.snapshot()
+            else:
+                result[name] = metric.snapshot()
+        for collector in self.collectors:
+            result.update(collector())
+        return result
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        by_name = collections.defaultdict(list)
+        with self.lock:
+            items = sorted(self.metrics.items())
+        for (name, labels), metric in items:
+            by_name[name].append((labels, metric))
+        for name, metrics in by_name.items():
+            full_name = self.prefix + name
+            lines.append(f"# HELP {full_name} {self.help[name]}")
+            lines.append(f"# TYPE {full_name} {self.kinds[name]}")
+            for labels, metric in metrics:
+                for sample_name, sample_labels, value in metric.samples(full_name, labels):
+                    lines.append(self.format_sample(sample_name, sample_labels, value))
+        for collector in self.collectors:
+            for name, value in collector().items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE {self.prefix}{name} gauge")
+                    lines.append(self.format_sample(self.prefix + name, (), value))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def format_sample(name, labels, value):
+        if labels:
+            text = ",".join(f'{key}="{value}"' for key, value in labels)
+            return f"{name}{{{text}}} {value}"
+        return f"{name} {value}"
+
+
+class SamplingProfiler:
+    # Samples the stacks of all threads every `interval` seconds while
+    # running and counts identical stacks. dump() returns the hottest ones in
+    # the folded "frame;frame;frame count" format flame graph tools read.
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.stacks.clear()
+                self.samples = 0
+                self.stopped.clear()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread:
+            self.stopped.set()
+            thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = ";".join(f"{entry.name} ({entry.filename.rsplit('/', 1)[-1]}:{entry.lineno})"
+                                 for entry in traceback.extract_stack(frame))
+                with self.lock:
+                    self.stacks[stack] += 1
+            with self.lock:
+                self.samples += 1
+
+    def dump(self, limit=50):
+        with self.lock:
+            hottest = self.stacks.most_common(limit)
+            samples = self.samples
+        lines = [f"# {samples} samples every {self.interval * 1000:g} ms, running={self.running}"]
+        lines.extend(f"{stack} {count}" for stack, count in hottest)
+        return "\n".join(lines) + "\n"
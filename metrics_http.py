@@ -0,0 +1,77 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# HTTP endpoint of the metrics registry, the profiler and the transfer
+# limits (--metrics-port). Kept out of metrics.py so that http.server is
+# only imported by servers that serve it.
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # GET /metrics                 Prometheus text format
+    # GET /profile/start|stop      toggles the sampling profiler
+    # GET /profile                 hottest stacks so far
+    # GET /limits[?rate=<bytes/s>&handle_rate=<bytes/s>&max_large=<n>&large_transfer=<bytes>&weight=<handle>:<w>]
+    #                              shows, and with parameters changes, the
+    #                              transfer limits (see scheduler.py)
+
+    def do_GET(self):
+        registry, profiler = self.server.registry, self.server.profiler
+        if urlsplit(self.path).path == '/limits' and self.server.scheduler:
+            self.limits()
+        elif self.path == '/metrics':
+            self.reply(registry.render(), 'text/plain; version=0.0.4')
+        elif self.path == '/profile/start':
+            profiler.start()
+            self.reply("profiler started\n")
+        elif self.path == '/profile/stop':
+            profiler.stop()
+            self.reply(profiler.dump())
+        elif self.path == '/profile':
+            self.reply(profiler.dump())
+        else:
+            self.send_error(404)
+
+    def limits(self):
+        changes = {}
+        try:
+            for name, values in parse_qs(urlsplit(self.path).query).items():
+                if name == 'weight':
+                    weights = changes.setdefault('weights', {})
+                    for value in values:
+                        handle, _, weight = value.rpartition(':')
+                        if not handle:
+                            raise ValueError("A weight is given as <handle>:<weight>.")
+                        weights[handle] = float(weight)
+                elif name in ('rate', 'handle_rate', 'max_large', 'large_transfer'):
+                    changes[name] = int(values[-1])
+                else:
+                    raise ValueError(f"Unknown limit '{name}'.")
+            settings = self.server.scheduler.configure(**changes)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.reply(json.dumps(settings) + "\n", 'application/json')
+
+    def reply(self, text, content_type='text/plain'):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(registry, profiler, host='127.0.0.1', port=9100, scheduler=None):
+    # Starts the HTTP endpoint on a daemon thread and returns the server
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    server.profiler = profiler
+    server.scheduler = scheduler
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
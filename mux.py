@@ -0,0 +1,404 @@
+import itertools
+import os
+import socket
+import struct
+import threading
+from collections import deque
+import protocol
+
+# Multiplexed sessions: once the client offers "mux" at /join and the server
+# announces it in its reply, every request on the connection runs as a
+# stream of its own, identified by the request id in the frame header.
+# Frames of different streams interleave freely, so a /dir is answered
+# while a /get is still streaming and many small requests share one
+# connection without waiting for each other.
+#
+#   OP_COMMAND with a new id   opens a stream (client to server only)
+#   OP_WINDOW                  grants the peer more data bytes on a stream
+#   OP_RESET                   aborts a stream, e.g. a cancelled transfer
+#
+# Data frames are flow controlled per stream: a sender may have at most
+# STREAM_WINDOW payload bytes in flight that the receiving side has not
+# consumed yet, so one slow consumer never stalls the other streams.
+#
+# A Stream looks like a socket to the protocol helpers (sendall, sendfile,
+# recv, recv_into), so commands are handled by the same code in both modes.
+# Frames written to it are re-tagged with its request id; data frames larger
+# than MAX_CONTROL_PAYLOAD are cut into FRAME_SIZE pieces so that streams
+# take turns on the wire. Smaller frames are kept whole because their
+# payloads can carry meaning of their own (e.g. /dir batches).
+
+FRAME_SIZE = 256 * 1024
+STREAM_WINDOW = 2 * protocol.MAX_CONTROL_PAYLOAD
+
+# Streams of a connection that may wait for one of its threads, see
+# StreamPool; each may have STREAM_WINDOW bytes buffered meanwhile
+STREAM_BACKLOG = 64
+
+# Seconds an idle StreamPool thread waits for the next request
+IDLE_TIMEOUT = 5
+
+WINDOW = struct.Struct('!Q')
+
+
+def offered_mux(params):
+    return 'mux' in params
+
+
+def announced_mux(message):
+    # "mux" is announced in the /join reply, ahead of any codec
+    return 'mux' in message.split()
+
+
+class Stream:
+    def __init__(self, mux, request_id):
+        self.mux = mux
+        self.request_id = request_id
+        self.condition = threading.Condition()
+        self.inbound = deque()     # (bytes of a frame header or payload, data size)
+        self.current = memoryview(b'')
+        self.buffered = 0          # data bytes received but not consumed
+        self.unacked = 0           # consumed data bytes not granted back yet
+        self.credit = STREAM_WINDOW
+        self.closed = None         # None, 'closed' or 'reset'
+        self.header = bytearray()  # header of the frame being written
+        self.frame = None          # [opcode, flags, remaining]
+        self.split = False         # the frame is cut into FRAME_SIZE pieces
+        self.payload = bytearray()
+
+    # Receiving side, fed by the multiplexer's reader thread
+
+    def deliver(self, frame, payload):
+        size = len(payload) if frame.opcode == protocol.OP_DATA else 0
+        with self.condition:
+            if self.buffered + size > STREAM_WINDOW:
+                raise protocol.ProtocolError(f"Stream {self.request_id} exceeded its window.")
+            self.buffered += size
+            self.inbound.append((protocol.pack_header(frame.opcode, len(payload), 0, frame.flags), 0))
+            if payload:
+                self.inbound.append((payload, size))
+            self.condition.notify_all()
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer)
+        nbytes = nbytes or len(view)
+        grant = 0
+        with self.condition:
+            while not self.current and not self.inbound and self.closed is None:
+                self.condition.wait()
+            if not self.current:
+                if not self.inbound:
+                    if self.closed == 'reset':
+                        raise ConnectionResetError("Stream reset by peer.")
+                    return 0
+                data, size = self.inbound.popleft()
+                self.current = memoryview(data)
+                self.buffered -= size
+                self.unacked += size
+                # Credit is returned in batches, or as soon as everything
+                # received so far is consumed
+                if self.unacked >= STREAM_WINDOW // 4 or (self.unacked and not self.inbound):
+                    grant, self.unacked = self.unacked, 0
+            count = min(nbytes, len(self.current))
+            view[:count] = self.current[:count]
+            self.current = self.current[count:]
+        if grant and self.closed is None:
+            self.mux.send_frame(protocol.OP_WINDOW, WINDOW.pack(grant), self.request_id)
+        return count
+
+    def recv(self, size):
+        buffer = bytearray(size)
+        count = self.recv_into(buffer, size)
+        return bytes(buffer[:count])
+
+    def grant(self, count):
+        with self.condition:
+            self.credit += count
+            self.condition.notify_all()
+
+    def take_credit(self, count):
+        # Blocks until `count` data bytes may be sent
+        with self.condition:
+            while self.credit < count and self.closed is None:
+                self.condition.wait()
+            self.check_open()
+            self.credit -= count
+
+    def check_open(self):
+        if self.closed == 'reset':
+            raise ConnectionResetError("Stream reset by peer.")
+        if self.closed:
+            raise ConnectionError("Stream closed.")
+
+    # Sending side: frames written by the protocol helpers are parsed back
+    # and re-sent on the multiplexed connection
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            if self.frame is None:
+                count = min(protocol.HEADER_SIZE - len(self.header), len(view))
+                self.header += view[:count]
+                view = view[count:]
+                if len(self.header) == protocol.HEADER_SIZE:
+                    self.start_frame(protocol.unpack_header(bytes(self.header)))
+                    self.header.clear()
+                continue
+            count = min(self.frame[2], len(view))
+            self.write_payload(view[:count])
+            view = view[count:]
+
+    def sendfile(self, file, offset=0, count=None):
+        # Only used for the body of a data frame, see protocol.send_stream
+        opcode, flags, remaining = self.frame
+        if count > remaining:
+            raise protocol.ProtocolError("sendfile past the end of the frame.")
+        if not self.split:
+            self.write_payload(os.pread(file.fileno(), count, offset))
+            return count
+        sent = 0
+        while sent < count:
+            size = min(FRAME_SIZE, count - sent)
+            self.take_credit(size)
+            self.frame[2] -= size
+            self.mux.send_file_frame(file, offset + sent, size, self.request_id, self.piece_flags())
+            sent += size
+        self.finish_frame()
+        return sent
+
+    def start_frame(self, frame):
+        self.check_open()
+        self.frame = [frame.opcode, frame.flags, frame.length]
+        self.split = frame.opcode == protocol.OP_DATA and frame.length > protocol.MAX_CONTROL_PAYLOAD
+        self.finish_frame()
+
+    def write_payload(self, data):
+        if not self.split:
+            self.payload += data
+            self.frame[2] -= len(data)
+            self.finish_frame()
+            return
+        while data:
+            size = min(FRAME_SIZE, len(data))
+            self.take_credit(size)
+            self.frame[2] -= size
+            self.mux.send_frame(protocol.OP_DATA, bytes(data[:size]), self.request_id, self.piece_flags())
+            data = data[size:]
+        self.finish_frame()
+
+    def piece_flags(self):
+        # Only the last piece of a cut frame keeps FLAG_END
+        opcode, flags, remaining = self.frame
+        return flags if remaining == 0 else flags & ~protocol.FLAG_END
+
+    def finish_frame(self):
+        opcode, flags, remaining = self.frame
+        if remaining:
+            return
+        if not self.split:
+            payload, self.payload = bytes(self.payload), bytearray()
+            if opcode == protocol.OP_DATA:
+                self.take_credit(len(payload))
+            self.mux.send_frame(opcode, payload, self.request_id, flags)
+        self.frame = None
+
+    def close(self):
+        # Done with the request; frames still arriving for it are dropped
+        with self.condition:
+            if self.closed is None:
+                self.closed = 'closed'
+            self.condition.notify_all()
+        self.mux.forget(self)
+
+    def reset(self):
+        # Aborts the request on both sides
+        if self.closed is None:
+            try:
+                self.mux.send_frame(protocol.OP_RESET, b'', self.request_id)
+            except OSError:
+                pass
+        with self.condition:
+            self.closed = 'reset'
+            self.condition.notify_all()
+        self.mux.forget(self)
+
+    def shutdown(self, how=socket.SHUT_RDWR):
+        self.reset()
+
+
+class Multiplexer:
+    # Owns a connection in multiplexed mode. run() reads frames and routes
+    # them to their streams; streams write through send_frame, which keeps
+    # frames of different streams from mixing on the wire. The client opens
+    # streams with open(); on the server every new request id is handed to
+    # on_request(stream), which must not block the reader.
+
+    def __init__(self, sock, on_request=None):
+        self.sock = sock
+        # Headers, window updates and replies are small writes that must not
+        # wait for the peer's delayed ACK
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.on_request = on_request
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.ids = itertools.count(1)
+        self.stopped = False
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def open(self):
+        with self.lock:
+            if self.stopped:
+                raise ConnectionError("Connection closed.")
+            stream = Stream(self, next(self.ids))
+            self.streams[stream.request_id] = stream
+        return stream
+
+    def forget(self, stream):
+        with self.lock:
+            if self.streams.get(stream.request_id) is stream:
+                del self.streams[stream.request_id]
+
+    def send_frame(self, opcode, payload, request_id, flags=0):
+        with self.send_lock:
+            self.sock.sendall(protocol.pack_header(opcode, len(payload), request_id, flags) + payload)
+
+    def send_file_frame(self, file, offset, count, request_id, flags):
+        with self.send_lock:
+            self.sock.sendall(protocol.pack_header(protocol.OP_DATA, count, request_id, flags))
+            # os.sendfile directly: socket.sendfile sets up a selector per call
+            sent = 0
+            while sent < count:
+                done = os.sendfile(self.sock.fileno(), file.fileno(), offset + sent, count - sent)
+                if not done:
+                    # The frame header promised more; the connection is unusable
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                    raise protocol.ProtocolError("File shrank while it was being sent.")
+                sent += done
+
+    def run(self):
+        try:
+            while True:
+                frame = protocol.recv_frame_header(self.sock)
+                if frame is None:
+                    break
+                if frame.length > protocol.MAX_CONTROL_PAYLOAD:
+                    raise protocol.ProtocolError(f"Frame payload of {frame.length} bytes exceeds the limit.")
+                self.route(frame, self.recv_payload(frame.length))
+        except (OSError, protocol.ProtocolError):
+            pass
+        finally:
+            self.stop()
+
+    def recv_payload(self, size):
+        # Read in place; the buffer is handed to the stream without a copy
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = self.sock.recv_into(view[received:], size - received)
+            if not count:
+                raise ConnectionError("Connection closed in the middle of a frame.")
+            received += count
+        return buffer
+
+    def route(self, frame, payload):
+        with self.lock:
+            stream = self.streams.get(frame.request_id)
+            opened = stream is None and frame.opcode == protocol.OP_COMMAND and self.on_request is not None
+            if opened:
+                stream = self.streams[frame.request_id] = Stream(self, frame.request_id)
+        if opened:
+            # Outside the lock: on_request may reset the stream right away
+            stream.deliver(frame, payload)
+            self.on_request(stream)
+            return
+        if stream is None:
+            return
+        if frame.opcode == protocol.OP_WINDOW:
+            stream.grant(WINDOW.unpack(payload)[0])
+        elif frame.opcode == protocol.OP_RESET:
+            with stream.condition:
+                stream.closed = 'reset'
+                stream.condition.notify_all()
+            self.forget(stream)
+        else:
+            stream.deliver(frame, payload)
+
+    def stop(self):
+        # Wakes every stream still waiting; they see a closed connection
+        with self.lock:
+            self.stopped = True
+            streams, self.streams = list(self.streams.values()), {}
+        for stream in streams:
+            with stream.condition:
+                if stream.closed is None:
+                    stream.closed = 'closed'
+                stream.condition.notify_all()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.stop()
+
+
+class StreamPool:
+    # Serves the requests of one multiplexed connection on at most `workers`
+    # threads of its own. A stream holds its thread for the whole request,
+    # including waits for data and window credit, so a client whose streams
+    # stall only stalls itself. Up to `backlog` more streams wait for a
+    # thread; streams beyond that are reset.
+
+    def __init__(self, serve, workers, backlog=STREAM_BACKLOG):
+        self.serve = serve
+        self.workers = workers
+        self.backlog = backlog
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.threads = 0
+        self.idle = 0
+        self.closed = False
+
+    def submit(self, stream):
+        # Called by the multiplexer's reader, so it never blocks
+        full = False
+        with self.condition:
+            if self.idle <= len(self.queue):
+                if self.threads < self.workers:
+                    self.threads += 1
+                    threading.Thread(target=self.run, daemon=True).start()
+                elif len(self.queue) >= self.backlog:
+                    full = True
+            if not full:
+                self.queue.append(stream)
+                self.condition.notify()
+                return
+        stream.reset()
+
+    def run(self):
+        while (stream := self.next_stream()) is not None:
+            self.serve(stream)
+
+    def next_stream(self):
+        # None once the thread has been idle for IDLE_TIMEOUT or the
+        # connection is gone
+        with self.condition:
+            while not self.queue and not self.closed:
+                self.idle += 1
+                notified = self.condition.wait(IDLE_TIMEOUT)
+                self.idle -= 1
+                if not notified:
+                    break
+            if self.queue:
+                return self.queue.popleft()
+            self.threads -= 1
+            return None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
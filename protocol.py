@@ -0,0 +1,475 @@
+import io
+import os
+import struct
+from collections import namedtuple
+from compression import DecompressingWriter
+
+# Wire format shared by the server and the client.
+#
+# Every message is a frame: a fixed 18 byte header followed by exactly
+# `length` payload bytes.
+#
+#   magic (2s) | version (B) | opcode (B) | flags (H) | request id (I) | length (Q)
+#
+# Commands travel as OP_COMMAND frames whose payload is the UTF-8 command
+# line (e.g. "/store report.csv"). File contents travel as OP_DATA frames;
+# the last frame of a transfer carries FLAG_END. Because the reader always
+# knows how many bytes are left, file contents are never scanned for a
+# delimiter and may contain arbitrary bytes.
+#
+# Data frames of a compressed transfer carry FLAG_COMPRESSED. Their payloads
+# are consecutive pieces of one stream in the codec negotiated at /join, so
+# the sender does not need to know the compressed size up front and the
+# receiver can decompress each frame as it arrives.
+#
+# When both sides offered "checksums" at /join (or /attach), a /store and a
+# whole-file /get end with a data frame carrying FLAG_CHECKSUM instead of
+# FLAG_END alone: its payload is the SHA-256 hex digest of the transferred
+# bytes before compression. The sender hashes while it sends (or knows the
+# digest already), the receiver while it writes, and a mismatch fails the
+# transfer before anything is published.
+#
+# OP_WINDOW and OP_RESET only appear on multiplexed connections, see mux.py.
+
+MAGIC = b'FX'
+VERSION = 1
+
+HEADER = struct.Struct('!2sBBHIQ')
+HEADER_SIZE = HEADER.size
+
+OP_COMMAND = 1
+OP_REPLY = 2
+OP_ERROR = 3
+OP_DATA = 4
+OP_WINDOW = 5
+OP_RESET = 6
+
+FLAG_END = 0x0001
+FLAG_COMPRESSED = 0x0002
+FLAG_CHECKSUM = 0x0004
+
+CHUNK_SIZE = 64 * 1024
+SEND_BUFFER_SIZE = 1024 * 1024
+MAX_CONTROL_PAYLOAD = 1024 * 1024
+
+Frame = namedtuple('Frame', ['opcode', 'flags', 'request_id', 'length'])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class ChecksumError(Exception):
+    # The data arrived complete but not intact; the connection is still in
+    # sync, so the receiver can report it in-band
+    pass
+
+
+def offered_checksums(params):
+    return 'checksums' in params
+
+
+def announced_checksums(message):
+    # "checksums" is announced in the /join or /attach reply, ahead of any codec
+    return 'checksums' in message.split()
+
+
+def pack_header(opcode, length, request_id=0, flags=0):
+    return HEADER.pack(MAGIC, VERSION, opcode, flags, request_id, length)
+
+
+def unpack_header(data):
+    magic, version, opcode, flags, request_id, length = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("Bad frame magic.")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}.")
+    return Frame(opcode, flags, request_id, length)
+
+
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if not count:
+            raise ConnectionError("Connection closed in the middle of a frame.")
+        received += count
+    return bytes(buffer)
+
+
+def recv_frame_header(sock):
+    # Returns None on a clean close between frames.
+    first = sock.recv(HEADER_SIZE)
+    if not first:
+        return None
+    if len(first) < HEADER_SIZE:
+        first += recv_exact(sock, HEADER_SIZE - len(first))
+    return unpack_header(first)
+
+
+def recv_frame(sock, max_payload=MAX_CONTROL_PAYLOAD):
+    # Reads a whole control frame (command, reply or error) into memory.
+    frame = recv_frame_header(sock)
+    if frame is None:
+        return None, b''
+    if frame.length > max_payload:
+        raise ProtocolError(f"Frame payload of {frame.length} bytes exceeds the limit.")
+    payload = recv_exact(sock, frame.length) if frame.length else b''
+    return frame, payload
+
+
+def send_frame(sock, opcode, payload=b'', request_id=0, flags=0):
+    sock.sendall(pack_header(opcode, len(payload), request_id, flags) + payload)
+
+
+def send_command(sock, command, request_id=0):
+    send_frame(sock, OP_COMMAND, command.encode(), request_id)
+
+
+def send_reply(sock, message, request_id=0):
+    send_frame(sock, OP_REPLY, message.encode(), request_id)
+
+
+def send_error(sock, message, request_id=0):
+    send_frame(sock, OP_ERROR, message.encode(), request_id)
+
+
+def send_stream(sock, file, size, request_id=0, zero_copy=True, buffer_size=SEND_BUFFER_SIZE, flags=0, end=True):
+    # Sends `size` bytes of `file`, starting at its current position, as a
+    # single data frame marked as the end of the transfer (unless a
+    # checksum follows, see send_checksum). Real files go through
+    # socket.sendfile so the kernel copies them straight out of the page
+    # cache; anything else is copied through one reused buffer.
+    sock.sendall(pack_header(OP_DATA, size, request_id, (FLAG_END if end else 0) | flags))
+    if hasattr(file, 'memory'):
+        # Cached files are sent straight out of their buffer
+        view = file.memory(size)
+        sock.sendall(view)
+        sent = len(view)
+    elif zero_copy and hasattr(file, 'segments'):
+        # Files assembled from several pieces on disk (deduplicated chunks)
+        # are sent one piece at a time
+        sent = 0
+        for part, offset, count in file.segments():
+            sent += sock.sendfile(part, offset, count) if count else 0
+    elif zero_copy and can_sendfile(file):
+        sent = sock.sendfile(file, file.tell(), size) if size else 0
+    else:
+        sent = send_buffered(sock, file, size, buffer_size)
+    if sent != size:
+        raise ProtocolError("File shrank while it was being sent.")
+
+
+def compressed_chunks(file, size, codec, buffer_size=SEND_BUFFER_SIZE):
+    # Yields the compressed form of `size` bytes of `file` piece by piece
+    compressor = codec.compressor()
+    remaining = size
+    while remaining:
+        data = file.read(min(buffer_size, remaining))
+        if not data:
+            raise ProtocolError("File shrank while it was being sent.")
+        remaining -= len(data)
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def send_compressed(sock, file, size, codec, request_id=0, buffer_size=SEND_BUFFER_SIZE, end=True):
+    # Sends `size` bytes of `file` compressed with `codec`, one data frame
+    # per compressed piece. The last piece carries FLAG_END.
+    pending = None
+    for chunk in compressed_chunks(file, size, codec, buffer_size):
+        if pending is not None:
+            send_frame(sock, OP_DATA, pending, request_id, FLAG_COMPRESSED)
+        pending = chunk
+    send_frame(sock, OP_DATA, pending, request_id, FLAG_COMPRESSED | (FLAG_END if end else 0))
+
+
+def send_checksum(sock, checksum, request_id=0):
+    # Ends a transfer sent with end=False
+    send_frame(sock, OP_DATA, checksum.encode(), request_id, FLAG_CHECKSUM | FLAG_END)
+
+
+def check_checksum(digest, payload):
+    # `digest` hashed what the receiver wrote; None skips the check
+    if digest is not None and digest.hexdigest() != payload.decode():
+        raise ChecksumError("Checksum mismatch, the data was damaged in transit.")
+
+
+def can_sendfile(file):
+    if not hasattr(os, 'sendfile'):
+        return False
+    try:
+        file.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+    return True
+
+
+def send_buffered(sock, file, size, buffer_size=SEND_BUFFER_SIZE):
+    buffer = bytearray(min(buffer_size, size) or 1)
+    view = memoryview(buffer)
+    sent = 0
+    while sent < size:
+        count = file.readinto(view[:min(len(buffer), size - sent)])
+        if not count:
+            break
+        sock.sendall(view[:count])
+        sent += count
+    return sent
+
+
+def copy_payload(sock, frame, file, chunk_size=CHUNK_SIZE):
+    # Copies exactly `frame.length` payload bytes into `file` (or drops
+    # them when `file` is None).
+    buffer = bytearray(min(chunk_size, frame.length) or 1)
+    view = memoryview(buffer)
+    remaining = frame.length
+    while remaining:
+        count = sock.recv_into(view, min(len(buffer), remaining))
+        if not count:
+            raise ConnectionError("Connection closed in the middle of a transfer.")
+        if file is not None:
+            file.write(view[:count])
+        remaining -= count
+    return frame.length
+
+
+def decompressing_writer(frame, file, codec):
+    # Wraps `file` so that the payloads of a compressed transfer are written
+    # decompressed. Returns None for an uncompressed transfer.
+    if not frame.flags & FLAG_COMPRESSED or file is None:
+        return None
+    if codec is None:
+        raise ProtocolError("Received compressed data without a negotiated codec.")
+    return DecompressingWriter(file, codec)
+
+
+def recv_stream(sock, file, first=None, codec=None, digest=None):
+    # Receives data frames until the one carrying FLAG_END. Returns the
+    # number of bytes written, after decompression. A trailing checksum is
+    # compared with `digest` (anything with hexdigest(), e.g. a
+    # HashingWriter around `file`) and raises ChecksumError on a mismatch.
+    total = 0
+    frame = first
+    decompressor = None
+    while True:
+        if frame is None:
+            frame = recv_frame_header(sock)
+            if frame is None:
+                raise ConnectionError("Connection closed before the transfer finished.")
+        if frame.opcode != OP_DATA:
+            raise ProtocolError(f"Expected a data frame, got opcode {frame.opcode}.")
+        if frame.flags & FLAG_CHECKSUM:
+            if frame.length > MAX_CONTROL_PAYLOAD:
+                raise ProtocolError(f"Frame payload of {frame.length} bytes exceeds the limit.")
+            payload = recv_exact(sock, frame.length)
+            if decompressor:
+                total = decompressor.finish()
+            check_checksum(digest, payload)
+            return total
+        if decompressor is None and total == 0:
+            decompressor = decompressing_writer(frame, file, codec)
+        total += copy_payload(sock, frame, decompressor or file)
+        if frame.flags & FLAG_END:
+            return decompressor.finish() if decompressor else total
+        frame = None
+
+
+def send_chunks(sock, chunks, request_id=0):
+    # Sends each payload as a data frame of its own, followed by an empty
+    # frame carrying FLAG_END.
+    for chunk in chunks:
+        send_frame(sock, OP_DATA, chunk, request_id)
+    send_frame(sock, OP_DATA, b'', request_id, FLAG_END)
+
+
+def recv_chunks(sock, first=None):
+    # Yields the payloads of data frames up to the one carrying FLAG_END
+    frame = first
+    while True:
+        if frame is None:
+            frame = recv_frame_header(sock)
+            if frame is None:
+                raise ConnectionError("Connection closed before the transfer finished.")
+        if frame.opcode != OP_DATA:
+            raise ProtocolError(f"Expected a data frame, got opcode {frame.opcode}.")
+        if frame.length > MAX_CONTROL_PAYLOAD:
+            raise ProtocolError(f"Frame payload of {frame.length} bytes exceeds the limit.")
+        yield recv_exact(sock, frame.length) if frame.length else b''
+        if frame.flags & FLAG_END:
+            return
+        frame = None
+
+
+def read_response(sock):
+    # Reads a reply or error frame and returns (ok, message).
+    frame, payload = recv_frame(sock)
+    if frame is None:
+        raise ConnectionError("Server closed the connection.")
+    if frame.opcode not in (OP_REPLY, OP_ERROR):
+        raise ProtocolError(f"Unexpected opcode {frame.opcode} in response.")
+    return frame.opcode == OP_REPLY, payload.decode()
+
+
+def parse_command(payload):
+    tokens = payload.decode().split()
+    if not tokens:
+        raise ProtocolError("Empty command.")
+    return tokens[0], tokens[1:]
+
+
+# asyncio counterparts used by the asyncio server engine. They work on a
+# StreamReader/StreamWriter pair instead of a socket. asyncio itself is not
+# imported here, so that the threaded engine and the client start without
+# it; asyncio.IncompleteReadError is caught as the EOFError it derives from.
+
+async def read_frame_header(reader):
+    try:
+        data = await reader.readexactly(HEADER_SIZE)
+    except EOFError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Connection closed in the middle of a frame.")
+    return unpack_header(data)
+
+
+async def read_frame(reader, max_payload=MAX_CONTROL_PAYLOAD):
+    frame = await read_frame_header(reader)
+    if frame is None:
+        return None, b''
+    if frame.length > max_payload:
+        raise ProtocolError(f"Frame payload of {frame.length} bytes exceeds the limit.")
+    try:
+        payload = await reader.readexactly(frame.length) if frame.length else b''
+    except EOFError:
+        raise ConnectionError("Connection closed in the middle of a frame.")
+    return frame, payload
+
+
+def write_frame(writer, opcode, payload=b'', request_id=0, flags=0):
+    writer.write(pack_header(opcode, len(payload), request_id, flags) + payload)
+
+
+def write_reply(writer, message, request_id=0):
+    write_frame(writer, OP_REPLY, message.encode(), request_id)
+
+
+def write_error(writer, message, request_id=0):
+    write_frame(writer, OP_ERROR, message.encode(), request_id)
+
+
+async def write_chunks(writer, chunks, request_id=0):
+    for chunk in chunks:
+        write_frame(writer, OP_DATA, chunk, request_id)
+        await writer.drain()
+    write_frame(writer, OP_DATA, b'', request_id, FLAG_END)
+
+
+async def read_payload(reader, frame, file, chunk_size=CHUNK_SIZE):
+    remaining = frame.length
+    while remaining:
+        chunk = await reader.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ConnectionError("Connection closed in the middle of a transfer.")
+        if file is not None:
+            file.write(chunk)
+        remaining -= len(chunk)
+    return frame.length
+
+
+async def read_stream(reader, file, first=None, codec=None, digest=None):
+    total = 0
+    frame = first
+    decompressor = None
+    while True:
+        if frame is None:
+            frame = await read_frame_header(reader)
+            if frame is None:
+                raise ConnectionError("Connection closed before the transfer finished.")
+        if frame.opcode != OP_DATA:
+            raise ProtocolError(f"Expected a data frame, got opcode {frame.opcode}.")
+        if frame.flags & FLAG_CHECKSUM:
+            if frame.length > MAX_CONTROL_PAYLOAD:
+                raise ProtocolError(f"Frame payload of {frame.length} bytes exceeds the limit.")
+            try:
+                payload = await reader.readexactly(frame.length)
+            except EOFError:
+                raise ConnectionError("Connection closed in the middle of a frame.")
+            if decompressor:
+                total = decompressor.finish()
+            check_checksum(digest, payload)
+            return total
+        if decompressor is None and total == 0:
+            decompressor = decompressing_writer(frame, file, codec)
+        total += await read_payload(reader, frame, decompressor or file)
+        if frame.flags & FLAG_END:
+            return decompressor.finish() if decompressor else total
+        frame = None
+
+
+async def run_blocking(run, function, *args):
+    # Calls function directly, or through `run` (e.g. on an executor) when
+    # it does CPU work the event loop should not wait for
+    if run is None:
+        return function(*args)
+    return await run(function, *args)
+
+
+async def write_compressed(writer, file, size, codec, request_id=0, buffer_size=SEND_BUFFER_SIZE, end=True,
+                           run=None):
+    chunks = compressed_chunks(file, size, codec, buffer_size)
+    pending = None
+    while (chunk := await run_blocking(run, next, chunks, None)) is not None:
+        if pending is not None:
+            write_frame(writer, OP_DATA, pending, request_id, FLAG_COMPRESSED)
+            await writer.drain()
+        pending = chunk
+    write_frame(writer, OP_DATA, pending, request_id, FLAG_COMPRESSED | (FLAG_END if end else 0))
+
+
+def write_checksum(writer, checksum, request_id=0):
+    write_frame(writer, OP_DATA, checksum.encode(), request_id, FLAG_CHECKSUM | FLAG_END)
+
+
+async def sendfile(writer, file, offset, count):
+    # Writers that pace their output (scheduler.ShapedWriter) send files
+    # themselves
+    if hasattr(writer, 'sendfile'):
+        return await writer.sendfile(file, offset, count)
+    import asyncio  # already loaded by the running event loop, see above
+    return await asyncio.get_running_loop().sendfile(writer.transport, file, offset, count)
+
+
+async def write_stream(writer, file, size, request_id=0, zero_copy=True, buffer_size=SEND_BUFFER_SIZE, flags=0,
+                       end=True, run=None):
+    writer.write(pack_header(OP_DATA, size, request_id, (FLAG_END if end else 0) | flags))
+    if hasattr(file, 'memory'):
+        view = file.memory(size)
+        writer.write(view)
+        sent = len(view)
+        await writer.drain()
+    elif zero_copy and hasattr(file, 'segments'):
+        sent = 0
+        for part, offset, count in file.segments():
+            sent += await sendfile(writer, part, offset, count) if count else 0
+    elif zero_copy and can_sendfile(file) and size:
+        # loop.sendfile waits for the header to be flushed and falls back
+        # to plain writes on transports that cannot use os.sendfile.
+        sent = await sendfile(writer, file, file.tell(), size)
+    else:
+        # The transport may keep a reference to whatever it could not send
+        # yet, so each chunk is a fresh bytes object here.
+        sent = 0
+        while sent < size:
+            chunk = await run_blocking(run, file.read, min(buffer_size, size - sent))
+            if not chunk:
+                break
+            writer.write(chunk)
+            sent += len(chunk)
+            await writer.drain()
+    if sent != size:
+        raise ProtocolError("File shrank while it was being sent.")
@@ -0,0 +1,381 @@
+import collections
+import itertools
+import threading
+import time
+from operator import attrgetter
+
+# Bandwidth shaping for the file data of /store and /get (server.py
+# --rate-limit and friends). Commands, replies and /dir listings never pass
+# through it, so they are answered at once while transfers are throttled.
+#
+#   rate limits   token buckets per direction, one for the whole server and
+#                 one per handle. Transfers take tokens for at most QUANTUM
+#                 bytes at a time: before sending them, or after receiving
+#                 them, which holds back the next read.
+#   fair queuing  transfers waiting for tokens are served in the order of
+#                 their virtual finish times (self-clocked fair queuing), so
+#                 each gets a share of the bandwidth in proportion to its
+#                 handle's weight, whatever the size of its file
+#   admission     at most max_large transfers may have moved more than
+#                 large_transfer bytes at a time; the next one to pass that
+#                 mark waits there until one of them ends
+#
+# Everything can be changed while the server runs with configure(), which
+# the metrics port serves as /limits. New limits apply to the next grant;
+# whether a transfer is shaped at all is decided when it starts. Worker
+# processes of --workers each apply their share of the limits to their own
+# transfers, see coordinator.worker_limits().
+
+QUANTUM = 256 * 1024
+LARGE_TRANSFER = 8 * 1024 * 1024
+
+# Tokens a bucket can save up, in seconds of its rate
+BURST_SECONDS = 0.1
+
+DIRECTIONS = ('in', 'out')
+
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate * BURST_SECONDS, QUANTUM)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, count, now):
+        # Seconds until `count` bytes may pass. Counts above the capacity
+        # only wait for a full bucket, which they leave in debt.
+        self.refill(now)
+        return max(0.0, min(count, self.capacity) - self.tokens) / self.rate
+
+
+class Transfer:
+    # One upload or download, as the scheduler sees it
+    def __init__(self, handle, direction):
+        self.handle = handle
+        self.direction = direction
+        self.moved = 0
+        self.finish = 0.0   # virtual finish time of its last request
+        self.large = False  # holds one of the large transfer slots
+
+
+class Request:
+    def __init__(self, transfer, count, wake):
+        self.transfer = transfer
+        self.count = count
+        self.wake = wake
+        self.finish = 0.0
+        self.sequence = 0
+
+
+class TransferScheduler:
+    # Engines call request() before moving bytes of a transfer, or take()
+    # and take_async() which wait for the grant. Requests that cannot be
+    # granted at once are queued and granted by a dispatcher thread.
+
+    def __init__(self, rate=0, handle_rate=0, max_large=0, large_transfer=LARGE_TRANSFER):
+        self.condition = threading.Condition()
+        self.rate = 0
+        self.handle_rate = 0
+        self.max_large = 0
+        self.large_transfer = large_transfer
+        self.weights = {}
+        self.buckets = {}    # (direction, handle) -> TokenBucket, handle None for the server
+        self.active = collections.Counter()  # handle -> open transfers
+        self.virtual_time = dict.fromkeys(DIRECTIONS, 0.0)
+        self.waiting = []    # requests waiting for tokens
+        self.admissions = collections.deque()  # requests waiting for a large transfer slot
+        self.large = 0
+        self.sequence = itertools.count()
+        self.thread = None
+        self.configure(rate=rate, handle_rate=handle_rate, max_large=max_large)
+
+    @property
+    def enabled(self):
+        return bool(self.rate or self.handle_rate or self.max_large)
+
+    def configure(self, rate=None, handle_rate=None, max_large=None, large_transfer=None, weights=None):
+        # Changes the given settings and returns all of them. Rates are in
+        # bytes per second, 0 meaning unlimited; max_large 0 admits all.
+        for name, value in (('rate', rate), ('handle_rate', handle_rate), ('max_large', max_large),
+                            ('large_transfer', large_transfer)):
+            if value is not None and value < 0:
+                raise ValueError(f"{name} cannot be negative.")
+        for handle, weight in (weights or {}).items():
+            if weight <= 0:
+                raise ValueError(f"Weight of {handle} must be positive.")
+        with self.condition:
+            if rate is not None or handle_rate is not None:
+                self.rate = self.rate if rate is None else rate
+                self.handle_rate = self.handle_rate if handle_rate is None else handle_rate
+                self.buckets.clear()
+            if max_large is not None:
+                self.max_large = max_large
+            if large_transfer is not None:
+                self.large_transfer = large_transfer
+            self.weights.update(weights or {})
+            wake = self.admit_waiting()
+            self.condition.notify_all()
+            settings = self.settings()
+        for callback in wake:
+            callback()
+        return settings
+
+    def settings(self):
+        return {'rate': self.rate, 'handle_rate': self.handle_rate, 'max_large': self.max_large,
+                'large_transfer': self.large_transfer, 'weights': dict(self.weights)}
+
+    def stats(self):
+        return {'transfers_throttled': len(self.waiting), 'transfers_admission_waiting': len(self.admissions),
+                'large_transfers_active': self.large}
+
+    def open(self, handle, direction):
+        with self.condition:
+            self.active[handle] += 1
+        return Transfer(handle, direction)
+
+    def close(self, transfer):
+        # The transfer ended: its slot is freed and requests it left queued,
+        # e.g. when its connection dropped, are forgotten
+        with self.condition:
+            self.waiting = [request for request in self.waiting if request.transfer is not transfer]
+            self.admissions = collections.deque(request for request in self.admissions
+                                                if request.transfer is not transfer)
+            wake = []
+            if transfer.large:
+                transfer.large = False
+                self.large -= 1
+                wake = self.admit_waiting()
+            self.active[transfer.handle] -= 1
+            if not self.active[transfer.handle]:
+                del self.active[transfer.handle]
+                self.drop_full_buckets(transfer.handle)
+            self.condition.notify_all()
+        for callback in wake:
+            callback()
+
+    def drop_full_buckets(self, handle):
+        # A full bucket is as good as a new one, so idle handles cost nothing
+        now = time.monotonic()
+        for direction in DIRECTIONS:
+            bucket = self.buckets.get((direction, handle))
+            if bucket is not None:
+                bucket.refill(now)
+                if bucket.tokens >= bucket.capacity:
+                    del self.buckets[(direction, handle)]
+
+    def request(self, transfer, count, wake):
+        # True if `count` bytes of the transfer may move now; otherwise
+        # wake() is called from another thread once they may
+        request = Request(transfer, count, wake)
+        with self.condition:
+            transfer.moved += count
+            if not transfer.large and transfer.moved > self.large_transfer:
+                if self.max_large and self.large >= self.max_large:
+                    self.admissions.append(request)
+                    return False
+                transfer.large = True
+                self.large += 1
+            return self.schedule(request)
+
+    def admit_waiting(self):
+        # Called with the lock held; returns the callbacks to wake
+        wake = []
+        while self.admissions and (not self.max_large or self.large < self.max_large):
+            request = self.admissions.popleft()
+            request.transfer.large = True
+            self.large += 1
+            if self.schedule(request):
+                wake.append(request.wake)
+        return wake
+
+    def schedule(self, request):
+        # Called with the lock held: grants the request or queues it
+        transfer = request.transfer
+        buckets = self.buckets_for(transfer)
+        if not buckets:
+            return True
+        start = max(self.virtual_time[transfer.direction], transfer.finish)
+        transfer.finish = request.finish = start + request.count / self.weights.get(transfer.handle, 1)
+        request.sequence = next(self.sequence)
+        now = time.monotonic()
+        if not self.waiting and all(bucket.delay(request.count, now) == 0 for bucket in buckets):
+            self.grant(request, buckets)
+            return True
+        self.waiting.append(request)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='transfer-scheduler', daemon=True)
+            self.thread.start()
+        self.condition.notify_all()
+        return False
+
+    def buckets_for(self, transfer):
+        buckets = []
+        for handle, rate in ((None, self.rate), (transfer.handle, self.handle_rate)):
+            if rate:
+                key = (transfer.direction, handle)
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(rate)
+                buckets.append(bucket)
+        return buckets
+
+    def grant(self, request, buckets):
+        for bucket in buckets:
+            bucket.tokens -= request.count
+        self.virtual_time[request.transfer.direction] = request.finish
+
+    def run(self):
+        # Grants queued requests in the order of their finish times as
+        # tokens come in. One that only waits for its handle's bucket does
+        # not hold up others; one waiting for the server's bucket holds up
+        # everything behind it in its direction.
+        while True:
+            wake = []
+            with self.condition:
+                while not self.waiting:
+                    self.condition.wait()
+                now = time.monotonic()
+                timeout = None
+                blocked = set()
+                for request in sorted(self.waiting, key=attrgetter('finish', 'sequence')):
+                    direction = request.transfer.direction
+                    if direction in blocked:
+                        continue
+                    buckets = self.buckets_for(request.transfer)
+                    delays = [bucket.delay(request.count, now) for bucket in buckets]
+                    if not any(delays):
+                        self.grant(request, buckets)
+                        self.waiting.remove(request)
+                        wake.append(request.wake)
+                        continue
+                    if self.rate and delays[0]:
+                        blocked.add(direction)
+                    delay = max(delays)
+                    timeout = delay if timeout is None else min(timeout, delay)
+                if not wake:
+                    self.condition.wait(timeout)
+            for callback in wake:
+                callback()
+
+    def take(self, transfer, count):
+        # Blocks the calling thread until the bytes may move
+        granted = threading.Event()
+        if not self.request(transfer, count, granted.set):
+            granted.wait()
+
+    async def take_async(self, transfer, count, loop):
+        # Waits on the event loop `loop`, which runs the calling coroutine
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        if not self.request(transfer, count, wake):
+            await granted
+
+
+class ShapedSocket:
+    # Socket (or mux stream) of the threaded engine whose data passes the
+    # scheduler, for the duration of one transfer
+    def __init__(self, sock, scheduler, transfer):
+        self.sock = sock
+        self.scheduler = scheduler
+        self.transfer = transfer
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        for start in range(0, len(view), QUANTUM):
+            piece = view[start:start + QUANTUM]
+            self.scheduler.take(self.transfer, len(piece))
+            self.sock.sendall(piece)
+
+    def sendfile(self, file, offset=0, count=None):
+        sent = 0
+        while sent < count:
+            size = min(QUANTUM, count - sent)
+            self.scheduler.take(self.transfer, size)
+            done = self.sock.sendfile(file, offset + sent, size)
+            if not done:
+                break
+            sent += done
+        return sent
+
+    def recv_into(self, buffer, nbytes=0):
+        count = self.sock.recv_into(buffer, min(nbytes or len(buffer), QUANTUM))
+        if count:
+            self.scheduler.take(self.transfer, count)
+        return count
+
+    def recv(self, size):
+        data = self.sock.recv(min(size, QUANTUM))
+        if data:
+            self.scheduler.take(self.transfer, len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class ShapedReader:
+    # StreamReader of the asyncio engine, for the duration of one upload
+    def __init__(self, reader, scheduler, transfer, loop):
+        self.reader = reader
+        self.scheduler = scheduler
+        self.transfer = transfer
+        self.loop = loop
+
+    async def read(self, n=-1):
+        data = await self.reader.read(QUANTUM if n < 0 else min(n, QUANTUM))
+        if data:
+            await self.scheduler.take_async(self.transfer, len(data), self.loop)
+        return data
+
+    async def readexactly(self, n):
+        data = await self.reader.readexactly(n)
+        await self.scheduler.take_async(self.transfer, n, self.loop)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.reader, name)
+
+
+class ShapedWriter:
+    # StreamWriter of the asyncio engine, for the duration of one download.
+    # Writes are paid for when drained; files are sent QUANTUM bytes at a
+    # time (see protocol.write_stream).
+    def __init__(self, writer, scheduler, transfer, loop):
+        self.writer = writer
+        self.scheduler = scheduler
+        self.transfer = transfer
+        self.loop = loop
+        self.pending = 0
+
+    def write(self, data):
+        self.writer.write(data)
+        self.pending += len(data)
+
+    async def drain(self):
+        pending, self.pending = self.pending, 0
+        if pending:
+            await self.scheduler.take_async(self.transfer, pending, self.loop)
+        await self.writer.drain()
+
+    async def sendfile(self, file, offset, count):
+        sent = 0
+        while sent < count:
+            size = min(QUANTUM, count - sent)
+            await self.drain()
+            await self.scheduler.take_async(self.transfer, size, self.loop)
+            done = await self.loop.sendfile(self.writer.transport, file, offset + sent, size)
+            if not done:
+                break
+            sent += done
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
@@ -1,100 +1,63 @@
+import argparse
+import contextlib
 import socket
+import sys
 import threading
-import os
-import ttkbootstrap as ttk
-from tkinter import font, scrolledtext
-
-class ServerApp:
-    DEFAULT_HOST = '127.0.0.1'
-    DEFAULT_PORT = 12345
-
-    def __init__(self):
-        self.host = self.DEFAULT_HOST
-        self.port = self.DEFAULT_PORT
-        self.clients = {}
-        self.files_directory = "server_files"
-        os.makedirs(self.files_directory, exist_ok=True)
-        
-        # Initialize the GUI
-        self.init_gui()
-        self.server_socket = None
-        self.active_connections = set()
-
-    def init_gui(self):
-        self.root = ttk.Window(themename="vapor")
-        self.style = ttk.Style()
-        self.set_default_font()
-
-        self.root.title("Server")
-        self.root.geometry('680x600')
-
-        # Main Frame
-        main_frame = ttk.Frame(self.root)
-        main_frame.pack(fill='both', expand=True, padx=10, pady=10)
-        main_frame.grid_rowconfigure(0, weight=1)
-        main_frame.grid_columnconfigure(0, weight=1)
-
-        # Connection Info Frame
-        self.conn_info_frame = ttk.LabelFrame(main_frame, text='Connection Information', padding=10)
-        self.conn_info_frame.grid(row=0, column=0, padx=10, pady=10, sticky='nsew')
-
-        # Log Frame
-        self.log_frame = ttk.LabelFrame(main_frame, text='Server Log', padding=10)
-        self.log_frame.grid(row=1, column=0, padx=10, pady=10, sticky='nsew')
-
-        # Labels and Entries
-        self.create_labels()
-        self.create_log_area()
-
-    def set_default_font(self, font_name='Helvetica', font_size=10, font_weight='bold'):
-        default_font = (font_name, font_size, font_weight)
-        
-        self.style.configure('TLabel', font=default_font)
-        self.style.configure('TButton', font=default_font)
-        self.style.configure('TEntry', font=default_font)
-        self.style.configure('TFrame', font=default_font)
-        self.style.configure('TCheckbutton', font=default_font)
-        self.style.configure('TRadiobutton', font=default_font)
-
-    def create_labels(self):
-        ttk.Label(self.conn_info_frame, text='Address', anchor='center', width=25).grid(row=1, column=1, ipadx=10, ipady=5)
-        ttk.Label(self.conn_info_frame, text='Port Number', anchor='center', width=25).grid(row=2, column=1, ipadx=10, ipady=5)
-        ttk.Label(self.conn_info_frame, text='Number of Users', anchor="center", width=25).grid(row=3, column=1, ipadx=10, ipady=5)
-        ttk.Label(self.conn_info_frame, text='List of Users', anchor='center', width=25).grid(row=4, column=1, ipadx=10, ipady=5)
-
-        self.address_label = ttk.Label(self.conn_info_frame, text=self.host, bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
-        self.address_label.grid(row=1, column=2, ipadx=10, ipady=5)
-        
-        self.port_label = ttk.Label(self.conn_info_frame, text=self.port, bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
-        self.port_label.grid(row=2, column=2, ipadx=10, ipady=5)
-        
-        self.number_users_label = ttk.Label(self.conn_info_frame, text="0", bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
-        self.number_users_label.grid(row=3, column=2, ipadx=10, ipady=5)
-        
-        self.list_users_label = ttk.Label(self.conn_info_frame, text=f"", bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
-        self.list_users_label.grid(row=4, column=2, ipadx=10, ipady=5)
-
-    def create_log_area(self):
-        self.log_area = scrolledtext.ScrolledText(self.log_frame, wrap='word', height=15, width=70)
-        self.log_area.pack(expand=True, fill='both')
-
-    def log_message(self, message):
-        self.log_area.configure(state='normal')  # Enable editing
-        self.log_area.insert('end', message + '\n')
-        self.log_area.yview('end')
-        self.log_area.configure(state='disabled')  # Disable editing
-
-    def start_server(self):
+import time
+import compression
+import protocol
+from cache import SMALL_FILE_LIMIT
+from event_log import ERROR, INFO, LEVELS, LOG_BACKUPS, MAX_LOG_BYTES
+from mux import Multiplexer, StreamPool
+from durability import DURABILITY_MODES
+from scheduler import ShapedSocket
+from server_core import ClientState, Error, Listing, Receive, Reply, Send, ServerCore
+
+class ServerApp(ServerCore):
+    DEFAULT_BACKLOG = 128
+    DEFAULT_STREAM_WORKERS = 16
+
+    def __init__(self, host=ServerCore.DEFAULT_HOST, port=ServerCore.DEFAULT_PORT, files_directory="server_files",
+                 backlog=DEFAULT_BACKLOG, zero_copy=True, send_buffer_size=protocol.SEND_BUFFER_SIZE,
+                 dedup=False, cache_size=0, cache_small_limit=SMALL_FILE_LIMIT, compress_at_rest=None,
+                 log_file=None, log_level=INFO, observer=None, metrics_port=None, profile=None,
+                 multiplex=True, stream_workers=DEFAULT_STREAM_WORKERS, durability='none', rate_limit=0,
+                 handle_rate_limit=0, max_large_transfers=0, swarm=False, log_max_bytes=MAX_LOG_BYTES,
+                 log_backups=LOG_BACKUPS):
+        super().__init__(host, port, files_directory, backlog, zero_copy, send_buffer_size, dedup, cache_size,
+                         cache_small_limit, compress_at_rest, log_file, log_level, observer, metrics_port,
+                         profile, durability, rate_limit, handle_rate_limit, max_large_transfers, swarm,
+                         log_max_bytes, log_backups)
+        self.multiplex = multiplex
+        # Threads serving the requests of each multiplexed connection
+        self.stream_workers = stream_workers
+
+    def bind(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Worker processes each listen on the port; the kernel spreads
+            # new connections over them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        self.number_users_label.config(text="0")
+        self.server_socket.listen(self.backlog)
+        self.port = self.server_socket.getsockname()[1]
+
+    def start_server(self):
+        self.events.start()
+        # A worker process may inherit an already listening socket
+        if self.server_socket is None:
+            self.bind()
         self.log_message(f"Server started on {self.host}:{self.port}")
-        threading.Thread(target=self.accept_clients).start()
+        self.start_metrics()
+        self.accept_thread = threading.Thread(target=self.accept_clients, daemon=True)
+        self.accept_thread.start()
 
     def accept_clients(self):
         while True:
             client_socket, client_address = self.server_socket.accept()
+            # Replies of several small frames must not wait for delayed ACKs
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             
             if client_address in self.active_connections:
                 self.log_message(f"Rejected connection from {client_address}: Already connected")
@@ -102,146 +65,244 @@ class ServerApp:
                 continue
             
             self.active_connections.add(client_address)
+            self.connections_gauge.inc()
             self.log_message(f"Connection from {client_address}")
-            threading.Thread(target=self.handle_client, args=(client_socket, client_address)).start()
+            threading.Thread(target=self.handle_client, args=(client_socket, client_address), daemon=True).start()
 
     def handle_client(self, client_socket, client_address):
-        registered = False
-        joined = False
-        handle = None
+        state = ClientState(client_socket, client_address[0])
 
         while True:
             try:
-                data = client_socket.recv(1024).decode()
-                if not data:
+                frame, payload = protocol.recv_frame(client_socket)
+                if frame is None:
                     break
 
-                command, *params = data.split()
-                print(f"Received command: {command}, params: {params}, from {client_address}")
-
-                if command == "/register":
-                    if registered:
-                        client_socket.sendall("Error: Already registered.".encode())
-                    else:
-                        handle = params[0]
-                        registration_status = self.register_handle(client_socket, handle)
-                        if registration_status == "Success":
-                            registered = True
-
-                elif command == "/store":
-                    if registered:
-                        self.store_file(client_socket, params[0])
-                    else:
-                        client_socket.sendall("Error: Please join the server before storing files.".encode())
-
-                elif command == "/dir":
-                    if registered:
-                        self.send_directory_list(client_socket)
-                    else:
-                        client_socket.sendall("Error: Please join the server before requesting directory list.".encode())
-
-                elif command == "/get":
-                    if registered:
-                        self.send_file(client_socket, params[0])
-                    else:
-                        client_socket.sendall("Error: Please join the server before requesting files.".encode())
-
-                elif command == "/join":
-                    if not joined:
-                        self.clients[client_socket] = handle  # Register client with current handle
-                        client_socket.sendall("Joined the server successfully.".encode())
-                        joined = True
-                        self.update_users_text()  # Update the users list when a client joins
-                    else:
-                        client_socket.sendall("Error: Already joined.".encode())
-
-                elif command == "/leave":
-                    if joined:
-                        self.clients.pop(client_socket, None)
-                        client_socket.sendall("Left the server.".encode())
-                        joined = False
-                        registered = False
-                        handle = None
-                        self.update_users_text()  # Update the users list when a client leaves
-                    else:
-                        client_socket.sendall("Error: Not joined yet.".encode())
-
-                else:
-                    client_socket.sendall("Error: Command not found.".encode())
+                if frame.opcode != protocol.OP_COMMAND:
+                    raise protocol.ProtocolError(f"Expected a command frame, got opcode {frame.opcode}.")
+
+                command, params = protocol.parse_command(payload)
+                self.events.debug("Received command", command=command, params=params, client=client_address)
+                started = time.perf_counter()
+                self.dispatch(client_socket, state, command, params)
+                self.metrics.observe_command(command, time.perf_counter() - started)
+
+                if state.multiplexed:
+                    # From here on every request is a stream of its own,
+                    # served by the connection's own threads; this one only
+                    # reads
+                    workers = StreamPool(lambda stream: self.serve_stream(stream, state, client_address),
+                                         self.stream_workers)
+                    try:
+                        Multiplexer(client_socket, workers.submit).run()
+                    finally:
+                        workers.close()
+                    break
 
             except Exception as e:
-                self.log_message(f"Error: {str(e)}")
+                self.log_message(f"Error: {str(e)}", ERROR)
                 break
 
-        # Clean up after client disconnects
-        if handle and handle in self.clients.values():
-            self.clients = {cs: h for cs, h in self.clients.items() if h != handle}
-
+        # Clean up after client disconnects; frees the handle and its tokens
+        self.close_session(state)
         self.active_connections.discard(client_address)  # Use discard to avoid KeyError
-        self.update_users_text()
+        self.connections_gauge.dec()
         client_socket.close()
 
-
-    def register_handle(self, client_socket, handle):
-        if handle not in self.clients.values():
-            self.clients[client_socket] = handle
-            client_socket.sendall(f"Welcome {handle}!".encode())
-            self.update_users_text()  # Update UI with new user list
-            return "Success"
-        else:
-            client_socket.sendall("Error: Registration failed. Handle or alias already exists.".encode())
-            return "Failure"
-
-    def store_file(self, client_socket, filename):
-        file_path = os.path.join(self.files_directory, filename)
+    def serve_stream(self, stream, state, client_address):
+        # One request of a multiplexed connection, run on one of its threads. A
+        # failure only aborts this stream, the connection stays usable.
         try:
-            with open(file_path, 'wb') as file:
-                while True:
-                    data = client_socket.recv(1024)
-                    if b"\r\nEND\r\n" in data:
-                        data, _ = data.split(b"\r\nEND\r\n", 1)
-                        file.write(data)
-                        break
-                    file.write(data)
-            self.log_message(f"File {filename} stored successfully.")
+            frame, payload = protocol.recv_frame(stream)
+            command, params = protocol.parse_command(payload)
+            self.events.debug("Received command", command=command, params=params, client=client_address,
+                              stream=stream.request_id)
+            started = time.perf_counter()
+            self.dispatch(stream, state, command, params)
+            self.metrics.observe_command(command, time.perf_counter() - started)
         except Exception as e:
-            client_socket.sendall(f"Error: Failed to store file. {str(e)}".encode())
-            self.log_message(f"Error: {str(e)}")
-
-    def send_directory_list(self, client_socket):
-        files = os.listdir(self.files_directory)
-        if files:
-            file_list = "\n".join(files)
-            client_socket.sendall(f"Directory list:\n{file_list}".encode())
+            self.log_message(f"Error: {str(e)}", ERROR)
+            stream.reset()
         else:
-            client_socket.sendall("Directory is empty.".encode())
+            stream.close()
+
+    def dispatch(self, sock, state, command, params):
+        # Commands are checked and executed by ServerCore; this only does
+        # the socket side of its response
+        response = self.execute(state, command, params)
+        if isinstance(response, Receive):
+            response = self.receive(sock, response)
+        if isinstance(response, Reply):
+            protocol.send_reply(sock, response.message)
+        elif isinstance(response, Error):
+            if response.discard:
+                protocol.recv_stream(sock, None)
+            protocol.send_error(sock, response.message)
+        elif isinstance(response, Listing):
+            protocol.send_chunks(sock, response.chunks)
+        elif isinstance(response, Send):
+            self.send_file(sock, response)
+
+    def shaped(self, sock, handle, direction):
+        # The file data of one transfer, passed through the scheduler when
+        # shaping is on
+        if not self.scheduler.enabled:
+            return contextlib.nullcontext(sock)
+        return self.shaped_transfer(sock, handle, direction)
+
+    @contextlib.contextmanager
+    def shaped_transfer(self, sock, handle, direction):
+        transfer = self.scheduler.open(handle, direction)
+        try:
+            yield ShapedSocket(sock, self.scheduler, transfer)
+        finally:
+            self.scheduler.close(transfer)
 
-    def send_file(self, client_socket, filename):
-        file_path = os.path.join(self.files_directory, filename)
+    def receive(self, client_socket, receive):
+        upload = receive.upload
+        self.transfers_gauge.inc()
         try:
-            if not os.path.exists(file_path):
-                client_socket.sendall(f"Error: File '{filename}' not found.".encode())
-                return
-
-            with open(file_path, 'rb') as file:
-                while chunk := file.read(1024):
-                    client_socket.sendall(chunk)
-            client_socket.sendall(b"\r\nEND\r\n")
+            with upload.file, self.shaped(client_socket, receive.handle, 'in') as sock:
+                received = protocol.recv_stream(sock, upload.file, codec=receive.codec,
+                                                digest=upload.file if receive.verify else None)
         except Exception as e:
-            client_socket.sendall(f"Error: Failed to send file. {str(e)}".encode())
-            self.log_message(f"Error: {str(e)}")
-
-
-    def update_users_text(self):
-        number_of_users = len(self.clients)
-        self.number_users_label.config(text=number_of_users)
-        list_of_users = "\n".join(self.clients.values())
-        self.list_users_label.config(text=list_of_users)
+            # Raised again unless it was a checksum mismatch, to let
+            # handle_client drop the connection
+            return self.receive_failed(upload, e)
+        finally:
+            self.transfers_gauge.dec()
+        return self.finish_receive(upload, received)
+
+    def send_file(self, client_socket, send):
+        # Once the data frame header is out an error can no longer be
+        # reported in-band, so failures past this point drop the connection.
+        self.transfers_gauge.inc()
+        try:
+            with self.shaped(client_socket, send.handle, 'out') as sock:
+                self.send_file_data(sock, send)
+        finally:
+            self.transfers_gauge.dec()
+        # Counted as stored, i.e. compressed for files kept compressed at rest
+        self.bytes_out.inc(send.count)
+
+    def send_file_data(self, client_socket, send):
+        end = send.checksum is None
+        with send.file as file:
+            if send.encoded:
+                # Stored compressed with the client's codec, sent as is
+                protocol.send_stream(client_socket, file, send.count, zero_copy=self.zero_copy,
+                                     buffer_size=self.send_buffer_size, flags=protocol.FLAG_COMPRESSED, end=end)
+            elif self.compresses(send):
+                protocol.send_compressed(client_socket, file, send.count, send.codec,
+                                         buffer_size=self.send_buffer_size, end=end)
+            else:
+                protocol.send_stream(client_socket, file, send.count, zero_copy=self.zero_copy,
+                                     buffer_size=self.send_buffer_size, end=end)
+        if send.checksum is not None:
+            protocol.send_checksum(client_socket, send.checksum)
 
     def run(self):
         self.start_server()
-        self.root.mainloop()
+        try:
+            self.accept_thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="File exchange server")
+    parser.add_argument('--host', default=ServerApp.DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=ServerApp.DEFAULT_PORT)
+    parser.add_argument('--storage-dir', default='server_files',
+                        help="directory the files are stored in")
+    parser.add_argument('--async', dest='async_mode', action='store_true',
+                        help="serve clients from a single asyncio event loop")
+    parser.add_argument('--gui', action='store_true',
+                        help="show the Tk window instead of logging to stdout")
+    # Headless is the default; still accepted for existing scripts
+    parser.add_argument('--no-gui', dest='gui', action='store_false', help=argparse.SUPPRESS)
+    parser.add_argument('--backlog', type=int, default=None,
+                        help="listen() backlog")
+    parser.add_argument('--max-connections', type=int, default=None,
+                        help="connection limit of the asyncio engine")
+    parser.add_argument('--no-sendfile', dest='zero_copy', action='store_false',
+                        help="copy downloads through a buffer instead of socket.sendfile")
+    parser.add_argument('--send-buffer', type=int, default=protocol.SEND_BUFFER_SIZE,
+                        help="buffer size in bytes for the copying download path")
+    parser.add_argument('--dedup', action='store_true',
+                        help="store files as deduplicated, content-addressed chunks")
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help="memory budget in bytes for caching hot files (0 disables the cache)")
+    parser.add_argument('--cache-small-limit', type=int, default=SMALL_FILE_LIMIT,
+                        help="files up to this size are cached as buffers, larger ones as mmap views")
+    parser.add_argument('--log-file', default='logs/server.log',
+                        help="JSON lines log file, rotated by size (empty to disable)")
+    parser.add_argument('--log-level', choices=sorted(LEVELS, key=LEVELS.get), default='info',
+                        help="debug also logs every command")
+    parser.add_argument('--log-max-bytes', type=int, default=MAX_LOG_BYTES,
+                        help="size at which the log file is rotated")
+    parser.add_argument('--log-backups', type=int, default=LOG_BACKUPS,
+                        help="rotated log files to keep")
+    parser.add_argument('--compress-at-rest', choices=sorted(compression.CODECS), default=None,
+                        help="keep uploaded files compressed with this codec")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve Prometheus metrics and the profiler toggle over HTTP on this port")
+    parser.add_argument('--profile', metavar='FILE', default=None,
+                        help="sample stacks from startup and write the hottest ones to FILE on exit")
+    parser.add_argument('--no-mux', dest='multiplex', action='store_false',
+                        help="refuse multiplexed connections (threaded engine)")
+    parser.add_argument('--stream-workers', type=int, default=ServerApp.DEFAULT_STREAM_WORKERS,
+                        help="threads serving the requests of each multiplexed connection")
+    parser.add_argument('--durability', choices=DURABILITY_MODES, default='none',
+                        help="when uploads reach the disk: none, fdatasync per file or batched group commits")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes sharing the port (headless, needs fork)")
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help="bytes per second of file data in each direction, for the whole server (0: unlimited)")
+    parser.add_argument('--handle-rate-limit', type=int, default=0,
+                        help="bytes per second of file data in each direction, per handle (0: unlimited)")
+    parser.add_argument('--max-large-transfers', type=int, default=0,
+                        help="transfers past 8 MiB allowed at once, the others wait (0: unlimited)")
+    parser.add_argument('--swarm', action='store_true',
+                        help="let clients that announce themselves with /peer download from each other")
+    args = parser.parse_args(argv)
+    if args.workers > 1 and args.gui:
+        parser.error("--workers cannot be combined with --gui")
+
+    if args.async_mode:
+        from async_server import AsyncServer
+        engine = AsyncServer(args.host, args.port, args.storage_dir,
+                             backlog=args.backlog or AsyncServer.DEFAULT_BACKLOG,
+                             max_connections=args.max_connections or AsyncServer.DEFAULT_MAX_CONNECTIONS,
+                             zero_copy=args.zero_copy, send_buffer_size=args.send_buffer, dedup=args.dedup,
+                             cache_size=args.cache_size, cache_small_limit=args.cache_small_limit,
+                             compress_at_rest=args.compress_at_rest, log_file=args.log_file or None,
+                             log_level=LEVELS[args.log_level], metrics_port=args.metrics_port,
+                             profile=args.profile, durability=args.durability, rate_limit=args.rate_limit,
+                             handle_rate_limit=args.handle_rate_limit,
+                             max_large_transfers=args.max_large_transfers, swarm=args.swarm,
+                             log_max_bytes=args.log_max_bytes, log_backups=args.log_backups)
+    else:
+        engine = ServerApp(args.host, args.port, args.storage_dir,
+                           backlog=args.backlog or ServerApp.DEFAULT_BACKLOG,
+                           zero_copy=args.zero_copy, send_buffer_size=args.send_buffer, dedup=args.dedup,
+                           cache_size=args.cache_size, cache_small_limit=args.cache_small_limit,
+                           compress_at_rest=args.compress_at_rest, log_file=args.log_file or None,
+                           log_level=LEVELS[args.log_level], metrics_port=args.metrics_port,
+                           profile=args.profile, multiplex=args.multiplex, stream_workers=args.stream_workers,
+                           durability=args.durability, rate_limit=args.rate_limit,
+                           handle_rate_limit=args.handle_rate_limit, max_large_transfers=args.max_large_transfers,
+                           swarm=args.swarm, log_max_bytes=args.log_max_bytes, log_backups=args.log_backups)
+
+    if args.workers > 1:
+        from coordinator import serve_workers
+        sys.exit(serve_workers(engine, args.workers))
+    elif args.gui:
+        # Tk is only imported when a window is actually wanted
+        from server_gui import ServerWindow
+        ServerWindow(engine).run()
+    else:
+        engine.run()
 
 if __name__ == "__main__":
-    app = ServerApp()
-    app.run()
+    main()
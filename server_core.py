@@ -0,0 +1,476 @@
+import atexit
+import itertools
+import json
+import os
+from collections import namedtuple
+import compression
+import protocol
+from cache import FileCache, SMALL_FILE_LIMIT
+from event_log import ERROR, INFO, LOG_BACKUPS, MAX_LOG_BYTES, EventLog
+from metrics import MetricsRegistry, SamplingProfiler
+from mux import offered_mux
+from durability import make_durability
+from scheduler import TransferScheduler
+from sessions import SessionRegistry
+from storage import ChunkStore, FileStore, StorageError
+from swarm import CHUNK_SIZE, SwarmTracker, parse_swarm_options
+
+# What the two server engines have in common. ServerCore parses commands,
+# checks them against the connection's state and does the storage side of
+# each; it never touches a connection itself. execute() answers a command
+# with one of the responses below, and the engine (server.py with a thread
+# per connection, async_server.py on an event loop) does the I/O:
+#
+#   Reply      send the message
+#   Error      send the error, after reading and dropping the data that
+#              follows the command when `discard` is set
+#   Receive    read the data stream into upload.file, then send what
+#              finish_receive() answers
+#   Listing    send the chunks of a /dir listing
+#   Send       send `count` bytes of `file`, compressed with `codec` unless
+#              `encoded`, followed by `checksum` when it is not None
+Reply = namedtuple('Reply', ['message'])
+Error = namedtuple('Error', ['message', 'discard'], defaults=[False])
+Receive = namedtuple('Receive', ['upload', 'codec', 'verify', 'handle'])
+Listing = namedtuple('Listing', ['chunks'])
+Send = namedtuple('Send', ['filename', 'file', 'count', 'encoded', 'codec', 'checksum', 'handle', 'inflated'])
+
+# Commands that go through the session registry, which is a round trip to
+# the coordinator in a worker process (see coordinator.py)
+SESSION_COMMANDS = {'/register', '/attach', '/token', '/join', '/leave'}
+
+
+class ClientState:
+    # What a connection has negotiated and who it belongs to. `session` is
+    # the client socket or stream writer, which keys the session registry;
+    # `address` is the host the client connected from. The streams of a
+    # multiplexed connection all share its state.
+
+    def __init__(self, session, address):
+        self.session = session
+        self.address = address
+        self.registered = False
+        self.joined = False
+        self.attached = False
+        self.handle = None
+        self.codec = None  # Negotiated at /join or /attach, None sends data as is
+        self.checksums = False  # Transfers end with a checksum trailer
+        self.multiplexed = False
+
+
+class ServerCore:
+    DEFAULT_HOST = '127.0.0.1'
+    DEFAULT_PORT = 12345
+
+    # Only the threaded engine can switch a connection to multiplexed mode
+    multiplex = False
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, files_directory="server_files",
+                 backlog=128, zero_copy=True, send_buffer_size=protocol.SEND_BUFFER_SIZE,
+                 dedup=False, cache_size=0, cache_small_limit=SMALL_FILE_LIMIT, compress_at_rest=None,
+                 log_file=None, log_level=INFO, observer=None, metrics_port=None, profile=None,
+                 durability='none', rate_limit=0, handle_rate_limit=0, max_large_transfers=0, swarm=False,
+                 log_max_bytes=MAX_LOG_BYTES, log_backups=LOG_BACKUPS):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.zero_copy = zero_copy
+        self.send_buffer_size = send_buffer_size
+        self.observer = observer
+        self.events = EventLog(log_file, log_level, max_bytes=log_max_bytes, backups=log_backups)
+        self.metrics_port = metrics_port
+        self.profile = profile
+        self.metrics = MetricsRegistry()
+        self.profiler = SamplingProfiler()
+        self.connections_gauge = self.metrics.gauge('connections_active', "Open client connections")
+        self.transfers_gauge = self.metrics.gauge('transfers_in_flight', "Uploads and downloads in progress")
+        self.bytes_in = self.metrics.counter('bytes_received_total', "File bytes received from clients")
+        self.bytes_out = self.metrics.counter('bytes_sent_total', "File bytes sent to clients")
+        self.sessions = SessionRegistry()
+        self.sessions.subscribe(self.update_users_text)
+        self.files_directory = files_directory
+        os.makedirs(self.files_directory, exist_ok=True)
+        # Hot files are only cached when a memory budget is given
+        self.cache = FileCache(cache_size, cache_small_limit) if cache_size > 0 else None
+        durability = make_durability(durability)
+        if dedup:
+            self.store = ChunkStore(self.files_directory, self.cache, durability=durability)
+        else:
+            self.store = FileStore(self.files_directory, self.cache, compress_at_rest, durability)
+        if self.cache:
+            self.metrics.add_collector(self.cache_metrics)
+        self.metrics.add_collector(self.durability_metrics)
+        # Paces file data once a rate limit or admission cap is set
+        self.scheduler = TransferScheduler(rate_limit, handle_rate_limit, max_large_transfers)
+        self.metrics.add_collector(self.scheduler.stats)
+        # Which peers hold which chunks, for clients downloading from each other
+        self.swarm = SwarmTracker() if swarm else None
+        if self.swarm:
+            self.metrics.add_collector(self.swarm_metrics)
+
+        self.server_socket = None
+        self.reuse_port = False
+        self.active_connections = set()
+
+    def log_message(self, message, level=INFO):
+        # Only queues the message; the event log's own thread writes it out
+        self.events.emit(level, message)
+
+    def execute(self, state, command, params):
+        if command == "/register":
+            if state.registered:
+                return Error("Error: Already registered.")
+            if len(params) != 1:
+                return Error("Error: Command parameters do not match or is not allowed.")
+            return self.register_handle(state, params[0])
+
+        if command == "/attach":
+            # Extra connection of an already registered client, used for
+            # parallel range transfers. It does not show up as a separate
+            # user.
+            if state.registered:
+                return Error("Error: Already registered.")
+            handle = self.sessions.resolve_token(params[0]) if len(params) in (1, 2, 3) else None
+            if handle is None:
+                return Error("Error: Invalid session token.")
+            state.handle = handle
+            state.registered = True
+            state.attached = True
+            state.codec = self.negotiate_codec(params[1:])
+            state.checksums = protocol.offered_checksums(params[1:])
+            message = self.with_checksums(f"Attached to {state.handle}.", state.checksums)
+            return Reply(self.with_codec(message, state.codec))
+
+        if command == "/token":
+            if state.registered and not state.attached:
+                return Reply(self.sessions.issue_token(state.handle))
+            return Error("Error: Please register before requesting a session token.")
+
+        if command == "/store":
+            # The file contents always follow the command, so they are
+            # consumed even when the upload is refused.
+            if not state.registered:
+                return Error("Error: Please join the server before storing files.", discard=True)
+            if len(params) not in (1, 3):
+                return Error("Error: Command parameters do not match or is not allowed.", discard=True)
+            return self.open_upload(state, *params)
+
+        if command == "/chunks":
+            # Deduplicating upload: the client asks which of its chunk
+            # hashes are missing, sends those with /chunk and then links the
+            # file name to them with /manifest.
+            if not state.registered:
+                return Error("Error: Please join the server before storing files.")
+            try:
+                return Reply(" ".join(self.store.missing_chunks(params)))
+            except StorageError as e:
+                return Error(f"Error: {str(e)}")
+
+        if command in ("/chunk", "/manifest"):
+            if not state.registered:
+                return Error("Error: Please join the server before storing files.", discard=True)
+            if len(params) != 1:
+                return Error("Error: Command parameters do not match or is not allowed.", discard=True)
+            return self.open_blob_upload(state, command[1:], params[0])
+
+        if command == "/dir":
+            if not state.registered:
+                return Error("Error: Please join the server before requesting directory list.")
+            return self.directory_list(params)
+
+        if command == "/get":
+            if not state.registered:
+                return Error("Error: Please join the server before requesting files.")
+            if len(params) >= 2 and params[1] == "swarm":
+                return self.chunk_map(state, params[0], params[2:])
+            if len(params) not in (1, 2, 3):
+                return Error("Error: Command parameters do not match or is not allowed.")
+            return self.open_download(state, *params)
+
+        if command == "/stat":
+            if not state.registered:
+                return Error("Error: Please join the server before requesting files.")
+            if len(params) != 1:
+                return Error("Error: Command parameters do not match or is not allowed.")
+            return self.file_stat(params[0])
+
+        if command == "/peer":
+            # Swarm mode: the client serves the chunks it downloads on this
+            # port of the address it connected from
+            if not state.registered or state.attached:
+                return Error("Error: Please register before joining the swarm.")
+            if self.swarm is None:
+                return Error("Error: Swarm mode is off.")
+            if len(params) != 1 or not params[0].isdigit():
+                return Error("Error: Command parameters do not match or is not allowed.")
+            self.swarm.add_peer(state.handle, f"{state.address}:{params[0]}")
+            return Reply("Joined the swarm.")
+
+        if command == "/stats":
+            return Reply(json.dumps(self.stats()))
+
+        if command == "/join":
+            if state.joined:
+                return Error("Error: Already joined.")
+            self.sessions.join(state.session)
+            state.codec = self.negotiate_codec(params)
+            # A client offering "mux" gets a multiplexed connection, switched
+            # over right after this reply
+            state.multiplexed = self.multiplex and offered_mux(params)
+            state.checksums = protocol.offered_checksums(params)
+            message = "Joined the server successfully. mux" if state.multiplexed else "Joined the server successfully."
+            message = self.with_checksums(message, state.checksums)
+            state.joined = True
+            return Reply(self.with_codec(message, state.codec))
+
+        if command == "/leave":
+            if not state.joined:
+                return Error("Error: Not joined yet.")
+            self.close_session(state)
+            state.joined = False
+            state.registered = False
+            state.handle = None
+            return Reply("Left the server.")
+
+        return Error("Error: Command not found.")
+
+    def register_handle(self, state, handle):
+        if not self.sessions.reserve(state.session, handle):
+            return Error("Error: Registration failed. Handle or alias already exists.")
+        # Registered before the reply goes out: on a multiplexed connection
+        # the client's next request may already be running on another worker
+        state.handle = handle
+        state.registered = True
+        return Reply(f"Welcome {handle}!")
+
+    def close_session(self, state):
+        # Frees the handle and its tokens. A client's chunks go with its
+        # session, not with attached connections.
+        if self.swarm and state.registered and not state.attached:
+            self.swarm.remove_peer(state.handle)
+        self.sessions.release(state.session)
+
+    def negotiate_codec(self, params):
+        name = compression.negotiate(compression.offered_codecs(params))
+        return compression.get_codec(name) if name else None
+
+    def with_codec(self, message, codec):
+        # The chosen codec is announced as a trailing "codec=<name>"
+        return f"{message} codec={codec.name}" if codec else message
+
+    def with_checksums(self, message, checksums):
+        return f"{message} checksums" if checksums else message
+
+    def open_upload(self, state, filename, offset=None, total=None):
+        # "/store <file>" uploads a whole file, "/store <file> <offset> <total>"
+        # one range of it. Either way the data is only published under its
+        # final name once every byte has arrived, and with checksums only if
+        # it matches the checksum the client sent after it.
+        try:
+            if offset is not None:
+                offset, total = int(offset), int(total)
+            upload = self.store.open_upload(filename, offset, total)
+        except (OSError, ValueError, StorageError) as e:
+            self.log_message(f"Error: {str(e)}", ERROR)
+            return Error(f"Error: Failed to store file. {str(e)}", discard=True)
+        return Receive(upload, state.codec, state.checksums, state.handle)
+
+    def open_blob_upload(self, state, kind, name):
+        try:
+            upload = self.store.open_blob_upload(kind, name)
+        except (OSError, StorageError) as e:
+            return Error(f"Error: {str(e)}", discard=True)
+        return Receive(upload, state.codec, False, state.handle)
+
+    def receive_failed(self, upload, error):
+        # A checksum mismatch only refuses the upload. Anything else leaves
+        # the stream out of sync, so it is raised for the engine to drop the
+        # connection.
+        self.store.abort_upload(upload)
+        if not isinstance(error, protocol.ChecksumError):
+            raise error
+        self.log_message(f"Error: {upload.filename}: {str(error)}", ERROR)
+        return Error(f"Error: Failed to store file. {str(error)}")
+
+    def finish_receive(self, upload, received):
+        # Publishes the received data. It may wait for the disk and, when a
+        # ranged upload completes, reads the whole file once.
+        self.bytes_in.inc(received)
+        if upload.kind != 'file':
+            try:
+                message = self.store.finish_blob_upload(upload)
+            except (OSError, StorageError) as e:
+                return Error(f"Error: {str(e)}")
+            if upload.kind == 'manifest':
+                self.log_message(message)
+            return Reply(message)
+
+        try:
+            committed = self.store.finish_upload(upload, received)
+        except (OSError, StorageError) as e:
+            self.log_message(f"Error: {str(e)}", ERROR)
+            return Error(f"Error: Failed to store file. {str(e)}")
+        if committed:
+            self.log_message(f"File {upload.filename} stored successfully.")
+            return Reply(f"File {upload.filename} stored successfully.")
+        return Reply(f"Stored {received} bytes of {upload.filename} at offset {upload.offset}.")
+
+    def finish_blocks(self, upload):
+        # Whether finish_receive() may block, which event loop callers must
+        # know: durable modes wait for the disk, the last range of a file
+        # hashes (and may compress) all of it and a manifest is hashed from
+        # its chunks. A worker process waits for the others to reload the
+        # file it publishes.
+        return (self.store.durability.blocks or upload.partial is not None or upload.kind == 'manifest'
+                or self.sessions.blocks)
+
+    def execute_blocks(self, command, params):
+        # Whether execute() may block: in a worker process the session and
+        # swarm commands are round trips to the coordinator, and a range of
+        # a file kept compressed at rest is found by inflating all of the
+        # file before it
+        if command in SESSION_COMMANDS:
+            return self.sessions.blocks
+        if command == "/get" and len(params) >= 2 and params[1] == "swarm":
+            return self.swarm is not None and self.swarm.blocks
+        if command == "/peer":
+            return self.swarm is not None and self.swarm.blocks
+        if command == "/get" and len(params) >= 2 and params[1] != "0":
+            try:
+                return self.store.is_compressed(params[0])
+            except StorageError:
+                return False
+        return False
+
+    def pending_hash(self, state, command, params):
+        # The file execute() would read whole to hash before answering, or
+        # None. Only files found at startup are hashed on request.
+        if not state.registered or command not in ("/stat", "/get") or not params:
+            return None
+        chunks = False
+        if command == "/stat":
+            if len(params) != 1:
+                return None
+        elif len(params) >= 2 and params[1] == "swarm":
+            # The chunk map lists the hashes of the file's chunks
+            if self.swarm is None:
+                return None
+            chunks = True
+        elif not state.checksums or len(params) > 2 or (len(params) == 2 and params[1] != "0"):
+            # Ranges are sent without a checksum
+            return None
+        try:
+            return params[0] if self.store.needs_hashing(params[0], chunks) else None
+        except (OSError, StorageError):
+            return None
+
+    def directory_list(self, params):
+        # Served from the in-memory index and streamed in batches, so the
+        # size of the listing is only bounded by the requested page.
+        try:
+            listing = self.store.directory_listing(params)
+            header = next(listing)
+        except ValueError as e:
+            return Error(f"Error: {str(e)}")
+        return Listing(itertools.chain([header], listing))
+
+    def file_stat(self, filename):
+        try:
+            info = self.store.stat(filename)
+        except (OSError, StorageError) as e:
+            return Error(f"Error: {str(e)}")
+        return Reply(json.dumps(info))
+
+    def chunk_map(self, state, filename, params):
+        # "/get <file> swarm ..." tells a peer where to fetch the chunks of
+        # the file from; see swarm.py
+        if self.swarm is None:
+            return Error("Error: Swarm mode is off.")
+        if not self.swarm.is_peer(state.handle):
+            return Error("Error: Please join the swarm with /peer first.")
+        try:
+            known, have = parse_swarm_options(params)
+            size, checksum, hashes = self.store.chunk_hashes(filename)
+        except FileNotFoundError:
+            return Error(f"Error: File '{filename}' not found.")
+        except (OSError, ValueError, StorageError) as e:
+            return Error(f"Error: {str(e)}")
+        if known == checksum:
+            self.swarm.add_chunks(state.handle, checksum, have, len(hashes))
+        chunks, pending = self.swarm.chunk_map(state.handle, checksum, len(hashes))
+        reply = {'size': size, 'checksum': checksum, 'chunk_size': CHUNK_SIZE, 'chunks': chunks, 'pending': pending}
+        if known != checksum:
+            reply['hashes'] = hashes
+        return Reply(json.dumps(reply))
+
+    def open_download(self, state, filename, offset=0, length=None):
+        # "/get <file> [<offset> [<length>]]" sends the whole file or a range.
+        # Whole files are followed by their checksum if the client asked for
+        # it; it is hashed once and then kept by the store.
+        try:
+            offset = int(offset)
+            length = None if length is None else int(length)
+            whole = offset == 0 and length is None
+            checksum = self.store.checksum(filename) if state.checksums and whole else None
+            encoded = None
+            if state.codec is not None and whole:
+                encoded = self.store.open_encoded(filename, state.codec.name)
+            file, count = encoded or self.store.open_read(filename, offset, length)
+        except FileNotFoundError:
+            return Error(f"Error: File '{filename}' not found.")
+        except (OSError, ValueError, StorageError) as e:
+            self.log_message(f"Error: {str(e)}", ERROR)
+            return Error(f"Error: Failed to send file. {str(e)}")
+        # A file kept compressed at rest is read through a DecompressingReader
+        inflated = isinstance(file, compression.DecompressingReader)
+        return Send(filename, file, count, encoded is not None, state.codec, checksum, state.handle, inflated)
+
+    def compresses(self, send):
+        # Whether the file data goes out compressed with the client's codec.
+        # A file kept compressed at rest passed the test when it was stored;
+        # sampling it again would inflate its start twice, as seeking back
+        # restarts the reader. Anything else is test-compressed.
+        if send.encoded or send.codec is None:
+            return False
+        if send.inflated:
+            return compression.is_compressible(send.filename, send.count)
+        return compression.is_compressible(send.filename, send.count, send.file)
+
+    def stats(self):
+        return {
+            'cache': self.cache.stats() if self.cache else None,
+            'metrics': self.metrics.snapshot(),
+            'profiling': self.profiler.running,
+        }
+
+    def cache_metrics(self):
+        return {f"cache_{key}": value for key, value in self.cache.stats().items()}
+
+    def durability_metrics(self):
+        return {'disk_syncs': self.store.durability.syncs}
+
+    def swarm_metrics(self):
+        # Looked up on every read, a worker's tracker lives in the coordinator
+        return self.swarm.stats()
+
+    def start_metrics(self):
+        # The HTTP endpoint and the profiler run on their own threads, so
+        # they keep answering while the engine is busy
+        if self.metrics_port is not None:
+            from metrics_http import serve_metrics
+            serve_metrics(self.metrics, self.profiler, self.host, self.metrics_port, self.scheduler)
+            self.log_message(f"Metrics served on http://{self.host}:{self.metrics_port}/metrics")
+        if self.profile:
+            self.profiler.start()
+            atexit.register(self.write_profile)
+            self.log_message(f"Profiling, hot stacks are written to {self.profile} on exit")
+
+    def write_profile(self):
+        with open(self.profile, 'w') as file:
+            file.write(self.profiler.dump())
+
+    def update_users_text(self, count, handles):
+        # Coalesced change notification from the session registry
+        self.metrics.gauge('users', "Joined users").set(count)
+        if self.observer:
+            self.observer.update_users(handles)
@@ -0,0 +1,115 @@
+import ttkbootstrap as ttk
+from tkinter import font, scrolledtext
+from event_log import DISPLAY_LINES
+
+# How often new log lines and user changes are moved into the widgets
+LOG_POLL_MS = 200
+
+# Handles shown in the users label; the rest are summarized
+LIST_USERS_LIMIT = 20
+
+class ServerWindow:
+    # Tk front end for a server engine (ServerApp or AsyncServer). The
+    # engine runs on its own threads and reports back through update_users;
+    # log lines are collected by its event log and rendered here in batches
+    # on a timer, so server threads never touch the widget.
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.pending_users = None
+        self.init_gui()
+        engine.observer = self
+        engine.events.attach_display(DISPLAY_LINES)
+
+    def init_gui(self):
+        self.root = ttk.Window(themename="vapor")
+        self.style = ttk.Style()
+        self.set_default_font()
+
+        self.root.title("Server")
+        self.root.geometry('680x600')
+
+        # Main Frame
+        main_frame = ttk.Frame(self.root)
+        main_frame.pack(fill='both', expand=True, padx=10, pady=10)
+        main_frame.grid_rowconfigure(0, weight=1)
+        main_frame.grid_columnconfigure(0, weight=1)
+
+        # Connection Info Frame
+        self.conn_info_frame = ttk.LabelFrame(main_frame, text='Connection Information', padding=10)
+        self.conn_info_frame.grid(row=0, column=0, padx=10, pady=10, sticky='nsew')
+
+        # Log Frame
+        self.log_frame = ttk.LabelFrame(main_frame, text='Server Log', padding=10)
+        self.log_frame.grid(row=1, column=0, padx=10, pady=10, sticky='nsew')
+
+        # Labels and Entries
+        self.create_labels()
+        self.create_log_area()
+
+    def set_default_font(self, font_name='Helvetica', font_size=10, font_weight='bold'):
+        default_font = (font_name, font_size, font_weight)
+        
+        self.style.configure('TLabel', font=default_font)
+        self.style.configure('TButton', font=default_font)
+        self.style.configure('TEntry', font=default_font)
+        self.style.configure('TFrame', font=default_font)
+        self.style.configure('TCheckbutton', font=default_font)
+        self.style.configure('TRadiobutton', font=default_font)
+
+    def create_labels(self):
+        ttk.Label(self.conn_info_frame, text='Address', anchor='center', width=25).grid(row=1, column=1, ipadx=10, ipady=5)
+        ttk.Label(self.conn_info_frame, text='Port Number', anchor='center', width=25).grid(row=2, column=1, ipadx=10, ipady=5)
+        ttk.Label(self.conn_info_frame, text='Number of Users', anchor="center", width=25).grid(row=3, column=1, ipadx=10, ipady=5)
+        ttk.Label(self.conn_info_frame, text='List of Users', anchor='center', width=25).grid(row=4, column=1, ipadx=10, ipady=5)
+
+        self.address_label = ttk.Label(self.conn_info_frame, text=self.engine.host, bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
+        self.address_label.grid(row=1, column=2, ipadx=10, ipady=5)
+        
+        self.port_label = ttk.Label(self.conn_info_frame, text=self.engine.port, bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
+        self.port_label.grid(row=2, column=2, ipadx=10, ipady=5)
+        
+        self.number_users_label = ttk.Label(self.conn_info_frame, text="0", bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
+        self.number_users_label.grid(row=3, column=2, ipadx=10, ipady=5)
+        
+        self.list_users_label = ttk.Label(self.conn_info_frame, text=f"", bootstyle="inverse-primary", relief='sunken', anchor='center', width=25)
+        self.list_users_label.grid(row=4, column=2, ipadx=10, ipady=5)
+
+    def create_log_area(self):
+        self.log_area = scrolledtext.ScrolledText(self.log_frame, wrap='word', height=15, width=70)
+        self.log_area.pack(expand=True, fill='both')
+
+    def poll_log(self):
+        lines = self.engine.events.lines()
+        if lines:
+            self.log_area.configure(state='normal')  # Enable editing
+            self.log_area.insert('end', '\n'.join(lines) + '\n')
+            # Keep only the newest DISPLAY_LINES lines
+            excess = int(self.log_area.index('end-1c').split('.')[0]) - 1 - DISPLAY_LINES
+            if excess > 0:
+                self.log_area.delete('1.0', f'{excess + 1}.0')
+            self.log_area.yview('end')
+            self.log_area.configure(state='disabled')  # Disable editing
+        handles, self.pending_users = self.pending_users, None
+        if handles is not None:
+            self.show_users(handles)
+        self.root.after(LOG_POLL_MS, self.poll_log)
+
+    def update_users(self, handles):
+        # Called by the session registry's notifier thread with the latest
+        # handles; only the newest list is kept until the next poll
+        self.pending_users = handles
+
+    def show_users(self, handles):
+        # The count comes from the engine's metrics, like /stats reports it
+        self.number_users_label.config(text=self.engine.metrics.value('users'))
+        text = "\n".join(sorted(handles)[:LIST_USERS_LIMIT])
+        if len(handles) > LIST_USERS_LIMIT:
+            text += f"\n... and {len(handles) - LIST_USERS_LIMIT} more"
+        self.list_users_label.config(text=text)
+
+    def run(self):
+        self.engine.start_server()
+        self.port_label.config(text=self.engine.port)
+        self.root.after(LOG_POLL_MS, self.poll_log)
+        self.root.mainloop()
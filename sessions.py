@@ -0,0 +1,112 @@
+import secrets
+import threading
+
+# Changes arriving within this many seconds are reported as one notification
+NOTIFY_DELAY = 0.1
+
+
+class SessionRegistry:
+    # Joined sessions (one per client connection) and the handles they
+    # registered. Both directions are indexed, so joining, reserving a
+    # handle, resolving a session token and leaving are O(1) however many
+    # users are connected. All methods are safe to call from any thread.
+    #
+    # Sessions are usually client sockets; a multi-process server keys them
+    # by strings naming the worker and its connection instead.
+    #
+    # Listeners are not called on every change: the first change starts a
+    # timer and everything that happens until it fires is reported once,
+    # with the number of joined sessions and the registered handles.
+    #
+    # `blocks` tells event loop callers whether the methods may block, as
+    # coordinator.CoordinatorClient's do.
+    blocks = False
+
+    def __init__(self, notify_delay=NOTIFY_DELAY):
+        self.lock = threading.Lock()
+        self.sessions = {}  # session -> handle (None until registered)
+        self.owners = {}    # handle -> session
+        self.tokens = {}    # token -> handle
+        self.handle_tokens = {}  # handle -> set of its tokens
+        self.notify_delay = notify_delay
+        self.listeners = []
+        self.timer = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def join(self, session):
+        with self.lock:
+            self.sessions.setdefault(session, None)
+        self.changed()
+
+    def reserve(self, session, handle):
+        # Claims the handle for the session; False if another session has it
+        with self.lock:
+            owner = self.owners.get(handle)
+            if owner is not None and owner != session:
+                return False
+            previous = self.sessions.get(session)
+            if previous is not None and previous != handle:
+                self.drop_handle(previous)
+            self.sessions[session] = handle
+            self.owners[handle] = session
+        self.changed()
+        return True
+
+    def release(self, session):
+        # The session left or disconnected: its handle and tokens are freed
+        with self.lock:
+            if session not in self.sessions:
+                return
+            handle = self.sessions.pop(session)
+            if handle is not None:
+                self.drop_handle(handle)
+        self.changed()
+
+    def drop_handle(self, handle):
+        # Called with the lock held
+        self.owners.pop(handle, None)
+        for token in self.handle_tokens.pop(handle, ()):
+            self.tokens.pop(token, None)
+
+    def handle_of(self, session):
+        return self.sessions.get(session)
+
+    def session_of(self, handle):
+        return self.owners.get(handle)
+
+    def issue_token(self, handle):
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.tokens[token] = handle
+            self.handle_tokens.setdefault(handle, set()).add(token)
+        return token
+
+    def resolve_token(self, token):
+        return self.tokens.get(token)
+
+    def handles(self):
+        with self.lock:
+            return list(self.owners)
+
+    def subscribe(self, listener):
+        # listener(count, handles) is called from a timer thread
+        self.listeners.append(listener)
+
+    def changed(self):
+        if not self.listeners:
+            return
+        with self.lock:
+            if self.timer is not None:
+                return
+            self.timer = threading.Timer(self.notify_delay, self.notify)
+            self.timer.daemon = True
+        self.timer.start()
+
+    def notify(self):
+        with self.lock:
+            self.timer = None
+            count, handles = len(self.sessions), list(self.owners)
+        for listener in self.listeners:
+            listener(count, handles)
@@ -0,0 +1,1214 @@
+import bisect
+import fnmatch
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+from collections import namedtuple
+from operator import attrgetter
+from cache import MemoryFile
+from compression import CompressingWriter, DecompressingReader, get_codec, is_compressible
+from durability import Durability
+
+try:
+    import fcntl
+except ImportError:  # Windows, which has no multi-process server mode
+    fcntl = None
+
+class StorageError(Exception):
+    pass
+
+
+FileEntry = namedtuple('FileEntry', ['name', 'size', 'mtime', 'checksum'])
+
+CHECKSUM_ALGORITHM = 'sha256'
+DIR_BATCH_SIZE = 256
+BLOB_CHUNK_SIZE = 1024 * 1024
+# Uploads reach the disk in writes of this size, whatever the frame size
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+def stream_checksum(file):
+    digest = hashlib.new(CHECKSUM_ALGORITHM)
+    while chunk := file.read(1024 * 1024):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_hashes(file, chunk_size=BLOB_CHUNK_SIZE):
+    # The checksum of a whole file and the hashes of its chunks, in one pass
+    digest = hashlib.new(CHECKSUM_ALGORITHM)
+    hashes = []
+    while data := file.read(chunk_size):
+        digest.update(data)
+        hashes.append(hashlib.new(CHECKSUM_ALGORITHM, data).hexdigest())
+    return digest.hexdigest(), hashes
+
+
+def iter_chunks(file, chunk_size=BLOB_CHUNK_SIZE):
+    # Yields (digest, offset, length) for every fixed-size chunk of a file,
+    # as the deduplicating store would cut it.
+    offset = 0
+    while data := file.read(chunk_size):
+        yield hashlib.new(CHECKSUM_ALGORITHM, data).hexdigest(), offset, len(data)
+        offset += len(data)
+
+
+def parse_query(params):
+    # /dir options: prefix=<text> glob=<pattern> sort=name|size|mtime desc
+    # offset=<n> limit=<n>
+    options = {}
+    for param in params:
+        key, _, value = param.partition('=')
+        if key in ('prefix', 'glob'):
+            options[key] = value
+        elif key == 'sort' and value in FileIndex.SORT_KEYS:
+            options['sort'] = value
+        elif key == 'desc' and not value:
+            options['descending'] = True
+        elif key in ('offset', 'limit') and value.isdigit():
+            options[key] = int(value)
+        else:
+            raise ValueError(f"Unknown /dir option '{param}'.")
+    return options
+
+
+class FileIndex:
+    # In-memory view of the stored files. It is built once from the
+    # directory at startup and then kept current by FileStore, so /dir
+    # never has to scan files_directory.
+    SORT_KEYS = ('name', 'size', 'mtime')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rebuild(self, directory):
+        entries = {}
+        with os.scandir(directory) as scan:
+            for item in scan:
+                if item.name.startswith('.') or not item.is_file():
+                    continue
+                info = item.stat()
+                entries[item.name] = FileEntry(item.name, info.st_size, info.st_mtime, None)
+        with self.lock:
+            self.entries = entries
+            self.names = sorted(entries)
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def update(self, name, size, mtime, checksum=None):
+        with self.lock:
+            if name not in self.entries:
+                bisect.insort(self.names, name)
+            self.entries[name] = FileEntry(name, size, mtime, checksum)
+
+    def set_checksum(self, name, size, mtime, checksum):
+        # Only applies when the file has not been replaced in the meantime
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry and entry.size == size and entry.mtime == mtime:
+                self.entries[name] = entry._replace(checksum=checksum)
+
+    def remove(self, name):
+        with self.lock:
+            if self.entries.pop(name, None):
+                del self.names[bisect.bisect_left(self.names, name)]
+
+    def query(self, prefix='', glob=None, sort='name', descending=False, offset=0, limit=None):
+        # Returns (total matches, requested page of FileEntry)
+        with self.lock:
+            low, high = 0, len(self.names)
+            if prefix:
+                low = bisect.bisect_left(self.names, prefix)
+                high = bisect.bisect_left(self.names, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+            entries = [self.entries[name] for name in self.names[low:high]
+                       if glob is None or fnmatch.fnmatchcase(name, glob)]
+        if sort != 'name':
+            entries.sort(key=attrgetter(sort), reverse=descending)
+        elif descending:
+            entries.reverse()
+        end = None if limit is None else offset + limit
+        return len(entries), entries[offset:end]
+
+
+class HashingWriter:
+    # File wrapper that hashes whatever is written through it, so uploads
+    # get a checksum without a second pass over the data.
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.new(CHECKSUM_ALGORITHM)
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+class HashingReader:
+    # Counterpart of HashingWriter for the sending side: whatever is read
+    # through it is hashed, so a transfer can end with its checksum.
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.new(CHECKSUM_ALGORITHM)
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.digest.update(data)
+        return data
+
+    def readinto(self, buffer):
+        count = self.file.readinto(buffer)
+        self.digest.update(memoryview(buffer)[:count])
+        return count
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def merge_range(ranges, start, end):
+    # Adds [start, end) to a sorted list of disjoint ranges
+    merged = []
+    for low, high in ranges:
+        if high < start or low > end:
+            merged.append([low, high])
+        else:
+            start, end = min(start, low), max(end, high)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+
+def missing_ranges(ranges, total):
+    missing = []
+    position = 0
+    for low, high in ranges:
+        if low > position:
+            missing.append((position, low))
+        position = max(position, high)
+    if position < total:
+        missing.append((position, total))
+    return missing
+
+
+class ProcessLock:
+    # A thread lock that also excludes other processes, with flock() on a
+    # path they all open. Multi-process servers use it for partial uploads,
+    # whose ranges may arrive at different worker processes.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            self.lock.release()
+            raise
+        self.fd = fd
+        return self
+
+    def __exit__(self, *exc_info):
+        # Closing the descriptor releases the flock
+        fd, self.fd = self.fd, None
+        os.close(fd)
+        self.lock.release()
+
+
+class RangeWriter:
+    # The data file of a PartialFile, opened at the offset of one range. It
+    # refuses to write past the end of the file, so an overlong range never
+    # reaches the disk.
+
+    def __init__(self, file, limit):
+        self.file = file
+        self.limit = limit
+
+    def write(self, data):
+        if len(data) > self.limit:
+            raise StorageError("Range runs past the end of the file.")
+        self.limit -= len(data)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PartialFile:
+    # A file filled in by byte ranges, possibly out of order and over several
+    # connections. Received ranges are kept in a small JSON sidecar so an
+    # interrupted transfer can pick up where it stopped; once every byte is
+    # present the data is renamed onto the final path in one step, so
+    # readers never see a half-written file.
+
+    #
+    # With a ProcessLock as `lock`, other processes may record ranges of the
+    # same file, so the state on disk is re-read under the lock every time.
+
+    def __init__(self, final_path, total, data_path=None, state_path=None, durability=None, lock=None):
+        self.final_path = final_path
+        self.total = total
+        self.data_path = data_path or final_path + '.part'
+        self.state_path = state_path or final_path + '.ranges'
+        self.durability = durability or Durability()
+        self.lock = lock or threading.Lock()
+        self.shared = lock is not None
+        self.published = False
+        self.inode = None
+        with self.lock:
+            self.ranges = self.load()
+
+    @staticmethod
+    def read_state(state_path):
+        try:
+            with open(state_path) as state:
+                return json.load(state)
+        except (OSError, ValueError):
+            return None
+
+    def load(self):
+        state = self.read_state(self.state_path)
+        if (state and state.get('total') == self.total and os.path.exists(self.data_path)
+                and os.path.getsize(self.data_path) == self.total):
+            self.inode = os.stat(self.data_path).st_ino
+            return state['ranges']
+
+        # Nothing usable to resume from, start over
+        with open(self.data_path, 'wb') as file:
+            file.truncate(self.total)
+            self.inode = os.fstat(file.fileno()).st_ino
+        self.save([])
+        return []
+
+    def refresh(self):
+        # Picks up ranges recorded by other processes. The file counts as
+        # published once its data file is gone or was started over.
+        try:
+            inode = os.stat(self.data_path).st_ino
+        except FileNotFoundError:
+            inode = None
+        state = self.read_state(self.state_path)
+        if inode != self.inode or not state:
+            self.published = True
+        else:
+            self.ranges = state['ranges']
+
+    def save(self, ranges):
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as state:
+            json.dump({'total': self.total, 'ranges': ranges}, state)
+        os.replace(temp_path, self.state_path)
+
+    def open(self, offset):
+        # Returns a RangeWriter at `offset`, or None once the file has been
+        # published
+        if not 0 <= offset <= self.total:
+            raise StorageError(f"Offset {offset} is outside of the file.")
+        with self.lock:
+            if self.shared:
+                self.refresh()
+            if self.published:
+                return None
+            file = open(self.data_path, 'r+b', buffering=WRITE_BUFFER_SIZE)
+        file.seek(offset)
+        return RangeWriter(file, self.total - offset)
+
+    def missing(self):
+        with self.lock:
+            if self.shared:
+                self.refresh()
+            return missing_ranges(self.ranges, self.total)
+
+    def is_complete(self):
+        return self.total == 0 or self.ranges == [[0, self.total]]
+
+    def record(self, offset, count):
+        # Marks [offset, offset + count) as received. Returns True once the
+        # file is complete and has been moved to its final path.
+        if offset + count > self.total:
+            raise StorageError("Range runs past the end of the file.")
+        # Only ranges that are on disk may be remembered as received
+        try:
+            self.durability.sync(files=[self.data_path])
+        except FileNotFoundError:
+            # Already published by another connection
+            pass
+        with self.lock:
+            if self.shared:
+                self.refresh()
+            if self.published:
+                # Another connection finished the file while this range was
+                # in flight
+                return False
+            self.ranges = merge_range(self.ranges, offset, offset + count)
+            if not self.is_complete():
+                self.save(self.ranges)
+                return False
+            os.replace(self.data_path, self.final_path)
+            self.durability.sync(directories=[os.path.dirname(self.final_path)])
+            self.published = True
+            try:
+                os.remove(self.state_path)
+            except FileNotFoundError:
+                pass
+            return True
+
+
+class Upload:
+    def __init__(self, filename, file, offset=None, temp_path=None, partial=None, kind='file', codec=None):
+        self.filename = filename
+        self.file = file
+        self.offset = offset
+        self.temp_path = temp_path
+        self.partial = partial
+        self.kind = kind
+        self.codec = codec
+
+
+class FileStore:
+    # Everything the server engines do with files_directory. Uploads are
+    # written next to the final file and renamed into place when complete;
+    # ranged uploads additionally remember which bytes have arrived.
+    #
+    # With compress_at_rest set to a codec name, uploads of compressible
+    # files are stored compressed. A JSON sidecar in .compressed records the
+    # codec and the original size and checksum. Ranged uploads are
+    # compressed in one pass once their last range has arrived.
+    #
+    # durability (see durability.py) decides whether a published file is
+    # also on disk before finish_upload returns.
+    #
+    # Several processes may share files_directory: listeners learn about
+    # every file this store publishes, and reload() picks up a file another
+    # process published.
+    #
+    # Checksums are kept in .checksums along with the size and mtime they
+    # were taken at, so a restart or another worker never hashes a file
+    # again; a record whose file changed since is ignored. Swarm downloads
+    # also need the hashes of the file's chunks, which go in the same
+    # record. Uploads are recorded as they are published; only files found
+    # at startup are hashed on first request, one caller at a time per
+    # file, and needs_hashing() tells event loop callers to do it on their
+    # executor first.
+    PARTIAL_DIRECTORY = '.partial'
+    COMPRESSED_DIRECTORY = '.compressed'
+    CHECKSUM_DIRECTORY = '.checksums'
+    deduplicates = False
+
+    def __init__(self, files_directory, cache=None, compress_at_rest=None, durability=None):
+        self.files_directory = files_directory
+        self.cache = cache
+        self.compress_at_rest = compress_at_rest
+        self.durability = durability or Durability()
+        if compress_at_rest:
+            get_codec(compress_at_rest)
+        self.partial_directory = os.path.join(files_directory, self.PARTIAL_DIRECTORY)
+        self.compressed_directory = os.path.join(files_directory, self.COMPRESSED_DIRECTORY)
+        self.checksum_directory = os.path.join(files_directory, self.CHECKSUM_DIRECTORY)
+        os.makedirs(self.partial_directory, exist_ok=True)
+        os.makedirs(self.compressed_directory, exist_ok=True)
+        os.makedirs(self.checksum_directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.partials = {}
+        self.partial_lock = None  # a ProcessLock when processes share the partials
+        self.listeners = []
+        self.compressed = {}
+        self.hashing = {}  # name -> (lock, callers) of the files being hashed
+        self.index = FileIndex()
+        self.rebuild_index()
+        self.load_checksums()
+
+    def load_checksums(self):
+        for name in os.listdir(self.checksum_directory):
+            entry = self.index.get(name)
+            checksum = self.read_checksum(entry) if entry else None
+            if checksum is None:
+                os.remove(os.path.join(self.checksum_directory, name))
+            elif entry.checksum is None:
+                self.index.set_checksum(name, entry.size, entry.mtime, checksum)
+
+    def read_checksum(self, entry, key='checksum'):
+        # The persisted checksum (or chunk hashes) of this version of the
+        # file, if any
+        try:
+            with open(os.path.join(self.checksum_directory, entry.name)) as file:
+                record = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if record.get('size') != entry.size or record.get('mtime') != entry.mtime:
+            return None
+        return record.get(key)
+
+    def save_checksum(self, name, size, mtime, checksum, chunks=None):
+        record = {'size': size, 'mtime': mtime, 'checksum': checksum}
+        if chunks is not None:
+            record['chunks'] = chunks
+        fd, temp_path = tempfile.mkstemp(dir=self.partial_directory, prefix=name + '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(record, file)
+        os.replace(temp_path, os.path.join(self.checksum_directory, name))
+
+    def rebuild_index(self):
+        self.index.rebuild(self.files_directory)
+        self.compressed = {}
+        for name in os.listdir(self.compressed_directory):
+            entry = self.index.get(name)
+            info = self.read_compressed_info(name)
+            # A sidecar whose file was replaced or removed no longer applies
+            if entry is None or info is None or info.get('stored_size') != entry.size:
+                os.remove(os.path.join(self.compressed_directory, name))
+                continue
+            self.compressed[name] = info
+            self.index.update(name, info['size'], entry.mtime, info.get('checksum'))
+
+    def read_compressed_info(self, name):
+        try:
+            with open(os.path.join(self.compressed_directory, name)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def set_compressed_info(self, name, info):
+        # info is None for a file stored as is
+        info_path = os.path.join(self.compressed_directory, name)
+        if info is None:
+            with self.lock:
+                if self.compressed.pop(name, None) is None:
+                    return
+            try:
+                os.remove(info_path)
+            except FileNotFoundError:
+                pass
+            self.durability.sync(directories=[self.compressed_directory])
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self.partial_directory, prefix=name + '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(info, file)
+        # The sidecar must be on disk before the compressed file it describes
+        self.durability.sync(files=[temp_path])
+        os.replace(temp_path, info_path)
+        self.durability.sync(directories=[self.compressed_directory])
+        with self.lock:
+            self.compressed[name] = info
+
+    def path(self, filename):
+        name = os.path.basename(filename)
+        if not name or name.startswith('.'):
+            raise StorageError(f"Invalid file name '{filename}'.")
+        return os.path.join(self.files_directory, name)
+
+    def directory_listing(self, params, batch_size=DIR_BATCH_SIZE):
+        # Yields the /dir response: a JSON header with the number of matches,
+        # then the requested page as batches of JSON lines.
+        options = parse_query(params)
+        total, entries = self.index.query(**options)
+        yield json.dumps({'total': total, 'offset': options.get('offset', 0), 'count': len(entries)}).encode()
+        for start in range(0, len(entries), batch_size):
+            batch = entries[start:start + batch_size]
+            yield "\n".join(json.dumps(entry._asdict()) for entry in batch).encode()
+
+    def checksum(self, filename):
+        entry = self.index.get(os.path.basename(self.path(filename)))
+        if entry is None:
+            raise FileNotFoundError(f"File '{filename}' not found.")
+        if entry.checksum is None:
+            checksum = self.read_checksum(entry)
+            if checksum is None:
+                return self.hash_file(filename)[0]
+            self.index.set_checksum(entry.name, entry.size, entry.mtime, checksum)
+            return checksum
+        return entry.checksum
+
+    def chunk_hashes(self, filename):
+        # Returns (size, checksum, hashes), hashes being the SHA-256 of every
+        # BLOB_CHUNK_SIZE chunk of the file
+        entry = self.index.get(os.path.basename(self.path(filename)))
+        if entry is None:
+            raise FileNotFoundError(f"File '{filename}' not found.")
+        hashes = self.read_checksum(entry, 'chunks')
+        if hashes is None:
+            checksum, hashes = self.hash_file(filename)
+            return entry.size, checksum, hashes
+        return entry.size, self.checksum(filename), hashes
+
+    def needs_hashing(self, filename, chunks=False):
+        # Whether checksum(), or chunk_hashes() with `chunks`, would read the
+        # whole file now
+        entry = self.index.get(os.path.basename(self.path(filename)))
+        if entry is None:
+            return False
+        if chunks:
+            return self.read_checksum(entry, 'chunks') is None
+        return (entry.checksum or self.read_checksum(entry)) is None
+
+    def hash_file(self, filename):
+        # Reads the file once for its checksum and chunk hashes and records
+        # both. Callers hashing the same file meanwhile wait for the first
+        # one and take its record.
+        name = os.path.basename(self.path(filename))
+        with self.lock:
+            lock, callers = self.hashing.get(name, (None, 0))
+            lock = lock or threading.Lock()
+            self.hashing[name] = (lock, callers + 1)
+        try:
+            with lock:
+                entry = self.index.get(name)
+                if entry is None:
+                    raise FileNotFoundError(f"File '{filename}' not found.")
+                hashes = self.read_checksum(entry, 'chunks')
+                checksum = self.read_checksum(entry)
+                if hashes is None or checksum is None:
+                    file, _ = self.open_uncached(filename)
+                    with file:
+                        checksum, hashes = file_hashes(file)
+                    self.save_checksum(entry.name, entry.size, entry.mtime, checksum, hashes)
+                self.index.set_checksum(entry.name, entry.size, entry.mtime, checksum)
+                return checksum, hashes
+        finally:
+            with self.lock:
+                lock, callers = self.hashing[name]
+                if callers == 1:
+                    del self.hashing[name]
+                else:
+                    self.hashing[name] = (lock, callers - 1)
+
+    def known_checksum(self, filename):
+        # Like checksum(), but None instead of hashing the file now
+        entry = self.index.get(os.path.basename(self.path(filename)))
+        if entry is None:
+            return None
+        return entry.checksum or self.read_checksum(entry)
+
+    def partial_paths(self, filename):
+        name = os.path.basename(self.path(filename))
+        return (os.path.join(self.partial_directory, name + '.part'),
+                os.path.join(self.partial_directory, name + '.ranges'))
+
+    def stat(self, filename):
+        file_path = self.path(filename)
+        info = {'name': os.path.basename(file_path)}
+        entry = self.index.get(info['name'])
+        if entry:
+            info['size'] = entry.size
+            info['mtime'] = entry.mtime
+            info['checksum'] = self.checksum(filename)
+            compressed = self.compressed.get(info['name'])
+            if compressed:
+                # Whole downloads with this codec get the stored bytes as they are
+                info['codec'] = compressed['codec']
+        state = PartialFile.read_state(self.partial_paths(filename)[1])
+        if state:
+            info['partial'] = state
+        if len(info) == 1:
+            raise FileNotFoundError(f"File '{filename}' not found.")
+        return info
+
+    def open_read(self, filename, offset=0, length=None):
+        # Returns (file, count) with the file positioned at offset
+        if self.cache is not None:
+            cached = self.open_cached(filename, offset, length)
+            if cached:
+                return cached
+        return self.open_uncached(filename, offset, length)
+
+    def open_uncached(self, filename, offset=0, length=None):
+        file_path = self.path(filename)
+        file = open(file_path, 'rb')
+        info = self.compressed.get(os.path.basename(file_path))
+        if info is None:
+            size = os.fstat(file.fileno()).st_size
+        else:
+            file = DecompressingReader(file, get_codec(info['codec']), info['size'])
+            size = info['size']
+        if not 0 <= offset <= size:
+            file.close()
+            raise StorageError(f"Offset {offset} is outside of the file.")
+        count = size - offset if length is None else min(length, size - offset)
+        file.seek(offset)
+        return file, count
+
+    def open_cached(self, filename, offset, length):
+        name = os.path.basename(self.path(filename))
+        entry = self.index.get(name)
+        if entry is None or not self.cache.admits(entry.size):
+            return None
+        version = (entry.size, entry.mtime)
+        view = self.cache.get(name, version)
+        if view is None:
+            buffer = self.load_buffer(filename, entry.size)
+            if buffer is None:
+                return None
+            view = self.cache.put(name, version, buffer)
+        if not 0 <= offset <= len(view):
+            raise StorageError(f"Offset {offset} is outside of the file.")
+        end = len(view) if length is None else min(len(view), offset + length)
+        return MemoryFile(view[offset:end]), end - offset
+
+    def is_compressed(self, filename):
+        # Whether the file is kept compressed at rest
+        return os.path.basename(self.path(filename)) in self.compressed
+
+    def open_encoded(self, filename, codec):
+        # Returns (file, stored size) when the file is kept compressed with
+        # `codec`, so its stored bytes can be sent as they are; else None
+        file_path = self.path(filename)
+        info = self.compressed.get(os.path.basename(file_path))
+        if info is None or info['codec'] != codec:
+            return None
+        file = open(file_path, 'rb')
+        return file, os.fstat(file.fileno()).st_size
+
+    def load_buffer(self, filename, size):
+        # Files compressed at rest go out straight from disk
+        if os.path.basename(self.path(filename)) in self.compressed:
+            return None
+        # Ready-to-send bytes for small files, a shared mmap for large ones
+        with open(self.path(filename), 'rb') as file:
+            if size <= self.cache.small_file_limit:
+                return file.read()
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def open_upload(self, filename, offset=None, total=None):
+        final_path = self.path(filename)
+        if offset is None:
+            return self.new_upload(filename)
+
+        if total < 0:
+            raise StorageError("Total size cannot be negative.")
+        while True:
+            with self.lock:
+                partial = self.partials.get(final_path)
+                if partial is None or partial.total != total or partial.published:
+                    data_path, state_path = self.partial_paths(filename)
+                    partial = PartialFile(self.completed_path(filename), total, data_path, state_path,
+                                          self.durability, self.partial_lock)
+                    self.partials[final_path] = partial
+            # A partial completed by another upload meanwhile starts over
+            file = partial.open(offset)
+            if file is not None:
+                # Hashed like whole uploads, for the checksum trailer of the range
+                return Upload(filename, HashingWriter(file), offset=offset, partial=partial)
+
+    def new_upload(self, filename):
+        fd, temp_path = tempfile.mkstemp(dir=self.partial_directory,
+                                         prefix=os.path.basename(self.path(filename)) + '.', suffix='.tmp')
+        file = os.fdopen(fd, 'wb', buffering=WRITE_BUFFER_SIZE)
+        if self.compress_at_rest and is_compressible(filename):
+            # The checksum is taken over the original bytes
+            file = CompressingWriter(file, get_codec(self.compress_at_rest))
+            return Upload(filename, HashingWriter(file), temp_path=temp_path, codec=self.compress_at_rest)
+        return Upload(filename, HashingWriter(file), temp_path=temp_path)
+
+    def completed_path(self, filename):
+        # Where a ranged upload lands once its last range has arrived. Files
+        # to be compressed wait next to the partials for publish_completed.
+        if self.compress_at_rest and is_compressible(filename):
+            return os.path.join(self.partial_directory, os.path.basename(self.path(filename)) + '.done')
+        return self.path(filename)
+
+    def finish_upload(self, upload, received):
+        # Returns True when the file has been published under its final name
+        upload.file.close()
+        if upload.partial is None:
+            self.publish_upload(upload)
+            return True
+
+        committed = upload.partial.record(upload.offset, received)
+        if committed:
+            with self.lock:
+                if self.partials.get(self.path(upload.filename)) is upload.partial:
+                    del self.partials[self.path(upload.filename)]
+            self.publish_completed(upload.filename, upload.partial.final_path)
+        return committed
+
+    def publish_upload(self, upload):
+        final_path = self.path(upload.filename)
+        name = os.path.basename(final_path)
+        checksum = upload.file.hexdigest()
+        if upload.codec is None:
+            self.durability.sync(files=[upload.temp_path])
+            os.replace(upload.temp_path, final_path)
+            self.durability.sync(directories=[self.files_directory])
+            self.set_compressed_info(name, None)
+            self.index_file(final_path, checksum)
+            return
+        info = {'codec': upload.codec, 'size': upload.file.size,
+                'stored_size': os.path.getsize(upload.temp_path), 'checksum': checksum}
+        self.durability.sync(files=[upload.temp_path])
+        self.set_compressed_info(name, info)
+        os.replace(upload.temp_path, final_path)
+        self.durability.sync(directories=[self.files_directory])
+        self.file_updated(name, info['size'], os.path.getmtime(final_path), checksum)
+
+    def publish_completed(self, filename, file_path):
+        # Ranges arrive out of order, so the file is hashed once complete
+        if file_path == self.path(filename):
+            with open(file_path, 'rb') as file:
+                checksum, hashes = file_hashes(file)
+            self.set_compressed_info(os.path.basename(file_path), None)
+            self.index_file(file_path, checksum, hashes)
+            return
+        # Compressed and published like a whole upload
+        upload = self.new_upload(filename)
+        try:
+            with open(file_path, 'rb') as file, upload.file:
+                while data := file.read(WRITE_BUFFER_SIZE):
+                    upload.file.write(data)
+        except Exception:
+            self.abort_upload(upload)
+            raise
+        self.publish_upload(upload)
+        os.remove(file_path)
+
+    def index_file(self, file_path, checksum=None, chunks=None):
+        info = os.stat(file_path)
+        self.file_updated(os.path.basename(file_path), info.st_size, info.st_mtime, checksum, chunks)
+
+    def file_updated(self, name, size, mtime, checksum=None, chunks=None):
+        if checksum:
+            self.save_checksum(name, size, mtime, checksum, chunks)
+        self.index.update(name, size, mtime, checksum)
+        if self.cache is not None:
+            self.cache.invalidate(name)
+        for listener in self.listeners:
+            listener(name, checksum)
+
+    def subscribe(self, listener):
+        # listener(name, checksum) is called after a file was published
+        self.listeners.append(listener)
+
+    def reload(self, name, checksum=None):
+        # Another process published the file; read its new state from disk
+        info = self.read_compressed_info(name)
+        with self.lock:
+            if info is None:
+                self.compressed.pop(name, None)
+            else:
+                self.compressed[name] = info
+        try:
+            stat = os.stat(os.path.join(self.files_directory, name))
+        except FileNotFoundError:
+            self.index.remove(name)
+        else:
+            size = info['size'] if info else stat.st_size
+            self.index.update(name, size, stat.st_mtime, checksum)
+        if self.cache is not None:
+            self.cache.invalidate(name)
+
+    def abort_upload(self, upload):
+        # Bytes of a ranged upload stay on disk but are not recorded, so
+        # the range is simply sent again on resume.
+        upload.file.close()
+        if upload.temp_path:
+            try:
+                os.remove(upload.temp_path)
+            except FileNotFoundError:
+                pass
+
+    # Chunk and manifest uploads only exist on the deduplicating store
+
+    def missing_chunks(self, digests):
+        raise StorageError("Deduplication is not enabled on this server.")
+
+    def open_blob_upload(self, kind, name):
+        raise StorageError("Deduplication is not enabled on this server.")
+
+    def finish_blob_upload(self, upload):
+        raise StorageError("Deduplication is not enabled on this server.")
+
+
+class ChunkWriter:
+    # Cuts whatever is written into fixed-size chunks and hands each one to
+    # the store, which keeps a single copy per distinct chunk.
+
+    def __init__(self, store):
+        self.store = store
+        self.buffer = bytearray()
+        self.chunks = []
+        self.written = []  # paths of the chunks this upload added
+        self.size = 0
+        self.digest = hashlib.new(CHECKSUM_ALGORITHM)
+
+    def write(self, data):
+        self.digest.update(data)
+        self.buffer += data
+        self.size += len(data)
+        chunk_size = self.store.chunk_size
+        while len(self.buffer) >= chunk_size:
+            self.add_chunk(bytes(self.buffer[:chunk_size]))
+            del self.buffer[:chunk_size]
+        return len(data)
+
+    def add_chunk(self, data):
+        digest = hashlib.new(CHECKSUM_ALGORITHM, data).hexdigest()
+        if self.store.put_chunk(digest, data):
+            self.written.append(self.store.chunk_path(digest))
+        self.chunks.append([digest, len(data)])
+
+    def close(self):
+        if self.buffer:
+            self.add_chunk(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def manifest(self):
+        return {'size': self.size, 'checksum': self.hexdigest(), 'chunks': self.chunks}
+
+
+class ChunkReader:
+    # Read-only file object over (path, offset, length) segments, used to
+    # serve a manifest as if it were one file.
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.starts = []
+        self.size = 0
+        for _, _, length in parts:
+            self.starts.append(self.size)
+            self.size += length
+        self.position = 0
+        self.current = None
+        self.current_index = -1
+
+    def segments(self):
+        # Lets protocol.send_stream hand every chunk to sendfile in turn
+        for path, offset, length in self.parts:
+            with open(path, 'rb') as file:
+                yield file, offset, length
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position += self.size
+        self.position = max(0, min(position, self.size))
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        pieces = []
+        while size > 0 and self.position < self.size:
+            index, skip = self.locate(self.position)
+            path, offset, length = self.parts[index]
+            if index != self.current_index:
+                self.close()
+                self.current = open(path, 'rb')
+                self.current_index = index
+            self.current.seek(offset + skip)
+            data = self.current.read(min(size, length - skip))
+            if not data:
+                break
+            pieces.append(data)
+            self.position += len(data)
+            size -= len(data)
+        return b''.join(pieces)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def locate(self, position):
+        index = bisect.bisect_right(self.starts, position) - 1
+        return index, position - self.starts[index]
+
+    def close(self):
+        if self.current:
+            self.current.close()
+            self.current = None
+            self.current_index = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BoundedBuffer:
+    # In-memory upload target for small payloads such as manifests
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+
+    def write(self, data):
+        if len(self.data) + len(data) > self.limit:
+            raise StorageError("Upload is larger than allowed.")
+        self.data += data
+        return len(data)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class ChunkStore(FileStore):
+    # Content-addressed variant of FileStore. File contents are cut into
+    # chunks kept once under their SHA-256 in .chunks, and a stored name is
+    # a JSON manifest in .manifests listing its chunks, so repeated and
+    # near-duplicate uploads take (almost) no extra space. Plain files left
+    # in files_directory from before are still served.
+    CHUNK_DIRECTORY = '.chunks'
+    MANIFEST_DIRECTORY = '.manifests'
+    MAX_MANIFEST_SIZE = 64 * 1024 * 1024
+    deduplicates = True
+
+    def __init__(self, files_directory, cache=None, chunk_size=BLOB_CHUNK_SIZE, durability=None):
+        self.chunk_size = chunk_size
+        self.chunk_directory = os.path.join(files_directory, self.CHUNK_DIRECTORY)
+        self.manifest_directory = os.path.join(files_directory, self.MANIFEST_DIRECTORY)
+        os.makedirs(self.chunk_directory, exist_ok=True)
+        os.makedirs(self.manifest_directory, exist_ok=True)
+        super().__init__(files_directory, cache, durability=durability)
+
+    def rebuild_index(self):
+        super().rebuild_index()
+        referenced = set()
+        for name in os.listdir(self.manifest_directory):
+            manifest = self.read_manifest(name)
+            if manifest is None:
+                continue
+            referenced.update(digest for digest, _ in manifest['chunks'])
+            mtime = os.path.getmtime(os.path.join(self.manifest_directory, name))
+            self.index.update(name, manifest['size'], mtime, manifest.get('checksum'))
+        self.collect_garbage(referenced)
+
+    def collect_garbage(self, referenced):
+        # Chunks no manifest points at any more (overwritten files, uploads
+        # that never got their manifest). Only run at startup, when no
+        # upload can be in flight.
+        for prefix in os.listdir(self.chunk_directory):
+            directory = os.path.join(self.chunk_directory, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for digest in os.listdir(directory):
+                if digest not in referenced:
+                    os.remove(os.path.join(directory, digest))
+
+    def chunk_path(self, digest):
+        if len(digest) != 64 or any(c not in '0123456789abcdef' for c in digest):
+            raise StorageError(f"Invalid chunk hash '{digest}'.")
+        return os.path.join(self.chunk_directory, digest[:2], digest)
+
+    def missing_chunks(self, digests):
+        return [digest for digest in digests if not os.path.exists(self.chunk_path(digest))]
+
+    def put_chunk(self, digest, data):
+        chunk_path = self.chunk_path(digest)
+        if os.path.exists(chunk_path):
+            return False
+        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.chunk_directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, chunk_path)
+        return True
+
+    def manifest_path(self, filename):
+        return os.path.join(self.manifest_directory, os.path.basename(self.path(filename)))
+
+    def read_manifest(self, filename):
+        try:
+            with open(self.manifest_path(filename)) as manifest:
+                return json.load(manifest)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self, filename, manifest, chunk_paths=()):
+        # chunk_paths are new chunks of the manifest, which must be on disk
+        # before it is
+        manifest_path = self.manifest_path(filename)
+        # Concurrent uploads of the same name each write their own manifest
+        fd, temp_path = tempfile.mkstemp(dir=self.partial_directory,
+                                         prefix=os.path.basename(manifest_path) + '.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(manifest, file)
+        self.durability.sync(files=[*chunk_paths, temp_path],
+                             directories={os.path.dirname(path) for path in chunk_paths})
+        os.replace(temp_path, manifest_path)
+        self.durability.sync(directories=[self.manifest_directory])
+        # The manifest now shadows any plain file of the same name
+        try:
+            os.remove(self.path(filename))
+        except FileNotFoundError:
+            pass
+        self.set_compressed_info(os.path.basename(manifest_path), None)
+        self.file_updated(os.path.basename(manifest_path), manifest['size'],
+                          os.path.getmtime(manifest_path), manifest.get('checksum'))
+
+    def reload(self, name, checksum=None):
+        manifest = self.read_manifest(name)
+        if manifest is None:
+            super().reload(name, checksum)
+            return
+        with self.lock:
+            self.compressed.pop(name, None)
+        mtime = os.path.getmtime(self.manifest_path(name))
+        self.index.update(name, manifest['size'], mtime, checksum or manifest.get('checksum'))
+        if self.cache is not None:
+            self.cache.invalidate(name)
+
+    def manifest_hashes(self, manifest):
+        # A manifest cut at BLOB_CHUNK_SIZE already lists the chunk hashes
+        if manifest is None or any(length != BLOB_CHUNK_SIZE for _, length in manifest['chunks'][:-1]):
+            return None
+        return [digest for digest, _ in manifest['chunks']]
+
+    def chunk_hashes(self, filename):
+        manifest = self.read_manifest(filename)
+        hashes = self.manifest_hashes(manifest)
+        if hashes is None:
+            return super().chunk_hashes(filename)
+        return manifest['size'], self.checksum(filename), hashes
+
+    def needs_hashing(self, filename, chunks=False):
+        if chunks and self.manifest_hashes(self.read_manifest(filename)) is not None:
+            chunks = False
+        return super().needs_hashing(filename, chunks)
+
+    def load_buffer(self, filename, size):
+        if not os.path.exists(self.manifest_path(filename)):
+            return super().load_buffer(filename, size)
+        # Manifests are spread over many chunk files, only small ones are
+        # worth assembling in memory
+        if size > self.cache.small_file_limit:
+            return None
+        file, _ = self.open_uncached(filename)
+        with file:
+            return file.read()
+
+    def open_uncached(self, filename, offset=0, length=None):
+        manifest = self.read_manifest(filename)
+        if manifest is None:
+            return super().open_uncached(filename, offset, length)
+
+        size = manifest['size']
+        if not 0 <= offset <= size:
+            raise StorageError(f"Offset {offset} is outside of the file.")
+        count = size - offset if length is None else min(length, size - offset)
+        return ChunkReader(self.manifest_parts(manifest['chunks'], offset, count)), count
+
+    def manifest_parts(self, chunks, offset, count):
+        # Keep only the chunks overlapping [offset, offset + count)
+        parts = []
+        start = 0
+        for digest, chunk_length in chunks:
+            end = start + chunk_length
+            low, high = max(start, offset), min(end, offset + count)
+            if low < high:
+                parts.append((self.chunk_path(digest), low - start, high - low))
+            start = end
+        return parts
+
+    def new_upload(self, filename):
+        self.path(filename)
+        return Upload(filename, ChunkWriter(self))
+
+    def publish_upload(self, upload):
+        self.write_manifest(upload.filename, upload.file.manifest(), upload.file.written)
+
+    def completed_path(self, filename):
+        return os.path.join(self.partial_directory, os.path.basename(self.path(filename)) + '.done')
+
+    def publish_completed(self, filename, file_path):
+        writer = ChunkWriter(self)
+        with open(file_path, 'rb') as file, writer:
+            while data := file.read(self.chunk_size):
+                writer.write(data)
+        self.write_manifest(filename, writer.manifest(), writer.written)
+        os.remove(file_path)
+
+    def open_blob_upload(self, kind, name):
+        # kind is 'chunk' (name is the chunk hash) or 'manifest'
+        if kind == 'chunk':
+            chunk_path = self.chunk_path(name)
+            fd, temp_path = tempfile.mkstemp(dir=self.chunk_directory, suffix='.tmp')
+            return Upload(name, HashingWriter(os.fdopen(fd, 'wb', buffering=WRITE_BUFFER_SIZE)),
+                          temp_path=temp_path, kind=kind)
+        self.path(name)
+        return Upload(name, BoundedBuffer(self.MAX_MANIFEST_SIZE), kind=kind)
+
+    def finish_blob_upload(self, upload):
+        upload.file.close()
+        if upload.kind == 'chunk':
+            if upload.file.hexdigest() != upload.filename:
+                os.remove(upload.temp_path)
+                raise StorageError("Chunk data does not match its hash.")
+            chunk_path = self.chunk_path(upload.filename)
+            os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+            self.durability.sync(files=[upload.temp_path])
+            os.replace(upload.temp_path, chunk_path)
+            self.durability.sync(directories=[os.path.dirname(chunk_path)])
+            return f"Chunk {upload.filename[:12]} stored."
+
+        try:
+            manifest = json.loads(bytes(upload.file.data))
+            chunks = [[str(digest), int(length)] for digest, length in manifest['chunks']]
+            size = int(manifest['size'])
+        except (ValueError, KeyError, TypeError):
+            raise StorageError("Malformed manifest.")
+        if sum(length for _, length in chunks) != size:
+            raise StorageError("Manifest size does not match its chunks.")
+        missing = self.missing_chunks(sorted({digest for digest, _ in chunks}))
+        if missing:
+            raise StorageError(f"{len(missing)} chunks of the manifest are missing.")
+        # The whole-file checksum is not trusted from the client; it is
+        # computed here from the stored chunks, like for any other upload.
+        with ChunkReader(self.manifest_parts(chunks, 0, size)) as file:
+            checksum = stream_checksum(file)
+        self.write_manifest(upload.filename, {'size': size, 'checksum': checksum, 'chunks': chunks})
+        return f"File {upload.filename} stored successfully."
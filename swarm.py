@@ -0,0 +1,281 @@
+import hashlib
+import random
+import socket
+import threading
+import time
+import protocol
+from storage import BLOB_CHUNK_SIZE, CHECKSUM_ALGORITHM, BoundedBuffer, StorageError
+
+# Swarm downloads (server.py --swarm, ClientCore(swarm=True)). Clients that
+# download the same file at once fetch most of it from each other, so the
+# server sends about one copy of it per wave of downloads instead of one
+# per client.
+#
+#   peers        a client runs a PeerServer and announces its port with
+#                "/peer <port>"; the server takes the host from the
+#                connection. It stops being a peer when its session ends.
+#   chunk maps   "/get <file> swarm [checksum=<c>] [have=<i>,<j>,...]"
+#                answers with the file's size, checksum and, unless the
+#                client already has them for this checksum, the SHA-256 of
+#                each CHUNK_SIZE chunk. `chunks` lists up to MAP_CHUNKS
+#                chunks the client lacks as [index, [peer addresses]], the
+#                rarest first; `pending` counts the rest. have= reports the
+#                chunks the client verified since its last map.
+#   leases       a chunk no peer holds is listed with no addresses, which
+#                means "fetch it from the server" (a ranged /get). It is
+#                leased to that client for LEASE_SECONDS, and other clients
+#                wait for it to show up at a peer instead of fetching it
+#                too. A client holds at most LEASE_CHUNKS leases at a time,
+#                so concurrent downloads take different chunks from the
+#                server and then trade them.
+#
+# Peers answer "/piece <hash>" with the chunk as a data stream. Every chunk
+# is checked against its hash before it is written, and one a peer fails to
+# deliver is fetched from the server. Under --workers every worker tracks
+# the peers connected to it.
+
+CHUNK_SIZE = BLOB_CHUNK_SIZE
+MAP_CHUNKS = 16
+LEASE_CHUNKS = 4
+LEASE_SECONDS = 10
+
+# How long a client without work waits before asking for a new map
+POLL_INTERVAL = 0.05
+
+# Seconds a peer may take to connect and send a chunk
+PEER_TIMEOUT = 10
+
+
+def parse_swarm_options(params):
+    # "checksum=<c>" and "have=<i>,<j>,..." of a swarm /get
+    checksum, have = None, []
+    for param in params:
+        key, _, value = param.partition('=')
+        if key == 'checksum' and value:
+            checksum = value
+        elif key == 'have' and value and all(index.isdigit() for index in value.split(',')):
+            have = [int(index) for index in value.split(',')]
+        else:
+            raise ValueError(f"Unknown swarm option '{param}'.")
+    return checksum, have
+
+
+class SwarmTracker:
+    # Server side: which peer holds which chunks of which file version, and
+    # which chunks are being fetched from the server. Versions are keyed by
+    # checksum, so holders of an overwritten file are not offered for the
+    # new one. All methods are safe to call from any thread.
+    #
+    # `blocks` tells event loop callers whether the methods may block, as
+    # coordinator.CoordinatorSwarm's do.
+    blocks = False
+
+    def __init__(self, map_chunks=MAP_CHUNKS, lease_chunks=LEASE_CHUNKS, lease_seconds=LEASE_SECONDS):
+        self.lock = threading.Lock()
+        self.map_chunks = map_chunks
+        self.lease_chunks = lease_chunks
+        self.lease_seconds = lease_seconds
+        self.peers = {}    # handle -> "host:port"
+        self.holders = {}  # checksum -> {index: set of handles}
+        self.leases = {}   # checksum -> {index: (handle, expiry)}
+
+    def add_peer(self, handle, address):
+        with self.lock:
+            self.peers[handle] = address
+
+    def remove_peer(self, handle):
+        with self.lock:
+            if self.peers.pop(handle, None) is None:
+                return
+            for checksum in list(self.holders):
+                chunks = self.holders[checksum]
+                for index in list(chunks):
+                    chunks[index].discard(handle)
+                    if not chunks[index]:
+                        del chunks[index]
+                if not chunks:
+                    del self.holders[checksum]
+            for checksum in list(self.leases):
+                leases = self.leases[checksum]
+                for index in [index for index, (holder, _) in leases.items() if holder == handle]:
+                    del leases[index]
+                if not leases:
+                    del self.leases[checksum]
+
+    def is_peer(self, handle):
+        return handle in self.peers
+
+    def add_chunks(self, handle, checksum, indices, count):
+        # The peer verified these chunks of the version and serves them now
+        with self.lock:
+            if handle not in self.peers:
+                return
+            chunks = self.holders.setdefault(checksum, {})
+            leases = self.leases.get(checksum, {})
+            for index in indices:
+                if 0 <= index < count:
+                    chunks.setdefault(index, set()).add(handle)
+                    leases.pop(index, None)
+
+    def chunk_map(self, handle, checksum, count):
+        # Returns (chunks, pending) for the peer, see the module comment
+        now = time.monotonic()
+        with self.lock:
+            holders = self.holders.get(checksum, {})
+            leases = self.leases.setdefault(checksum, {})
+            for index in [index for index, (_, expiry) in leases.items() if expiry <= now]:
+                del leases[index]
+            leased = sum(1 for holder, _ in leases.values() if holder == handle)
+            chunks, pending = [], 0
+            for index in range(count):
+                owners = holders.get(index, ())
+                if handle in owners:
+                    continue
+                if owners:
+                    addresses = [self.peers[owner] for owner in owners]
+                    random.shuffle(addresses)
+                    chunks.append([index, addresses])
+                elif index in leases:
+                    if leases[index][0] == handle:
+                        chunks.append([index, []])
+                    else:
+                        pending += 1
+                elif leased < self.lease_chunks:
+                    leases[index] = (handle, now + self.lease_seconds)
+                    leased += 1
+                    chunks.append([index, []])
+                else:
+                    pending += 1
+            if not leases:
+                del self.leases[checksum]
+        # Chunks from the server first, then the rarest ones
+        chunks.sort(key=lambda chunk: len(chunk[1]))
+        return chunks[:self.map_chunks], pending + len(chunks[self.map_chunks:])
+
+    def stats(self):
+        with self.lock:
+            return {'swarm_peers': len(self.peers),
+                    'swarm_chunks_held': sum(len(owners) for chunks in self.holders.values()
+                                             for owners in chunks.values())}
+
+
+class PeerServer:
+    # Client side: serves the chunks this client verified to other peers,
+    # one thread per connection. A chunk is read from the first of its paths
+    # that exists, which covers a download being renamed into place.
+
+    def __init__(self, host='127.0.0.1'):
+        self.lock = threading.Lock()
+        self.pieces = {}  # hash -> (paths, offset, length)
+        self.bytes_served = 0
+        self.server_socket = socket.create_server((host, 0))
+        self.port = self.server_socket.getsockname()[1]
+        threading.Thread(target=self.accept_peers, daemon=True).start()
+
+    def add(self, digest, paths, offset, length):
+        with self.lock:
+            self.pieces[digest] = (paths, offset, length)
+
+    def accept_peers(self):
+        while True:
+            try:
+                sock, _ = self.server_socket.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve_peer, args=(sock,), daemon=True).start()
+
+    def serve_peer(self, sock):
+        with sock:
+            try:
+                while True:
+                    frame, payload = protocol.recv_frame(sock)
+                    if frame is None:
+                        return
+                    command, params = protocol.parse_command(payload)
+                    piece = self.pieces.get(params[0]) if command == "/piece" and len(params) == 1 else None
+                    file = self.open_piece(piece) if piece else None
+                    if file is None:
+                        protocol.send_error(sock, "Error: Chunk not available.")
+                        continue
+                    with file:
+                        protocol.send_stream(sock, file, piece[2])
+                    with self.lock:
+                        self.bytes_served += piece[2]
+            except (OSError, ValueError, protocol.ProtocolError):
+                return
+
+    def read(self, digest):
+        # The chunk from this client's own files, e.g. for a second download
+        # of the same file, or None
+        piece = self.pieces.get(digest)
+        file = self.open_piece(piece) if piece else None
+        if file is None:
+            return None
+        with file:
+            data = file.read(piece[2])
+        return data if hashlib.new(CHECKSUM_ALGORITHM, data).hexdigest() == digest else None
+
+    def open_piece(self, piece):
+        paths, offset, _ = piece
+        for path in paths:
+            try:
+                file = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            file.seek(offset)
+            return file
+        return None
+
+    def close(self):
+        self.server_socket.close()
+
+
+def fetch_piece(address, digest, length, timeout=PEER_TIMEOUT):
+    # Returns the chunk from the peer at "host:port", or None when the peer
+    # cannot deliver it or sends something else
+    host, _, port = address.rpartition(':')
+    buffer = BoundedBuffer(length)
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            protocol.send_command(sock, f"/piece {digest}")
+            frame = protocol.recv_frame_header(sock)
+            if frame is None or frame.opcode == protocol.OP_ERROR:
+                return None
+            protocol.recv_stream(sock, buffer, first=frame)
+    except (OSError, ValueError, StorageError, protocol.ProtocolError):
+        return None
+    data = bytes(buffer.data)
+    if len(data) != length or hashlib.new(CHECKSUM_ALGORITHM, data).hexdigest() != digest:
+        return None
+    return data
+
+
+def chunk_span(index, size):
+    # (offset, length) of chunk `index` of a file of `size` bytes
+    offset = index * CHUNK_SIZE
+    return offset, min(CHUNK_SIZE, size - offset)
+
+
+def chunk_count(size):
+    return -(-size // CHUNK_SIZE)
+
+
+def missing_chunks(missing):
+    # Indices of the chunks that overlap the missing byte ranges
+    indices = set()
+    for start, end in missing:
+        indices.update(range(start // CHUNK_SIZE, chunk_count(end)))
+    return indices
+
+
+def is_chunk_intact(path, index, size, digest):
+    offset, length = chunk_span(index, size)
+    try:
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            data = file.read(length)
+    except OSError:
+        return False
+    return hashlib.new(CHECKSUM_ALGORITHM, data).hexdigest() == digest
@@ -0,0 +1,46 @@
+import itertools
+import os
+import sys
+import pytest
+
+# The modules live at the top of the repository, next to server.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_server import AsyncServer
+from client_core import ClientCore
+
+
+@pytest.fixture
+def start_server(tmp_path):
+    # Starts an asyncio server on a free port, serving tmp_path/server_files
+    servers = []
+
+    def start(**options):
+        server = AsyncServer(port=0, files_directory=str(tmp_path / 'server_files'), **options)
+        server.start_server()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop_server()
+        server.events.stop()
+
+
+@pytest.fixture
+def connect():
+    # Joins a server as a newly registered client
+    clients = []
+    handles = itertools.count(1)
+
+    def connect_client(server, **options):
+        client = ClientCore(**options)
+        client.connect(server.host, server.port)
+        client.register(f"user{next(handles)}")
+        clients.append(client)
+        return client
+
+    yield connect_client
+    for client in clients:
+        if client.is_joined:
+            client.disconnect()
@@ -0,0 +1,63 @@
+import threading
+import time
+import compression
+from client_core import ClientCore
+
+
+def test_stop_server_releases_connected_clients(start_server):
+    server = start_server()
+    failures = []
+    previous_hook = threading.excepthook
+    threading.excepthook = lambda args: failures.append(args.exc_type)
+    try:
+        clients = []
+        for number in range(3):
+            client = ClientCore()
+            client.connect(server.host, server.port)
+            client.register(f"user{number}")
+            clients.append(client)
+        assert len(server.sessions) == 3
+
+        server.stop_server()
+        deadline = time.monotonic() + 5
+        while (server.clients or server.active_connections) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        threading.excepthook = previous_hook
+    assert not server.clients
+    assert not server.active_connections
+    assert len(server.sessions) == 0
+    assert failures == []
+
+
+def test_files_compressed_at_rest_are_inflated_once_off_the_loop(start_server, connect, tmp_path, monkeypatch):
+    server = start_server(compress_at_rest='zlib')
+    readers, reading_threads = [], set()
+    restart, read = compression.DecompressingReader.restart, compression.DecompressingReader.read
+
+    def counting_restart(self):
+        readers.append(self)
+        restart(self)
+
+    def recording_read(self, size=-1):
+        reading_threads.add(threading.current_thread())
+        return read(self, size)
+    monkeypatch.setattr(compression.DecompressingReader, 'restart', counting_restart)
+    monkeypatch.setattr(compression.DecompressingReader, 'read', recording_read)
+
+    data = b''.join(b'line %d of a text file\n' % number for number in range(1000000))
+    source = tmp_path / 'text.txt'
+    source.write_bytes(data)
+    connect(server).store(str(source))
+    loop_thread = []
+    server.loop.call_soon_threadsafe(lambda: loop_thread.append(threading.current_thread()))
+
+    # Ranges are compressed for the client on the way out, a plain client
+    # gets them inflated
+    for codecs in (None, []):
+        destination = tmp_path / f'copy-{codecs}.txt'
+        connect(server, codecs=codecs).get('text.txt', 3, str(destination))
+        assert destination.read_bytes() == data
+    # Seeking back to a range's start restarts a reader; a sample must not
+    assert readers and len(readers) == len(set(map(id, readers)))
+    assert reading_threads and loop_thread[0] not in reading_threads
@@ -0,0 +1,58 @@
+import os
+import pytest
+from cache import FileCache
+from storage import FileStore
+
+
+def store_file(store, name, data):
+    upload = store.open_upload(name)
+    upload.file.write(data)
+    assert store.finish_upload(upload, len(data))
+
+
+def read_file(store, name, offset=0, length=None):
+    file, count = store.open_read(name, offset, length)
+    with file:
+        return file.read(count)
+
+
+def test_lookup_for_another_version_is_a_miss():
+    cache = FileCache(1000)
+    cache.put('a', (3, 1.0), b'old')
+    assert bytes(cache.get('a', (3, 1.0))) == b'old'
+    assert cache.get('a', (3, 2.0)) is None
+    assert cache.get('a', (3, 1.0)) is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['invalidations']) == (1, 2, 1)
+    assert stats['entries'] == stats['used'] == 0
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = FileCache(250)
+    for name in 'abc':
+        cache.put(name, 1, bytes(100))
+        cache.get('a', 1)
+    assert cache.get('b', 1) is None
+    assert cache.get('a', 1) is not None and cache.get('c', 1) is not None
+    assert cache.stats()['used'] == 200
+    assert cache.stats()['evictions'] == 1
+    assert cache.admits(125) and not cache.admits(126)
+
+
+# Small files are cached as bytes, larger ones as mmap views
+@pytest.mark.parametrize('size', [100, 5000])
+def test_overwritten_file_is_never_served_stale(tmp_path, size):
+    cache = FileCache(1 << 20, small_file_limit=1000)
+    store = FileStore(str(tmp_path), cache)
+    old, new = os.urandom(size), os.urandom(size)
+    store_file(store, 'data.bin', old)
+    assert read_file(store, 'data.bin') == old
+    assert read_file(store, 'data.bin', 10, 20) == old[10:30]
+    assert cache.stats()['hits'] == 1
+
+    # Same size, so only the invalidation tells the versions apart when
+    # the file system's mtime resolution is coarse
+    store_file(store, 'data.bin', new)
+    assert cache.stats()['entries'] == 0
+    assert read_file(store, 'data.bin') == new
+    assert read_file(store, 'data.bin', 10, 20) == new[10:30]
@@ -0,0 +1,52 @@
+import os
+import pytest
+import protocol
+from client_core import ClientError
+
+
+def test_damaged_upload_is_not_published(start_server, connect, tmp_path, monkeypatch):
+    server = start_server()
+    client = connect(server)
+    assert client.checksums
+    source = tmp_path / 'notes.bin'
+    source.write_bytes(os.urandom(200 * 1024))
+
+    send_checksum = protocol.send_checksum
+    monkeypatch.setattr(protocol, 'send_checksum',
+                        lambda sock, checksum, request_id=0: send_checksum(sock, '0' * 64, request_id))
+    with pytest.raises(ClientError, match="Checksum mismatch"):
+        client.store(str(source))
+    assert server.store.index.get('notes.bin') is None
+    assert not os.path.exists(os.path.join(server.files_directory, 'notes.bin'))
+
+    # Only the upload was refused, the connection is still usable
+    monkeypatch.undo()
+    client.store(str(source))
+    assert server.store.index.get('notes.bin').size == 200 * 1024
+
+
+def test_damaged_download_is_deleted(start_server, connect, tmp_path):
+    server = start_server()
+    client = connect(server)
+    source = tmp_path / 'notes.bin'
+    source.write_bytes(os.urandom(200 * 1024))
+    client.store(str(source))
+
+    # Damage the stored copy without changing its size
+    with open(os.path.join(server.files_directory, 'notes.bin'), 'r+b') as file:
+        file.write(b'\0' * 16)
+    destination = tmp_path / 'copy.bin'
+    with pytest.raises(ClientError, match="Checksum mismatch"):
+        client.get('notes.bin', 1, str(destination))
+    assert not destination.exists()
+
+
+def test_checksum_is_recorded_when_ranged_upload_completes(start_server, connect, tmp_path):
+    server = start_server()
+    client = connect(server)
+    source = tmp_path / 'large.bin'
+    source.write_bytes(os.urandom(3 * 1024 * 1024))
+    client.store(str(source), 3)
+
+    assert not server.store.needs_hashing('large.bin')
+    assert not server.store.needs_hashing('large.bin', chunks=True)
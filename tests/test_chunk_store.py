@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import pytest
+from storage import ChunkStore, StorageError
+
+CHUNK_SIZE = 4096
+
+
+def chunk_files(store):
+    return sorted(name for prefix in os.listdir(store.chunk_directory)
+                  if os.path.isdir(os.path.join(store.chunk_directory, prefix))
+                  for name in os.listdir(os.path.join(store.chunk_directory, prefix)))
+
+
+def store_file(store, name, data):
+    upload = store.open_upload(name)
+    upload.file.write(data)
+    assert store.finish_upload(upload, len(data))
+
+
+def read_file(store, name):
+    file, count = store.open_read(name)
+    with file:
+        return file.read(count)
+
+
+def upload_blob(store, kind, name, data):
+    upload = store.open_blob_upload(kind, name)
+    upload.file.write(data)
+    return store.finish_blob_upload(upload)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ChunkStore(str(tmp_path), chunk_size=CHUNK_SIZE)
+
+
+def test_upload_round_trip(store):
+    data = os.urandom(3 * CHUNK_SIZE + 100)
+    store_file(store, 'data.bin', data)
+    assert read_file(store, 'data.bin') == data
+
+    manifest = store.read_manifest('data.bin')
+    assert manifest['size'] == len(data)
+    assert manifest['checksum'] == hashlib.sha256(data).hexdigest()
+    assert [length for _, length in manifest['chunks']] == [CHUNK_SIZE] * 3 + [100]
+    assert store.checksum('data.bin') == manifest['checksum']
+    assert not os.path.exists(os.path.join(store.files_directory, 'data.bin'))
+
+    file, count = store.open_read('data.bin', CHUNK_SIZE - 10, 20)
+    with file:
+        assert file.read(count) == data[CHUNK_SIZE - 10:CHUNK_SIZE + 10]
+
+
+def test_identical_content_shares_chunks(store):
+    shared = os.urandom(2 * CHUNK_SIZE)
+    store_file(store, 'first.bin', shared)
+    assert len(chunk_files(store)) == 2
+    store_file(store, 'second.bin', shared + os.urandom(CHUNK_SIZE))
+    store_file(store, 'copy.bin', shared)
+    assert len(chunk_files(store)) == 3
+    assert read_file(store, 'copy.bin') == shared
+
+
+def test_chunk_and_manifest_uploads(store):
+    chunks = [os.urandom(CHUNK_SIZE), os.urandom(100)]
+    digests = [hashlib.sha256(chunk).hexdigest() for chunk in chunks]
+    assert store.missing_chunks(digests) == digests
+
+    upload_blob(store, 'chunk', digests[0], chunks[0])
+    assert store.missing_chunks(digests) == digests[1:]
+    manifest = json.dumps({'size': CHUNK_SIZE + 100, 'chunks': [[digest, len(chunk)] for digest, chunk
+                                                                  in zip(digests, chunks)]}).encode()
+    with pytest.raises(StorageError, match="missing"):
+        upload_blob(store, 'manifest', 'data.bin', manifest)
+
+    upload_blob(store, 'chunk', digests[1], chunks[1])
+    upload_blob(store, 'manifest', 'data.bin', manifest)
+    assert read_file(store, 'data.bin') == b''.join(chunks)
+    # The checksum is computed by the server, never taken from the client
+    assert not store.needs_hashing('data.bin')
+    assert store.checksum('data.bin') == hashlib.sha256(b''.join(chunks)).hexdigest()
+
+
+def test_chunk_not_matching_its_hash_is_refused(store):
+    digest = hashlib.sha256(b'expected').hexdigest()
+    with pytest.raises(StorageError, match="does not match"):
+        upload_blob(store, 'chunk', digest, b'something else')
+    assert store.missing_chunks([digest]) == [digest]
+    with pytest.raises(StorageError):
+        store.chunk_path('../' + digest[3:])
+
+
+def test_unreferenced_chunks_are_collected_at_startup(tmp_path, store):
+    store_file(store, 'data.bin', os.urandom(2 * CHUNK_SIZE))
+    kept = os.urandom(CHUNK_SIZE)
+    store_file(store, 'data.bin', kept)
+    assert len(chunk_files(store)) == 3
+
+    restarted = ChunkStore(str(tmp_path), chunk_size=CHUNK_SIZE)
+    assert chunk_files(restarted) == [hashlib.sha256(kept).hexdigest()]
+    assert read_file(restarted, 'data.bin') == kept
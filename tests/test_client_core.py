@@ -0,0 +1,63 @@
+import os
+import threading
+import pytest
+from client_core import RANGE_SIZE
+
+
+def test_progress_is_reported_while_a_file_moves(start_server, connect, tmp_path):
+    server = start_server()
+    client = connect(server)
+    reports = []
+    client.progress = reports.append
+    data = os.urandom(3 * 1024 * 1024 + 17)
+    source = tmp_path / 'data.bin'
+    source.write_bytes(data)
+
+    client.store(str(source))
+    assert len(reports) > 2 and sum(reports) == len(data)
+    reports.clear()
+    client.get('data.bin', destination=str(tmp_path / 'copy.bin'))
+    assert len(reports) > 2 and sum(reports) == len(data)
+    assert (tmp_path / 'copy.bin').read_bytes() == data
+
+
+@pytest.mark.parametrize('multiplex', [False, True])
+def test_ranges_report_progress_before_they_end(start_server, connect, tmp_path, multiplex):
+    server = start_server()
+    client = connect(server, multiplex=multiplex)
+    reports = []
+    client.progress = reports.append
+    data = os.urandom(RANGE_SIZE + 1024)
+    source = tmp_path / 'data.bin'
+    source.write_bytes(data)
+
+    client.store(str(source), 2)
+    assert sum(reports) == len(data)
+    assert max(reports) < RANGE_SIZE
+    reports.clear()
+    client.get('data.bin', 2, str(tmp_path / 'copy.bin'))
+    assert sum(reports) == len(data) and max(reports) < RANGE_SIZE
+
+
+def test_sessions_attach_from_other_threads(start_server, connect):
+    server = start_server()
+    client = connect(server)
+    attached, errors = [], []
+
+    def attach():
+        try:
+            attached.append(client.attach())
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=attach) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    # The main connection stays usable meanwhile
+    for _ in range(20):
+        assert list(client.list_directory())[0]['total'] == 0
+    for thread in threads:
+        thread.join()
+    assert errors == [] and len(attached) == 8
+    for core in attached:
+        assert list(core.list_directory())[0]['total'] == 0
+        core.close()
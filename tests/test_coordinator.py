@@ -0,0 +1,69 @@
+import threading
+import time
+import pytest
+from coordinator import Coordinator, CoordinatorClient, CoordinatorSwarm, worker_limits
+from swarm import SwarmTracker
+
+
+class SlowStore:
+    # Records reloads, taking a while like a real stat of the file
+    def __init__(self):
+        self.reloaded = []
+
+    def reload(self, name, checksum=None):
+        time.sleep(0.2)
+        self.reloaded.append(name)
+
+
+@pytest.fixture
+def workers():
+    coordinator = Coordinator(swarm=SwarmTracker())
+    for number in range(3):
+        coordinator.add_worker()
+    # In-process stand-ins for forked workers
+    clients = [CoordinatorClient(number, *ends) for number, ends in enumerate(coordinator.worker_ends)]
+    stores = [SlowStore() for _ in clients]
+    for client, store in zip(clients, stores):
+        client.listen(store)
+    coordinator.start()
+    return clients, stores
+
+
+def test_upload_is_confirmed_once_every_worker_reloaded(workers):
+    clients, stores = workers
+    clients[0].file_updated('data.bin', 'abc')
+    assert [store.reloaded for store in stores] == [[], ['data.bin'], ['data.bin']]
+
+
+def test_concurrent_publishes_all_wait(workers):
+    clients, stores = workers
+    threads = [threading.Thread(target=client.file_updated, args=(f'{client.number}.bin', None))
+               for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for number, store in enumerate(stores):
+        assert sorted(store.reloaded) == sorted(f'{other}.bin' for other in range(3) if other != number)
+
+
+def test_peers_are_known_to_every_worker(workers):
+    clients, _ = workers
+    first, second = CoordinatorSwarm(clients[0]), CoordinatorSwarm(clients[1])
+    first.add_peer('alice', '10.0.0.1:5000')
+    first.add_chunks('alice', 'abc', [0, 1], 2)
+    second.add_peer('bob', '10.0.0.2:5000')
+    assert second.is_peer('alice')
+    assert second.chunk_map('bob', 'abc', 2) == ([[0, ['10.0.0.1:5000']], [1, ['10.0.0.1:5000']]], 0)
+    assert first.stats()['swarm_peers'] == 2
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 8])
+def test_limits_are_split_between_workers(count):
+    settings = {'rate': 10000000, 'max_large': 8}
+    shares = [worker_limits(settings, number, count) for number in range(count)]
+    assert sum(share['rate'] for share in shares) <= settings['rate']
+    assert sum(share['max_large'] for share in shares) == settings['max_large']
+    assert all(share['max_large'] >= 1 for share in shares)
+    unlimited = worker_limits({'rate': 0, 'max_large': 0}, 0, count)
+    assert unlimited == {'rate': 0, 'max_large': 0}
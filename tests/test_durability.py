@@ -0,0 +1,64 @@
+import threading
+import pytest
+from durability import SYNCFS, DataSync, GroupCommit
+
+
+def make_files(directory, count):
+    paths = []
+    for number in range(count):
+        path = directory / f"upload{number}.bin"
+        path.write_bytes(b'x' * 1024)
+        paths.append(str(path))
+    return paths
+
+
+def sync_concurrently(durability, files, directory):
+    # Every file is one upload, renamed into the same directory
+    errors = {}
+
+    def upload(path):
+        try:
+            durability.sync(files=[path], directories=[directory])
+        except OSError as e:
+            errors[path] = e
+
+    threads = [threading.Thread(target=upload, args=(path,)) for path in files]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_fdatasync_syncs_every_path(tmp_path):
+    durability = DataSync()
+    files = make_files(tmp_path, 3)
+    durability.sync(files=files, directories=[str(tmp_path)] * 2)
+    assert durability.syncs == 4
+
+
+def test_group_commit_syncs_a_shared_directory_once_per_batch(tmp_path):
+    durability = GroupCommit(delay=0.5, syncfs=False)
+    files = make_files(tmp_path, 20)
+    assert sync_concurrently(durability, files, str(tmp_path)) == {}
+    # 20 files, and the directory once per batch rather than once per upload
+    assert 21 <= durability.syncs < 40
+
+
+@pytest.mark.skipif(SYNCFS is None, reason="syncfs(2) is not available")
+def test_group_commit_syncs_a_batch_with_one_syncfs(tmp_path):
+    durability = GroupCommit(delay=0.5)
+    files = make_files(tmp_path, 20)
+    assert sync_concurrently(durability, files, str(tmp_path)) == {}
+    assert durability.syncs <= 2
+
+
+@pytest.mark.parametrize('syncfs', [False, pytest.param(True, marks=pytest.mark.skipif(
+    SYNCFS is None, reason="syncfs(2) is not available"))])
+def test_group_commit_reports_errors_to_their_caller_only(tmp_path, syncfs):
+    durability = GroupCommit(delay=0.5, syncfs=syncfs)
+    files = make_files(tmp_path, 5)
+    missing = str(tmp_path / 'missing.bin')
+    errors = sync_concurrently(durability, files + [missing], str(tmp_path))
+    assert list(errors) == [missing]
+    assert isinstance(errors[missing], FileNotFoundError)
@@ -0,0 +1,175 @@
+import io
+import socket
+import threading
+import time
+import pytest
+import protocol
+from client_core import ClientCore
+from mux import STREAM_WINDOW, Multiplexer, StreamPool
+from server import ServerApp
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def serve_request(stream):
+    # "/echo <text>" replies with the text, "/send <size>" streams that many
+    # bytes and "/reset" aborts the request
+    try:
+        frame, payload = protocol.recv_frame(stream)
+        command, params = protocol.parse_command(payload)
+        if command == "/echo":
+            protocol.send_reply(stream, " ".join(params))
+        elif command == "/send":
+            size = int(params[0])
+            protocol.send_stream(stream, io.BytesIO(b'x' * size), size, zero_copy=False)
+        elif command == "/reset":
+            stream.reset()
+    except ConnectionError:
+        pass
+    finally:
+        stream.close()
+
+
+def tcp_pair():
+    # Multiplexers set TCP_NODELAY, which a socketpair() does not support
+    with socket.create_server(('127.0.0.1', 0)) as listener:
+        client_socket = socket.create_connection(listener.getsockname())
+        server_socket, _ = listener.accept()
+    return client_socket, server_socket
+
+
+@pytest.fixture
+def connection():
+    # A client and a server multiplexer on the two ends of a connection
+    client_socket, server_socket = tcp_pair()
+    pool = StreamPool(serve_request, 4)
+    server = Multiplexer(server_socket, pool.submit)
+    client = Multiplexer(client_socket)
+    server.start()
+    client.start()
+    yield client, server
+    client.close()
+    server.close()
+    pool.close()
+    client_socket.close()
+    server_socket.close()
+
+
+def request(client, command):
+    stream = client.open()
+    protocol.send_command(stream, command)
+    return stream
+
+
+def test_requests_run_as_streams_of_their_own(connection):
+    client, server = connection
+    first, second = request(client, "/echo one"), request(client, "/echo two")
+    assert first.request_id != second.request_id
+    assert protocol.read_response(second) == (True, "two")
+    assert protocol.read_response(first) == (True, "one")
+
+
+def test_stalled_stream_does_not_block_its_siblings(connection):
+    client, server = connection
+    size = 3 * STREAM_WINDOW
+    stalled = request(client, f"/send {size}")
+    # The sender stops once a window's worth is waiting to be read
+    assert wait_for(lambda: stalled.buffered == STREAM_WINDOW)
+
+    assert protocol.read_response(request(client, "/echo still answered")) == (True, "still answered")
+    time.sleep(0.1)
+    assert stalled.buffered == STREAM_WINDOW
+
+    # Reading the stalled stream grants the window back and the rest follows
+    received = io.BytesIO()
+    assert protocol.recv_stream(stalled, received) == size
+    assert received.getvalue() == b'x' * size
+
+
+def test_window_overrun_is_a_protocol_error(connection):
+    client, server = connection
+    stream = client.open()
+    header = protocol.Frame(protocol.OP_DATA, 0, stream.request_id, 0)
+    stream.deliver(header, b'x' * STREAM_WINDOW)
+    with pytest.raises(protocol.ProtocolError):
+        stream.deliver(header, b'x')
+
+
+def test_reset_frees_the_stream_id(connection):
+    client, server = connection
+    stream = request(client, "/reset")
+    with pytest.raises(ConnectionResetError):
+        protocol.read_response(stream)
+    assert wait_for(lambda: stream.request_id not in server.streams and stream.request_id not in client.streams)
+
+    # A reset from the client frees the id on the server too
+    stream = request(client, f"/send {3 * STREAM_WINDOW}")
+    assert wait_for(lambda: stream.request_id in server.streams)
+    stream.reset()
+    assert wait_for(lambda: stream.request_id not in server.streams)
+    assert protocol.read_response(request(client, "/echo after reset")) == (True, "after reset")
+
+
+class FakeStream:
+    def __init__(self):
+        self.was_reset = False
+
+    def reset(self):
+        self.was_reset = True
+
+
+def test_stream_pool_reuses_its_threads():
+    served = []
+    pool = StreamPool(lambda stream: served.append(threading.get_ident()), 2)
+    try:
+        for number in range(1, 11):
+            pool.submit(FakeStream())
+            assert wait_for(lambda: len(served) == number and pool.idle == pool.threads)
+        assert len(served) == 10
+        assert pool.threads == 1
+        assert len(set(served)) == 1
+    finally:
+        pool.close()
+
+
+def test_stream_pool_resets_streams_beyond_its_backlog():
+    release = threading.Event()
+    pool = StreamPool(lambda stream: release.wait(), 1, backlog=1)
+    try:
+        busy, waiting, refused = FakeStream(), FakeStream(), FakeStream()
+        pool.submit(busy)
+        assert wait_for(lambda: not pool.queue)
+        pool.submit(waiting)
+        pool.submit(refused)
+        assert not busy.was_reset and not waiting.was_reset
+        assert refused.was_reset
+    finally:
+        release.set()
+        pool.close()
+
+
+def test_request_right_after_register_sees_the_registration(tmp_path):
+    # /register and the next request run on different stream threads; the
+    # connection must count as registered before the reply goes out. The
+    # threaded engine has no stop, its daemon threads end with the test run.
+    server = ServerApp(port=0, files_directory=str(tmp_path / 'server_files'))
+    server.start_server()
+    port = server.server_socket.getsockname()[1]
+    try:
+        for number in range(30):
+            client = ClientCore(multiplex=True)
+            client.connect('127.0.0.1', port)
+            assert client.mux is not None
+            client.register(f"user{number}")
+            header = next(client.list_directory())
+            assert header['total'] == 0
+            client.disconnect()
+    finally:
+        server.events.stop()
@@ -0,0 +1,84 @@
+import os
+import pytest
+from storage import PartialFile, StorageError, merge_range, missing_ranges
+
+
+def write_range(partial, offset, data):
+    with partial.open(offset) as file:
+        file.write(data)
+    return partial.record(offset, len(data))
+
+
+def test_merge_range_joins_overlapping_and_adjacent_ranges():
+    ranges = merge_range([], 10, 20)
+    ranges = merge_range(ranges, 30, 40)
+    assert ranges == [[10, 20], [30, 40]]
+    assert merge_range(ranges, 20, 30) == [[10, 40]]
+    assert merge_range(ranges, 15, 35) == [[10, 40]]
+    assert merge_range(ranges, 0, 5) == [[0, 5], [10, 20], [30, 40]]
+
+
+def test_missing_ranges():
+    assert missing_ranges([], 100) == [(0, 100)]
+    assert missing_ranges([[0, 10], [50, 60]], 100) == [(10, 50), (60, 100)]
+    assert missing_ranges([[0, 100]], 100) == []
+
+
+def test_out_of_order_ranges_complete_the_file(tmp_path):
+    final_path = str(tmp_path / 'data.bin')
+    data = os.urandom(300)
+    partial = PartialFile(final_path, len(data))
+    assert not write_range(partial, 200, data[200:])
+    assert not write_range(partial, 0, data[:100])
+    assert partial.missing() == [(100, 200)]
+    assert not os.path.exists(final_path)
+
+    assert write_range(partial, 100, data[100:200])
+    with open(final_path, 'rb') as file:
+        assert file.read() == data
+    assert not os.path.exists(partial.data_path)
+    assert not os.path.exists(partial.state_path)
+    # Ranges still in flight find the file published
+    assert partial.open(0) is None
+
+
+def test_resume_keeps_recorded_ranges(tmp_path):
+    final_path = str(tmp_path / 'data.bin')
+    partial = PartialFile(final_path, 100)
+    write_range(partial, 0, b'a' * 40)
+
+    resumed = PartialFile(final_path, 100)
+    assert resumed.missing() == [(40, 100)]
+    assert PartialFile.read_state(resumed.state_path) == {'total': 100, 'ranges': [[0, 40]]}
+
+
+def test_different_total_starts_over(tmp_path):
+    final_path = str(tmp_path / 'data.bin')
+    write_range(PartialFile(final_path, 100), 0, b'a' * 40)
+
+    restarted = PartialFile(final_path, 200)
+    assert restarted.missing() == [(0, 200)]
+    assert os.path.getsize(restarted.data_path) == 200
+
+
+def test_overlong_range_never_reaches_the_file(tmp_path):
+    final_path = str(tmp_path / 'data.bin')
+    data = os.urandom(100)
+    partial = PartialFile(final_path, len(data))
+    with pytest.raises(StorageError):
+        write_range(partial, 90, b'x' * 50)
+    assert os.path.getsize(partial.data_path) == 100
+    assert partial.missing() == [(0, 100)]
+
+    assert write_range(partial, 0, data)
+    with open(final_path, 'rb') as file:
+        assert file.read() == data
+
+
+def test_ranges_outside_the_file_are_refused(tmp_path):
+    partial = PartialFile(str(tmp_path / 'data.bin'), 100)
+    with pytest.raises(StorageError):
+        partial.open(101)
+    with pytest.raises(StorageError):
+        partial.record(90, 20)
+    assert partial.missing() == [(0, 100)]
@@ -0,0 +1,89 @@
+import hashlib
+import io
+import socket
+import threading
+import pytest
+import protocol
+from storage import HashingWriter
+
+
+def send_in_background(function, *args, **kwargs):
+    # Payloads larger than the socket buffer need a reader on the other end
+    thread = threading.Thread(target=function, args=args, kwargs=kwargs)
+    thread.start()
+    return thread
+
+
+def test_command_frame_round_trip():
+    left, right = socket.socketpair()
+    with left, right:
+        protocol.send_command(left, "/get notes.txt 0 100", request_id=7)
+        frame, payload = protocol.recv_frame(right)
+    assert frame == protocol.Frame(protocol.OP_COMMAND, 0, 7, len(payload))
+    assert protocol.parse_command(payload) == ("/get", ["notes.txt", "0", "100"])
+
+
+def test_reply_and_error_frames():
+    left, right = socket.socketpair()
+    with left, right:
+        protocol.send_reply(left, "Welcome alice!")
+        protocol.send_error(left, "Error: Command not found.")
+        assert protocol.read_response(right) == (True, "Welcome alice!")
+        assert protocol.read_response(right) == (False, "Error: Command not found.")
+
+
+def test_clean_close_between_frames():
+    left, right = socket.socketpair()
+    with right:
+        left.close()
+        assert protocol.recv_frame(right) == (None, b'')
+
+
+def test_bad_magic_is_rejected():
+    header = protocol.pack_header(protocol.OP_COMMAND, 0).replace(protocol.MAGIC, b'XX', 1)
+    with pytest.raises(protocol.ProtocolError):
+        protocol.unpack_header(header)
+
+
+def test_oversized_control_frame_is_rejected():
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(protocol.pack_header(protocol.OP_COMMAND, protocol.MAX_CONTROL_PAYLOAD + 1))
+        with pytest.raises(protocol.ProtocolError):
+            protocol.recv_frame(right)
+
+
+def test_stream_round_trip_with_checksum():
+    data = bytes(range(256)) * 1024
+    left, right = socket.socketpair()
+    with left, right:
+        def send():
+            protocol.send_stream(left, io.BytesIO(data), len(data), end=False)
+            protocol.send_checksum(left, hashlib.sha256(data).hexdigest())
+
+        thread = send_in_background(send)
+        received = io.BytesIO()
+        writer = HashingWriter(received)
+        assert protocol.recv_stream(right, writer, digest=writer) == len(data)
+        thread.join()
+    assert received.getvalue() == data
+
+
+def test_stream_with_wrong_checksum_raises():
+    data = b'payload' * 100
+    left, right = socket.socketpair()
+    with left, right:
+        protocol.send_stream(left, io.BytesIO(data), len(data), end=False)
+        protocol.send_checksum(left, '0' * 64)
+        writer = HashingWriter(io.BytesIO())
+        with pytest.raises(protocol.ChecksumError):
+            protocol.recv_stream(right, writer, digest=writer)
+
+
+def test_chunks_round_trip():
+    chunks = [b'{"total": 2}', b'a.txt', b'b.txt']
+    left, right = socket.socketpair()
+    with left, right:
+        protocol.send_chunks(left, chunks)
+        # The frame marking the end carries no payload of its own
+        assert list(protocol.recv_chunks(right)) == chunks + [b'']
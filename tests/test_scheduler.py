@@ -0,0 +1,73 @@
+import collections
+import threading
+from scheduler import BURST_SECONDS, QUANTUM, TransferScheduler
+
+
+def share_of_grants(scheduler, handles, grants=60):
+    # Runs one transfer per handle, each taking QUANTUM bytes at a time as
+    # fast as the scheduler lets it, and counts the grants of each
+    counts = collections.Counter()
+    lock = threading.Lock()
+    done = threading.Event()
+    # Spend the burst the server's bucket starts with, so that the first
+    # transfer to start does not get it all before the others queue
+    warmup = scheduler.open('warmup', 'out')
+    scheduler.take(warmup, int(scheduler.rate * BURST_SECONDS))
+    scheduler.close(warmup)
+
+    def transfer(handle):
+        transfer = scheduler.open(handle, 'out')
+        try:
+            while not done.is_set():
+                scheduler.take(transfer, QUANTUM)
+                with lock:
+                    counts[handle] += 1
+                    if sum(counts.values()) >= grants:
+                        done.set()
+        finally:
+            scheduler.close(transfer)
+
+    threads = [threading.Thread(target=transfer, args=(handle,)) for handle in handles]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return counts
+
+
+def test_equal_handles_get_equal_shares():
+    scheduler = TransferScheduler(rate=100 * QUANTUM)
+    counts = share_of_grants(scheduler, ['alice', 'bob'])
+    assert abs(counts['alice'] - counts['bob']) <= 2
+
+
+def test_shares_follow_weights():
+    scheduler = TransferScheduler(rate=100 * QUANTUM)
+    scheduler.configure(weights={'alice': 3})
+    counts = share_of_grants(scheduler, ['alice', 'bob'], grants=80)
+    assert 2 <= counts['alice'] / counts['bob'] <= 4.5
+
+
+def test_unshaped_transfers_are_granted_at_once():
+    scheduler = TransferScheduler()
+    assert not scheduler.enabled
+    transfer = scheduler.open('alice', 'in')
+    assert scheduler.request(transfer, 100 * QUANTUM, lambda: None)
+    scheduler.close(transfer)
+
+
+def test_admission_holds_large_transfers_until_a_slot_frees():
+    scheduler = TransferScheduler(max_large=1, large_transfer=QUANTUM)
+    woken = threading.Event()
+    first = scheduler.open('alice', 'out')
+    second = scheduler.open('bob', 'out')
+    assert scheduler.request(first, 2 * QUANTUM, lambda: None)
+    assert not scheduler.request(second, 2 * QUANTUM, woken.set)
+    assert scheduler.stats()['transfers_admission_waiting'] == 1
+
+    scheduler.close(first)
+    assert woken.is_set()
+    assert scheduler.stats() == {'transfers_throttled': 0, 'transfers_admission_waiting': 0,
+                                 'large_transfers_active': 1}
+    scheduler.close(second)
+    assert scheduler.stats()['large_transfers_active'] == 0
@@ -0,0 +1,71 @@
+import threading
+import time
+from sessions import SessionRegistry
+
+
+def subscribe(registry):
+    calls = []
+    seen = threading.Event()
+
+    def listener(count, handles):
+        calls.append((count, sorted(handles)))
+        seen.set()
+    registry.subscribe(listener)
+    return calls, seen
+
+
+def test_changes_are_reported_once_per_delay():
+    registry = SessionRegistry(notify_delay=0.2)
+    calls, seen = subscribe(registry)
+    for number in range(50):
+        registry.join(number)
+        registry.reserve(number, f'user{number}')
+    registry.release(0)
+    assert seen.wait(2)
+    time.sleep(0.3)
+    assert calls == [(49, sorted(f'user{number}' for number in range(1, 50)))]
+
+    registry.release(1)
+    time.sleep(0.3)
+    assert len(calls) == 2 and calls[1][0] == 48
+
+
+def test_handle_belongs_to_one_session():
+    registry = SessionRegistry()
+    registry.join('a')
+    registry.join('b')
+    assert registry.reserve('a', 'alice')
+    assert not registry.reserve('b', 'alice')
+    assert registry.reserve('a', 'alice')
+
+    # Registering again gives up the previous handle
+    assert registry.reserve('a', 'alicia')
+    assert registry.session_of('alice') is None
+    assert registry.reserve('b', 'alice')
+    assert registry.handles() == ['alicia', 'alice']
+
+
+def test_tokens_expire_with_their_session():
+    registry = SessionRegistry()
+    registry.join('a')
+    registry.reserve('a', 'alice')
+    tokens = [registry.issue_token('alice') for _ in range(3)]
+    assert all(registry.resolve_token(token) == 'alice' for token in tokens)
+
+    registry.release('a')
+    assert len(registry) == 0
+    assert registry.handle_of('a') is None
+    assert all(registry.resolve_token(token) is None for token in tokens)
+    # A new owner of the handle does not inherit the old tokens
+    registry.join('b')
+    registry.reserve('b', 'alice')
+    assert registry.resolve_token(tokens[0]) is None
+
+
+def test_renamed_session_loses_its_tokens():
+    registry = SessionRegistry()
+    registry.join('a')
+    registry.reserve('a', 'alice')
+    token = registry.issue_token('alice')
+    registry.reserve('a', 'alicia')
+    assert registry.resolve_token(token) is None
@@ -0,0 +1,35 @@
+import os
+import pytest
+from client_core import ClientError
+from server_core import ClientState
+from swarm import CHUNK_SIZE
+
+
+def test_swarm_get_of_a_missing_file(start_server, connect, tmp_path):
+    server = start_server(swarm=True)
+    client = connect(server, swarm=True)
+    assert client.peer is not None
+    destination = tmp_path / 'missing.bin'
+    with pytest.raises(ClientError, match="File 'missing.bin' not found."):
+        client.get('missing.bin', 1, str(destination))
+    assert not destination.exists()
+    with pytest.raises(ClientError, match="not found"):
+        client.chunk_map('missing.bin', [])
+
+
+def test_swarm_get_hashes_a_file_found_at_startup(start_server, connect, tmp_path):
+    data = os.urandom(3 * CHUNK_SIZE + 1000)
+    files_directory = tmp_path / 'server_files'
+    files_directory.mkdir()
+    (files_directory / 'big.bin').write_bytes(data)
+    server = start_server(swarm=True)
+    client = connect(server, swarm=True)
+
+    state = ClientState(None, '127.0.0.1')
+    state.registered = True
+    assert server.pending_hash(state, '/get', ['big.bin', 'swarm']) == 'big.bin'
+    destination = tmp_path / 'copy.bin'
+    assert client.get('big.bin', 1, str(destination)) == len(data)
+    assert destination.read_bytes() == data
+    assert server.pending_hash(state, '/get', ['big.bin', 'swarm']) is None
+    assert len(client.chunk_map('big.bin', [])['hashes']) == 4